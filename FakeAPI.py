@@ -1,188 +1,2528 @@
-import json
+import time
+
+# Start of the import phase in the startup report, taken before Flask and the optional
+# packages are loaded
+IMPORT_STARTED = time.perf_counter()
 
-from flask import Flask, request, jsonify, g
+import gzip
+import csv
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import os
+import queue
+import re
+import shutil
 import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from functools import lru_cache, partial, wraps
+from urllib.parse import urlencode
+
+import click
+from flask import Flask, Response, copy_current_request_context, request, g, stream_with_context
+from flask import jsonify as flask_jsonify
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:
+    pyarrow = pq = None
 
 app = Flask(__name__)
-DATABASE = 'petstore.db'
+# Database file; configure_app() takes another one from app.config['DATABASE']
+DATABASE = app.config['DATABASE'] = os.environ.get('PETSTORE_DATABASE', 'petstore.db')
+
+# Seconds spent in each startup phase ('import', 'schema', 'warm_up') by this process,
+# or by the pre-fork master it was forked from
+startup_times = {}
+
+# Connection pool settings
+DB_POOL_SIZE = int(os.environ.get('PETSTORE_DB_POOL_SIZE', 8))
+DB_POOL_TIMEOUT = float(os.environ.get('PETSTORE_DB_POOL_TIMEOUT', 5.0))
+DB_BUSY_TIMEOUT = float(os.environ.get('PETSTORE_DB_BUSY_TIMEOUT', 5.0))
+
+# PRAGMAs applied once to every new connection
+DB_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', int(os.environ.get('PETSTORE_DB_MMAP_SIZE', 256 * 1024 * 1024))),
+    ('cache_size', int(os.environ.get('PETSTORE_DB_CACHE_SIZE', -16000))),
+)
+
+# Single-writer queue settings. When enabled, all writes run on one writer thread
+# per process and the pooled request connections are read-only.
+WRITE_QUEUE_ENABLED = os.environ.get('PETSTORE_WRITE_QUEUE', '1') == '1'
+WRITE_BATCH_SIZE = int(os.environ.get('PETSTORE_WRITE_BATCH_SIZE', 64))
+WRITE_BATCH_LATENCY = float(os.environ.get('PETSTORE_WRITE_BATCH_LATENCY_MS', 0)) / 1000
+WRITE_TIMEOUT = float(os.environ.get('PETSTORE_WRITE_TIMEOUT', 30.0))
+# Request bodies handed to the writer are read first; non-JSON bodies larger than this
+# many bytes are spooled to a temporary file instead of memory
+WRITE_BODY_SPOOL_SIZE = int(os.environ.get('PETSTORE_WRITE_BODY_SPOOL_SIZE', 1024 * 1024))
+READ_PRAGMAS = DB_PRAGMAS + ((('query_only', 'ON'),) if WRITE_QUEUE_ENABLED else ())
+
+
+# Function to open a SQLite connection with the given PRAGMAs applied
+def connect_db(database, pragmas=DB_PRAGMAS):
+    conn = sqlite3.connect(database, timeout=DB_BUSY_TIMEOUT, check_same_thread=False)
+    for name, value in pragmas:
+        conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# Pool of long-lived SQLite connections reused across requests
+class ConnectionPool:
+    def __init__(self, database, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT, pragmas=DB_PRAGMAS):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = pragmas
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # Connections must not cross a fork, so each process gets its own pool
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._open = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.created = 0
+        self.discarded = 0
+
+    def _connect(self):
+        return connect_db(self.database, self.pragmas)
+
+    @staticmethod
+    def _healthy(conn):
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._open -= 1
+            self.discarded += 1
+
+    def _new_connection(self):
+        try:
+            conn = self._connect()
+        except sqlite3.Error:
+            with self._lock:
+                self._open -= 1
+            raise
+        with self._lock:
+            self.created += 1
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            self.checkouts += 1
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_open = self._open < self.size
+                    if can_open:
+                        self._open += 1
+                    else:
+                        self.waits += 1
+                if can_open:
+                    return self._new_connection()
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise PoolTimeout(f"No database connection available within {self.timeout}s")
+            if self._healthy(conn):
+                return conn
+            self._discard(conn)
+
+    def release(self, conn):
+        if self._pid != os.getpid():
+            return
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        self._idle.put(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'open': self._open,
+                'idle': self._idle.qsize(),
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'created': self.created,
+                'discarded': self.discarded,
+            }
+
+
+db_pool = ConnectionPool(DATABASE, pragmas=READ_PRAGMAS)
+
+
+# Online backup settings. A backup copies BACKUP_STEP_PAGES pages per step and pauses
+# between steps, so it never holds the database for long and leaves I/O for the writers.
+BACKUP_STEP_PAGES = int(os.environ.get('PETSTORE_BACKUP_STEP_PAGES', 1024))
+BACKUP_STEP_SLEEP = float(os.environ.get('PETSTORE_BACKUP_STEP_SLEEP_MS', 5)) / 1000
+# A stepped copy starts over whenever another connection writes to the database; after
+# this many restarts the rest is copied in one step, as one read transaction that WAL
+# mode lets the writers work alongside.
+BACKUP_MAX_RESTARTS = int(os.environ.get('PETSTORE_BACKUP_MAX_RESTARTS', 3))
+
+# Read replica settings: comma-separated replica files that GET and HEAD requests are
+# spread over, how often they are refreshed, and how stale one may be and still serve reads
+REPLICAS = [path.strip() for path in os.environ.get('PETSTORE_REPLICAS', '').split(',') if path.strip()]
+REPLICA_SYNC_INTERVAL = float(os.environ.get('PETSTORE_REPLICA_SYNC_INTERVAL', 5.0))
+REPLICA_MAX_STALENESS = float(os.environ.get('PETSTORE_REPLICA_MAX_STALENESS', 15.0))
+# '0' leaves refreshing the replicas to a separate `flask sync-replicas` process
+REPLICA_SYNC = os.environ.get('PETSTORE_REPLICA_SYNC', '1') == '1'
+REPLICA_PRAGMAS = DB_PRAGMAS + (('query_only', 'ON'),)
+
+
+class BackupRestarted(Exception):
+    pass
+
+
+# Function to copy the database into the `target` connection with the online backup API;
+# returns the number of restarts. Readers of the target keep seeing its previous contents
+# until the copy is complete.
+def backup_database(target, pages=BACKUP_STEP_PAGES, sleep=BACKUP_STEP_SLEEP, max_restarts=BACKUP_MAX_RESTARTS,
+                    database=None):
+    database = database or DATABASE
+    restarts = 0
+    last_remaining = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, last_remaining
+        # Every step copies at least one page, so a remaining count that does not go down means a restart
+        if last_remaining is not None and remaining >= last_remaining:
+            restarts += 1
+            if restarts > max_restarts:
+                raise BackupRestarted()
+        last_remaining = remaining
+        if remaining and sleep:
+            time.sleep(sleep)
+
+    source = connect_db(database, READ_PRAGMAS)
+    try:
+        try:
+            source.backup(target, pages=pages, progress=progress)
+        except BackupRestarted:
+            source.backup(target)
+    finally:
+        source.close()
+    return restarts
+
+
+# Read replicas: copies of the database refreshed with backup_database(), which GET and
+# HEAD requests read from while they are fresh enough. Each replica's last sync time is
+# the mtime of a '<replica>-synced' marker file, so every process knows the staleness of
+# every replica no matter which process refreshed it, and a process skips replicas
+# another one has just synced.
+class ReplicaSet:
+    def __init__(self, paths, sync_interval=REPLICA_SYNC_INTERVAL, max_staleness=REPLICA_MAX_STALENESS,
+                 sync=REPLICA_SYNC):
+        self.paths = paths
+        self.sync_interval = sync_interval
+        self.max_staleness = max_staleness
+        self.sync = sync
+        self.pools = [ConnectionPool(path, pragmas=REPLICA_PRAGMAS) for path in paths]
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        self._pid = None
+        self.reads = [0] * len(paths)
+        self.fallbacks = 0
+
+    def _start(self):
+        # Threads do not survive a fork, so each process starts its own refresher
+        self._pid = os.getpid()
+        self.syncs = 0
+        self.failed_syncs = 0
+        self.restarts = 0
+        self.last_sync_seconds = 0.0
+        if self.sync:
+            thread = threading.Thread(target=self._run, name='petstore-replicas', daemon=True)
+            thread.start()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start()
+
+    @staticmethod
+    def marker(path):
+        return f"{path}-synced"
+
+    # Function to return how many seconds ago `path` was synced, or None if it never was
+    def staleness(self, path):
+        try:
+            return max(0.0, time.time() - os.stat(self.marker(path)).st_mtime)
+        except OSError:
+            return None
+
+    # Function to refresh one replica from the database; returns False if it was fresh already
+    def sync_replica(self, path, force=False):
+        staleness = self.staleness(path)
+        if not force and staleness is not None and staleness < self.sync_interval:
+            return False
+        # Marked with the time the copy started: the copy holds every commit made before it
+        started_at = time.time()
+        start = time.perf_counter()
+        conn = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT)
+        try:
+            # Readers keep their snapshot while the copy goes into the WAL
+            conn.execute("PRAGMA journal_mode = WAL")
+            restarts = backup_database(conn)
+        finally:
+            conn.close()
+        marker = self.marker(path)
+        with open(marker, 'a'):
+            pass
+        os.utime(marker, (started_at, started_at))
+        with self._lock:
+            self.syncs += 1
+            self.restarts += restarts
+            self.last_sync_seconds = round(time.perf_counter() - start, 6)
+        return True
+
+    # Function to refresh every replica that is due; returns the paths synced
+    def sync_all(self, force=False):
+        self._ensure_started()
+        synced = []
+        for path in self.paths:
+            try:
+                if self.sync_replica(path, force):
+                    synced.append(path)
+            except (sqlite3.Error, OSError):
+                app.logger.exception("Syncing replica %s failed", path)
+                with self._lock:
+                    self.failed_syncs += 1
+        return synced
+
+    def _run(self):
+        while True:
+            started = time.monotonic()
+            self.sync_all()
+            time.sleep(max(0.0, self.sync_interval - (time.monotonic() - started)))
+
+    # Function to choose the pool of a fresh replica, round-robin; None when none is fresh
+    def pick(self):
+        if not self.pools:
+            return None
+        self._ensure_started()
+        first = next(self._next)
+        for offset in range(len(self.pools)):
+            position = (first + offset) % len(self.pools)
+            staleness = self.staleness(self.paths[position])
+            if staleness is not None and staleness <= self.max_staleness:
+                with self._lock:
+                    self.reads[position] += 1
+                return self.pools[position]
+        with self._lock:
+            self.fallbacks += 1
+        return None
+
+    def metrics(self):
+        self._ensure_started()
+        replicas = []
+        for path, pool, reads in zip(self.paths, self.pools, self.reads):
+            staleness = self.staleness(path)
+            replicas.append({
+                'path': path,
+                'staleness': None if staleness is None else round(staleness, 3),
+                'fresh': staleness is not None and staleness <= self.max_staleness,
+                'reads': reads,
+                'pool': pool.metrics(),
+            })
+        with self._lock:
+            return {
+                'syncing': self.sync and bool(self.paths),
+                'max_staleness': self.max_staleness,
+                'fresh': sum(1 for replica in replicas if replica['fresh']),
+                'syncs': self.syncs,
+                'failed_syncs': self.failed_syncs,
+                'restarts': self.restarts,
+                'last_sync_seconds': self.last_sync_seconds,
+                'fallbacks': self.fallbacks,
+                'replicas': replicas,
+            }
+
+
+replica_set = ReplicaSet(REPLICAS)
+
+
+# Instrumentation settings; both can also be changed at runtime through /metrics/config
+METRICS_ENABLED = os.environ.get('PETSTORE_METRICS', '1') == '1'
+SLOW_QUERY_MS = float(os.environ.get('PETSTORE_SLOW_QUERY_MS', 100))
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+
+# Cumulative histogram in the Prometheus style
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[position] += 1
+                break
+
+
+# Per-route request, SQL and serialization statistics plus a slow-query log.
+# Every hook returns immediately while disabled, so the cost is one attribute check.
+class Instrumentation:
+    def __init__(self, enabled=METRICS_ENABLED, slow_query_ms=SLOW_QUERY_MS, slow_log_size=100):
+        self.enabled = enabled
+        self.slow_query_ms = slow_query_ms
+        self.slow_queries = deque(maxlen=slow_log_size)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.requests = {}
+
+    def _observe(self, metric, labels, buckets, value):
+        key = (metric, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def start_request(self):
+        g._metrics = {'start': time.perf_counter(), 'sql': 0.0, 'rows': 0, 'serialize': 0.0}
+
+    def record_sql(self, query, seconds, rows):
+        stats = g.get('_metrics') if g else None
+        if stats is not None:
+            stats['sql'] += seconds
+            stats['rows'] += rows
+        if seconds * 1000 >= self.slow_query_ms:
+            route = request.path if request else None
+            self.slow_queries.append({
+                'time': time.time(), 'ms': round(seconds * 1000, 3), 'rows': rows, 'route': route,
+                'query': ' '.join(query.split()),
+            })
+            app.logger.warning("Slow query (%.1f ms, %d rows): %s", seconds * 1000, rows, query)
+
+    def record_serialize(self, seconds):
+        stats = g.get('_metrics') if g else None
+        if stats is not None:
+            stats['serialize'] += seconds
+
+    def finish_request(self, response):
+        stats = g.pop('_metrics', None)
+        if stats is None:
+            return
+        total = time.perf_counter() - stats['start']
+        rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        labels = (('method', request.method), ('route', rule))
+        with self._lock:
+            self._observe('petstore_request_duration_seconds', labels, LATENCY_BUCKETS, total)
+            self._observe('petstore_request_sql_seconds', labels, LATENCY_BUCKETS, stats['sql'])
+            self._observe('petstore_request_serialize_seconds', labels, LATENCY_BUCKETS, stats['serialize'])
+            self._observe('petstore_request_rows', labels, ROW_BUCKETS, stats['rows'])
+            # Only requests that went through the write queue waited in it
+            if 'queue' in stats:
+                self._observe('petstore_request_queue_seconds', labels, LATENCY_BUCKETS, stats['queue'])
+            key = labels + (('status', str(response.status_code)),)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    # Render everything in the Prometheus text exposition format
+    def render(self, gauges):
+        def label_text(labels):
+            return ','.join(f'{name}="{value}"' for name, value in labels)
+
+        lines = []
+        with self._lock:
+            lines.append("# TYPE petstore_requests_total counter")
+            for labels, count in sorted(self.requests.items()):
+                lines.append(f"petstore_requests_total{{{label_text(labels)}}} {count}")
+            declared = set()
+            for (metric, labels), histogram in sorted(self.histograms.items()):
+                if metric not in declared:
+                    lines.append(f"# TYPE {metric} histogram")
+                    declared.add(metric)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    bucket_labels = label_text(labels + (("le", repr(float(bound))),))
+                    lines.append(f'{metric}_bucket{{{bucket_labels}}} {cumulative}')
+                lines.append(f'{metric}_bucket{{{label_text(labels + (("le", "+Inf"),))}}} {histogram.count}')
+                lines.append(f"{metric}_sum{{{label_text(labels)}}} {histogram.sum}")
+                lines.append(f"{metric}_count{{{label_text(labels)}}} {histogram.count}")
+        for metric, value in gauges:
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+instrumentation = Instrumentation()
+
+
+# jsonify that reports its encoding time to the instrumentation
+def jsonify(*args, **kwargs):
+    if not instrumentation.enabled:
+        return flask_jsonify(*args, **kwargs)
+    start = time.perf_counter()
+    response = flask_jsonify(*args, **kwargs)
+    instrumentation.record_serialize(time.perf_counter() - start)
+    return response
+
+
+@app.before_request
+def start_request_metrics():
+    if instrumentation.enabled:
+        instrumentation.start_request()
+
+
+@app.after_request
+def finish_request_metrics(response):
+    if instrumentation.enabled:
+        instrumentation.finish_request(response)
+    return response
+
+
+# Response compression settings. Encodings are listed in the server's order of
+# preference and used when the client accepts them with an equal quality.
+COMPRESS_ENCODINGS = [encoding.strip() for encoding in
+                      os.environ.get('PETSTORE_COMPRESS_ENCODINGS', 'zstd,br,gzip').split(',') if encoding.strip()]
+COMPRESS_MIN_SIZE = int(os.environ.get('PETSTORE_COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVELS = {
+    'gzip': int(os.environ.get('PETSTORE_GZIP_LEVEL', 6)),
+    'br': int(os.environ.get('PETSTORE_BROTLI_LEVEL', 4)),
+    'zstd': int(os.environ.get('PETSTORE_ZSTD_LEVEL', 3)),
+}
+COMPRESS_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/plain', 'text/csv', 'text/html')
+
+
+# Streaming brotli compressor with the same interface as zlib's
+class BrotliCompressor:
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+# Compressor factories by Content-Encoding; each takes a level and returns an object
+# with compress(data) and flush()
+COMPRESSORS = {'gzip': lambda level: zlib.compressobj(level, zlib.DEFLATED, 31)}
+if brotli is not None:
+    COMPRESSORS['br'] = BrotliCompressor
+if zstandard is not None:
+    COMPRESSORS['zstd'] = lambda level: zstandard.ZstdCompressor(level=level).compressobj()
+COMPRESS_ENCODINGS = [encoding for encoding in COMPRESS_ENCODINGS if encoding in COMPRESSORS]
+
+
+# Function to pick the Content-Encoding for the current request; None means identity
+def negotiate_encoding():
+    accepted = request.accept_encodings
+    best, best_quality = None, 0
+    for encoding in COMPRESS_ENCODINGS:
+        quality = accepted[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+# Generator to compress a streamed body chunk by chunk
+def compress_chunks(chunks, compressor):
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+# Function to match a client's ETags against an ETag or one of its compressed variants
+def etag_matches(etags, etag):
+    return etags.contains(etag) or any(etags.contains(f"{etag}-{encoding}") for encoding in COMPRESSORS)
+
+
+@app.after_request
+def compress_response(response):
+    if (not COMPRESS_ENCODINGS or response.mimetype not in COMPRESS_MIMETYPES
+            or 'Content-Encoding' in response.headers):
+        return response
+    etag, weak = response.get_etag()
+    if response.status_code == 304:
+        # Answer with the ETag of the variant the client holds
+        encoding = negotiate_encoding() if etag else None
+        if encoding and request.if_none_match.contains(f"{etag}-{encoding}"):
+            response.set_etag(f"{etag}-{encoding}", weak)
+        return response
+    if response.status_code < 200 or response.status_code in (204, 206):
+        return response
+    response.vary.add('Accept-Encoding')
+    if not response.is_streamed and len(response.get_data()) < COMPRESS_MIN_SIZE:
+        return response
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+    compressor = COMPRESSORS[encoding](COMPRESS_LEVELS[encoding])
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, compressor)
+        response.direct_passthrough = False
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(compressor.compress(response.get_data()) + compressor.flush())
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        # Each encoding is a different representation and needs its own strong ETag
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
+
+# Connection pinned to the current thread (the writer thread, or init_db)
+_pinned = threading.local()
+
+
+# Context manager to make get_db() return `conn` on this thread
+@contextmanager
+def use_connection(conn):
+    previous = getattr(_pinned, 'connection', None)
+    _pinned.connection = conn
+    try:
+        yield conn
+    finally:
+        _pinned.connection = previous
+
+
+# Function to choose where this request reads from: its shard for sharded routes, a fresh
+# replica for other GET and HEAD requests when replicas are configured, the primary otherwise
+def request_pool():
+    shard = g.get('_shard')
+    if shard is not None:
+        return shard_pools[shard]
+    if request and request.method in ('GET', 'HEAD'):
+        return replica_set.pick() or db_pool
+    return db_pool
+
+
+# Function to tell whether this request's connection is a replica's
+def on_replica():
+    return any(pool is g.get('_database_pool') for pool in replica_set.pools)
 
 
 # Function to get a database connection
 def get_db():
+    db = getattr(_pinned, 'connection', None)
+    if db is not None:
+        return db
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
+        pool = request_pool()
+        db = g._database = pool.acquire()
+        g._database_pool = pool
     return db
 
 
-# Function to execute SQL queries and return results
+# Functions called after every commit, e.g. to wake up change feed subscribers
+COMMIT_HOOKS = []
+
+
+# Function to run a read-only query and return results (never commits)
+def query_db(query, args=()):
+    timed = instrumentation.enabled
+    if timed:
+        start = time.perf_counter()
+    cur = get_db().execute(query, args)
+    rows = cur.fetchall()
+    cur.close()
+    if timed:
+        instrumentation.record_sql(query, time.perf_counter() - start, len(rows))
+    return rows
+
+
+# Generator to run a read-only query and yield rows in fetchmany batches
+def iter_query(query, args=(), batch_size=None):
+    cur = get_db().execute(query, args)
+    try:
+        while True:
+            timed = instrumentation.enabled
+            if timed:
+                start = time.perf_counter()
+            rows = cur.fetchmany(batch_size or cur.arraysize)
+            if timed:
+                instrumentation.record_sql(query, time.perf_counter() - start, len(rows))
+            if not rows:
+                break
+            yield rows
+    finally:
+        cur.close()
+
+
+# Context manager for a write transaction; nested scopes join the outer one
+@contextmanager
+def transaction():
+    db = get_db()
+    if db.in_transaction:
+        yield db
+        return
+    db.execute("BEGIN IMMEDIATE")
+    g._after_commit = []
+    try:
+        yield db
+    except BaseException:
+        g.pop('_after_commit', None)
+        db.rollback()
+        raise
+    db.commit()
+    for hook in COMMIT_HOOKS:
+        hook()
+    for callback in g.pop('_after_commit', ()):
+        callback()
+
+
+# Function to run a callback once the current transaction commits (or now, outside one)
+def after_commit(callback):
+    callbacks = g.get('_after_commit')
+    if callbacks is None:
+        callback()
+    else:
+        callbacks.append(callback)
+
+
+# Queue of write jobs drained by one writer thread that group-commits them in batches.
+# Each job runs in its own savepoint, so a failing job does not undo the rest of its batch.
+class WriteQueue:
+    def __init__(self, database, batch_size=WRITE_BATCH_SIZE, batch_latency=WRITE_BATCH_LATENCY,
+                 timeout=WRITE_TIMEOUT):
+        self.database = database
+        self.batch_size = batch_size
+        self.batch_latency = batch_latency
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+
+    def _start(self):
+        # Threads do not survive a fork, so each process starts its own writer
+        self._pid = os.getpid()
+        self._queue = queue.Queue()
+        self.jobs = 0
+        self.failed_jobs = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.max_batch_size = 0
+        self.batch_sizes = {}
+        self._thread = threading.Thread(target=self._run, name='petstore-writer', daemon=True)
+        self._thread.start()
+
+    def is_writer_thread(self):
+        return threading.current_thread() is self._thread
+
+    # Function to queue job() for the writer thread without waiting; returns its Future
+    def enqueue(self, job):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start()
+        future = Future()
+        self._queue.put((job, future))
+        return future
+
+    # Function to run job() on the writer thread and return its result: (value, after-commit callbacks)
+    def submit(self, job):
+        future = self.enqueue(job)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            # A job still queued is dropped, so it cannot commit after the client got an
+            # error; one already running is waited for, as its outcome is then unknown
+            if future.cancel():
+                raise
+            return future.result()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_latency
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+        return batch
+
+    def _run(self):
+        conn = connect_db(self.database)
+        with use_connection(conn):
+            while True:
+                self._commit_batch(conn, self._next_batch())
+
+    def _commit_batch(self, conn, batch):
+        outcomes = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for job, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT job")
+                try:
+                    outcomes.append((future, job(), None))
+                    conn.execute("RELEASE job")
+                except BaseException as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    outcomes.append((future, None, e))
+            conn.commit()
+            for hook in COMMIT_HOOKS:
+                hook()
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.rollback()
+            with self._lock:
+                self.failed_batches += 1
+            for job, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+                continue
+            value, callbacks = result
+            for callback in callbacks:
+                callback()
+            future.set_result(value)
+        with self._lock:
+            self.batches += 1
+            self.jobs += len(batch)
+            self.failed_jobs += sum(1 for _, _, error in outcomes if error is not None)
+            self.max_batch_size = max(self.max_batch_size, len(batch))
+            self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+
+    def metrics(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                return {'enabled': WRITE_QUEUE_ENABLED, 'running': False}
+            return {
+                'enabled': WRITE_QUEUE_ENABLED,
+                'running': self._thread.is_alive(),
+                'queue_depth': self._queue.qsize(),
+                'jobs': self.jobs,
+                'failed_jobs': self.failed_jobs,
+                'batches': self.batches,
+                'failed_batches': self.failed_batches,
+                'max_batch_size': self.max_batch_size,
+                'avg_batch_size': round(self.jobs / self.batches, 2) if self.batches else 0,
+                'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+            }
+
+
+write_queue = WriteQueue(DATABASE)
+
+
+# Optional sharding. With PETSTORE_SHARDS set, pets and orders live in that many shard
+# files instead of the main database, which keeps users, categories and tags (the
+# catalog). Every shard has its own writer thread, so writes to different shards commit
+# in parallel. A row's shard is its id modulo the shard count: the id allocator hands
+# out ids of the shard asked for, and a new order goes to its pet's shard. Single-entity
+# routes use one shard; collections and aggregates query all of them in parallel.
+SHARD_COUNT = int(os.environ.get('PETSTORE_SHARDS', 0))
+SHARDED_TABLES = ('pets', 'orders')
+# Shard file names; {shard} is replaced by the shard number, {root} and {ext} by the
+# database path without and with only its extension
+SHARD_PATH = os.environ.get('PETSTORE_SHARD_PATH', '{root}-shard{shard}{ext}')
+
+
+# Function to list the shard files belonging to a database
+def shard_paths(database):
+    root, ext = os.path.splitext(database)
+    return [SHARD_PATH.format(shard=shard, root=root, ext=ext) for shard in range(SHARD_COUNT)]
+
+
+SHARD_PATHS = shard_paths(DATABASE)
+DATABASES = [DATABASE] + SHARD_PATHS
+# Ids each process reserves at a time per table and shard
+ID_BLOCK_SIZE = int(os.environ.get('PETSTORE_ID_BLOCK_SIZE', 100))
+# Threads running the per-shard queries of collection and aggregate requests
+SHARD_QUERY_THREADS = int(os.environ.get('PETSTORE_SHARD_QUERY_THREADS', 4 * max(SHARD_COUNT, 1)))
+
+if SHARD_COUNT and not WRITE_QUEUE_ENABLED:
+    raise RuntimeError("Sharding needs the write queue; unset PETSTORE_WRITE_QUEUE=0 or PETSTORE_SHARDS")
+
+
+# Read pool of a shard. Tags live in the main database, attached as `catalog`; a temp
+# view shadows the shard's own empty tags table, so tag joins work as they are.
+class ShardPool(ConnectionPool):
+    def _connect(self):
+        conn = connect_db(self.database)
+        conn.execute("ATTACH DATABASE ? AS catalog", (DATABASE,))
+        conn.execute("CREATE TEMP VIEW tags AS SELECT * FROM catalog.tags")
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+
+# Writer of a shard. The catalog is not attached, as BEGIN IMMEDIATE would then lock it
+# for every shard write; the thread keeps its own connection to it for new tags instead.
+class ShardWriteQueue(WriteQueue):
+    def __init__(self, database, shard):
+        super().__init__(database)
+        self.shard = shard
+
+    def _start(self):
+        super()._start()
+        # Tag renames committed while no writer of this shard was running are applied first
+        future = Future()
+        future.add_done_callback(partial(log_tag_renames_failure, self.shard))
+        self._queue.put((tag_renames_job, future))
+
+    def _run(self):
+        _pinned.shard = self.shard
+        _pinned.catalog = connect_db(DATABASE)
+        super()._run()
+
+
+shard_pools = [ShardPool(path) for path in SHARD_PATHS]
+shard_write_queues = [ShardWriteQueue(path, shard) for shard, path in enumerate(SHARD_PATHS)]
+
+
+# Global id allocator for the sharded tables. An id is slot * SHARD_COUNT + shard, and
+# each process reserves blocks of slots per (table, shard) from id_allocations in the
+# main database, so ids are unique across processes without a round trip per insert.
+class IdAllocator:
+    def __init__(self, database, block_size=ID_BLOCK_SIZE):
+        self.database = database
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _reserve(self, table, shard):
+        conn = connect_db(self.database)
+        try:
+            with conn:
+                end = conn.execute(
+                    "UPDATE id_allocations SET next_slot = next_slot + ? WHERE name = ? AND shard = ? "
+                    "RETURNING next_slot", (self.block_size, table, shard)
+                ).fetchone()[0]
+        finally:
+            conn.close()
+        return [end - self.block_size, end]
+
+    def allocate(self, table, shard):
+        with self._lock:
+            # Reserved blocks must not be shared with a forked child
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._blocks = {}
+            block = self._blocks.get((table, shard))
+            if block is None or block[0] >= block[1]:
+                block = self._blocks[(table, shard)] = self._reserve(table, shard)
+            slot = block[0]
+            block[0] += 1
+        return slot * SHARD_COUNT + shard
+
+    # Function to move the allocator of a table and shard past `highest`, e.g. after rows
+    # were imported with their ids. Blocks other processes already reserved are not known
+    # here, so imports are best run while no other process creates rows of the table.
+    def advance(self, catalog, table, shard, highest):
+        with catalog:
+            catalog.execute("UPDATE id_allocations SET next_slot = MAX(next_slot, ?) WHERE name = ? AND shard = ?",
+                            (highest // SHARD_COUNT + 1, table, shard))
+        with self._lock:
+            if self._pid == os.getpid():
+                self._blocks.pop((table, shard), None)
+
+
+id_allocator = IdAllocator(DATABASE)
+_shard_cycle = itertools.count()
+
+
+# Function to tell whether a table is split across shards
+def is_sharded(table):
+    return SHARD_COUNT > 0 and table in SHARDED_TABLES
+
+
+# Function to map an id to its shard
+def shard_for(entity_id):
+    return entity_id % SHARD_COUNT
+
+
+# Function to pick the shard of a new pet, round-robin
+def next_shard():
+    return next(_shard_cycle) % SHARD_COUNT
+
+
+# Function to pick the shard of a new order: its pet's, so the two are stored together
+def order_shard(data):
+    pet_id = data.get('pet_id') if isinstance(data, dict) else None
+    if isinstance(pet_id, int) and not isinstance(pet_id, bool):
+        return shard_for(pet_id)
+    # The handler rejects the order, wherever it runs
+    return 0
+
+
+# Function to tell which shard this writer thread or request works on; None for the main database
+def current_shard():
+    shard = getattr(_pinned, 'shard', None)
+    if shard is None and g:
+        shard = g.get('_shard')
+    return shard
+
+
+# Function to allocate the id of a new row: None (SQLite assigns it) unless the table is sharded
+def new_id(table):
+    return id_allocator.allocate(table, current_shard()) if is_sharded(table) else None
+
+
+# Function to get the connection holding the tags for writes made on `db`
+def catalog_for(db):
+    return getattr(_pinned, 'catalog', None) or db
+
+
+# Decorator to run a pets or orders handler on one shard, chosen by `shard_of` from the
+# route arguments; get_db() and @transactional then use that shard. A no-op unsharded.
+def on_shard(shard_of):
+    def decorator(f):
+        if not SHARD_COUNT:
+            return f
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            g._shard = shard_of(**kwargs)
+            return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Scatter-gather over the shards: each query runs on every shard in parallel, on
+# executor threads created per process
+class ShardQueries:
+    def __init__(self, threads=SHARD_QUERY_THREADS):
+        self.threads = threads
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _executor(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='petstore-shards')
+            return self.executor
+
+    @staticmethod
+    def _query(pool, query, args):
+        conn = pool.acquire()
+        try:
+            return conn.execute(query, args).fetchall()
+        finally:
+            pool.release(conn)
+
+    # Function to run a read query on every shard; returns each shard's rows, in shard order
+    def scatter(self, query, args=()):
+        timed = instrumentation.enabled
+        if timed:
+            start = time.perf_counter()
+        results = list(self._executor().map(lambda pool: self._query(pool, query, args), shard_pools))
+        if timed:
+            instrumentation.record_sql(query, time.perf_counter() - start, sum(len(rows) for rows in results))
+        return results
+
+
+shard_queries = ShardQueries()
+
+
+# Function to run a read query over a table: on every shard when it is sharded, with the
+# rows of all shards concatenated, otherwise on this request's database
+def gather(table, query, args=()):
+    if not is_sharded(table):
+        return query_db(query, args)
+    return [row for rows in shard_queries.scatter(query, args) for row in rows]
+
+
+# Function to run a query ordered by id and return its first `limit` rows; on a sharded
+# table each shard returns its first `limit` and the sorted lists are k-way merged
+def gather_ordered(table, query, args, limit):
+    if not is_sharded(table):
+        return query_db(query + " LIMIT ?", list(args) + [limit])
+    results = shard_queries.scatter(query + " LIMIT ?", list(args) + [limit])
+    return list(itertools.islice(heapq.merge(*results, key=lambda row: row[0]), limit))
+
+
+# Generator of row batches of a query ordered by id. On a sharded table every shard
+# streams from its own connection and the streams are k-way merged by id.
+def iter_ordered(table, query, args, batch_size, limit=None):
+    if not is_sharded(table):
+        yield from iter_query(query, args, batch_size)
+        return
+
+    def shard_rows(pool):
+        conn = pool.acquire()
+        try:
+            cursor = conn.execute(query, args)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            pool.release(conn)
+
+    streams = [shard_rows(pool) for pool in shard_pools]
+    try:
+        merged = itertools.islice(heapq.merge(*streams, key=lambda row: row[0]), limit)
+        while True:
+            rows = list(itertools.islice(merged, batch_size))
+            if not rows:
+                return
+            yield rows
+    finally:
+        for stream in streams:
+            stream.close()
+
+
+# Tag renames and deletions reach the pets on the shards through tag_renames, which the
+# tag handlers append to in the catalog transaction. Each shard records the last one it
+# applied in tag_renames_applied, in the same transaction as the pets it rewrote, so a
+# rename is applied exactly once even if a shard fails or the process stops first.
+
+# Function to apply the tag renames (new_name NULL for a deletion) this shard has not
+# applied yet to its pets; runs on the shard's writer, and returns the changed pet ids
+def apply_tag_renames(db, catalog):
+    applied = db.execute("SELECT seq FROM tag_renames_applied").fetchone()[0]
+    renames = catalog.execute("SELECT seq, tag_id, old_name, new_name FROM tag_renames WHERE seq > ? ORDER BY seq",
+                              (applied,)).fetchall()
+    changed = set()
+    for _, tag_id, old_name, new_name in renames:
+        pet_ids = [row[0] for row in db.execute("SELECT pet_id FROM pet_tags WHERE tag_id = ?", (tag_id,))]
+        if new_name is None:
+            db.execute("DELETE FROM pet_tags WHERE tag_id = ?", (tag_id,))
+        for pet_id in pet_ids:
+            tags = db.execute("SELECT tags FROM pets WHERE id = ?", (pet_id,)).fetchone()[0]
+            names = [new_name if name == old_name else name for name in split_list(tags)
+                     if new_name is not None or name != old_name]
+            db.execute("UPDATE pets SET tags = ? WHERE id = ?", (', '.join(names), pet_id))
+        changed.update(pet_ids)
+    if renames:
+        db.execute("UPDATE tag_renames_applied SET seq = ?", (renames[-1][0],))
+    return changed
+
+
+# Write job running apply_tag_renames() on a shard's writer
+def tag_renames_job():
+    pet_ids = apply_tag_renames(get_db(), _pinned.catalog)
+
+    def invalidate():
+        for pet_id in pet_ids:
+            entity_cache.delete(('pets', pet_id))
+    return None, [invalidate]
+
+
+# Function to log a failed tag renames job; the renames stay pending until the next one
+def log_tag_renames_failure(shard, future):
+    if not future.cancelled() and future.exception() is not None:
+        app.logger.error("Applying tag renames to the pets on shard %d failed; they are retried with the next "
+                         "tag change or when the writer restarts", shard, exc_info=future.exception())
+
+
+# Function to have every shard's writer apply the new tag renames. Runs after the tag
+# change commits, on the main writer, so it only queues the jobs and does not wait.
+def sync_shard_tags():
+    for shard_queue in shard_write_queues:
+        future = shard_queue.enqueue(tag_renames_job)
+        future.add_done_callback(partial(log_tag_renames_failure, shard_queue.shard))
+
+
+# Function to read the whole request body before a handler goes to the writer thread,
+# so a slow client never holds up the writer or the write lock. JSON is parsed and
+# cached on the request; other bodies are spooled and read through request_stream().
+def buffer_request_body():
+    if request.is_json:
+        request.get_json(silent=True)
+        return None
+    # Already read by a caller, which closes it
+    if 'petstore.body' in request.environ:
+        return None
+    body = tempfile.SpooledTemporaryFile(max_size=WRITE_BODY_SPOOL_SIZE)
+    shutil.copyfileobj(request.stream, body)
+    body.seek(0)
+    request.environ['petstore.body'] = body
+    return body
+
+
+# Function to return the request body as a stream, buffered or straight from the client
+def request_stream():
+    return request.environ.get('petstore.body') or request.stream
+
+
+# Decorator to run a mutating handler inside a single transaction. With the write
+# queue enabled the handler runs on the writer thread, in the current request's context,
+# once the request body has been read on the request thread.
+def transactional(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        shard = current_shard()
+        writer = write_queue if shard is None else shard_write_queues[shard]
+        if WRITE_QUEUE_ENABLED and not writer.is_writer_thread():
+            # The writer gets a fresh app context, so the request's metrics are handed over
+            metrics = g.get('_metrics')
+
+            @copy_current_request_context
+            def job():
+                if metrics is not None:
+                    metrics['queue'] = metrics.get('queue', 0.0) + time.perf_counter() - submitted
+                    g._metrics = metrics
+                g._after_commit = []
+                value = f(*args, **kwargs)
+                return value, g.pop('_after_commit')
+            body = buffer_request_body()
+            submitted = time.perf_counter()
+            try:
+                return writer.submit(job)
+            finally:
+                if body is not None:
+                    body.close()
+        with transaction():
+            return f(*args, **kwargs)
+    return wrapper
+
+
+# Function to execute a write statement inside a transaction and return results
 def execute_query(query, args=()):
-    cur = get_db().cursor()
-    cur.execute(query, args)
-    get_db().commit()
-    return cur.fetchall()
+    with transaction() as db:
+        timed = instrumentation.enabled
+        if timed:
+            start = time.perf_counter()
+        cur = db.execute(query, args)
+        rows = cur.fetchall()
+        if timed:
+            instrumentation.record_sql(query, time.perf_counter() - start, max(cur.rowcount, len(rows)))
+        cur.close()
+        return rows
+
+
+# Entity cache settings
+ENTITY_CACHE_SIZE = int(os.environ.get('PETSTORE_ENTITY_CACHE_SIZE', 10000))
+ENTITY_CACHE_TTL = float(os.environ.get('PETSTORE_ENTITY_CACHE_TTL', 60.0))
+
+
+# Interface for entity cache backends, so the in-process cache can be swapped out
+class CacheBackend:
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def metrics(self):
+        return {}
+
+
+# In-process LRU cache with a per-entry time to live
+class LRUCache(CacheBackend):
+    def __init__(self, maxsize=ENTITY_CACHE_SIZE, ttl=ENTITY_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+entity_cache = LRUCache()
+
+
+# Function to look up a single row by id through the entity cache; returns a list like query_db.
+# A hit never touches SQLite. Writes in this process invalidate their keys when they commit;
+# writes by other processes are only seen once the entry's TTL runs out, so the TTL bounds
+# how stale a hit can be when several processes serve the same database.
+def cached_query(table, entity_id, query):
+    key = (table, entity_id)
+    row = entity_cache.get(key)
+    if row is not None:
+        return [row]
+    rows = query_db(query, (entity_id,))
+    # A replica row may predate a write that already invalidated the key, so only primary rows are cached
+    if rows and not on_replica():
+        entity_cache.set(key, rows[0])
+    return rows
+
+
+# Function to drop a cached entity now and again once the write commits
+def invalidate_entity(table, entity_id):
+    key = (table, entity_id)
+    entity_cache.delete(key)
+    after_commit(lambda: entity_cache.delete(key))
+
+
+# Conditional requests. Every row has a version that each write bumps (starting from
+# the table's change counter, so a reused id never repeats one) and an updated_at unix
+# timestamp; single-entity GETs select both after the model columns.
+# Collections use the per-table change counter in table_versions instead.
+SQL_NOW = "(julianday('now') - 2440587.5) * 86400.0"
+
+
+# Function to build the strong ETag of a row version
+def entity_etag(version):
+    return f"v{version}"
+
+
+# Function to tell whether the client's cached copy is still current
+def not_modified(etag, last_modified=None):
+    if request.if_none_match:
+        return etag_matches(request.if_none_match, etag)
+    if_modified_since = request.if_modified_since
+    return (last_modified is not None and if_modified_since is not None
+            and int(last_modified) <= if_modified_since.timestamp())
+
+
+# Function to check If-Match before a write; a missing header always passes
+def if_match(version):
+    return not request.if_match or etag_matches(request.if_match, entity_etag(version))
+
+
+# Function to respond with one entity row (model columns, version, updated_at),
+# or with 304 and no body when the client's copy is current
+def entity_response(model, row):
+    *values, version, updated_at = row
+    etag = entity_etag(version)
+    if not_modified(etag, updated_at):
+        response = Response(status=304)
+    else:
+        response = jsonify(model(*values).to_dict())
+    response.set_etag(etag)
+    if updated_at is not None:
+        response.last_modified = updated_at
+    return response
+
+
+# Function to build an empty 304 response carrying `etag`
+def not_modified_response(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+# Function to build a collection ETag from the table's change counter and the request
+def collection_etag(table):
+    # A sharded table changes whenever one of its shards' counters does, so their sum is its counter
+    counter = sum(version for version, in gather(table, "SELECT version FROM table_versions WHERE name = ?", (table,)))
+    request_key = f"{request.full_path}|{request.accept_mimetypes}".encode('utf-8')
+    return f"{counter}-{hashlib.sha1(request_key).hexdigest()[:16]}"
+
+
+# Compact JSON encoders by name. PETSTORE_JSON_ENCODER picks the one used for rows and
+# for every jsonify() response; 'auto' takes orjson when it is installed.
+JSON_ENCODERS = {
+    'json': json.JSONEncoder(separators=(',', ':'), default=DefaultJSONProvider.default).encode,
+}
+if orjson is not None:
+    def encode_orjson(obj):
+        return orjson.dumps(obj, default=DefaultJSONProvider.default).decode('utf-8')
+    JSON_ENCODERS['orjson'] = encode_orjson
+
+JSON_ENCODER = os.environ.get('PETSTORE_JSON_ENCODER', 'auto')
+if JSON_ENCODER == 'auto':
+    JSON_ENCODER = 'orjson' if 'orjson' in JSON_ENCODERS else 'json'
+if JSON_ENCODER not in JSON_ENCODERS:
+    raise RuntimeError(f"JSON encoder {JSON_ENCODER!r} is not available; choose from {', '.join(JSON_ENCODERS)}")
+encode_json = JSON_ENCODERS[JSON_ENCODER]
+
+
+# Flask JSON provider that makes jsonify() use encode_json: compact output with keys in
+# insertion order. Only debug mode (the development server) still pretty-prints.
+class FastJSONProvider(DefaultJSONProvider):
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return encode_json(obj)
+
+    def response(self, *args, **kwargs):
+        if self._app.debug:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(f"{encode_json(obj)}\n", mimetype=self.mimetype)
+
+
+app.json = FastJSONProvider(app)
+
+
+# Function to build an encoder that turns one row tuple straight into a JSON object,
+# without building a model object first
+@lru_cache(maxsize=None)
+def row_encoder(columns):
+    def encode_row(row):
+        return encode_json(dict(zip(columns, row)))
+    return encode_row
+
+
+# Function to build an encoder that turns a batch of rows into a JSON array in one
+# encoder call; only the dicts of the current batch are alive at a time
+@lru_cache(maxsize=None)
+def rows_encoder(columns):
+    def encode_rows(rows):
+        return encode_json([dict(zip(columns, row)) for row in rows])
+    return encode_rows
+
+
+# Base class for compact row models; subclasses list their columns in __slots__
+class Model:
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+        for name in self.__slots__[len(args):]:
+            setattr(self, name, kwargs.get(name))
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
 
 
 # Define data models
-class User:
-    def __init__(self, id, username, email, phone, address, user_status):
-        self.id = id
-        self.username = username
-        self.email = email
-        self.phone = phone
-        self.address = address
-        self.user_status = user_status
+class User(Model):
+    __slots__ = ('id', 'username', 'email', 'phone', 'address', 'user_status')
 
 
-class Pet:
-    def __init__(self, id, name, category_id, photo_urls, tags, status):
-        self.id = id
-        self.name = name
-        self.category_id = category_id
-        self.photo_urls = photo_urls
-        self.tags = tags
-        self.status = status
+class Pet(Model):
+    __slots__ = ('id', 'name', 'category_id', 'photo_urls', 'tags', 'status')
 
 
-class Order:
-    def __init__(self, id, pet_id, quantity, ship_date, status, complete):
-        self.id = id
-        self.pet_id = pet_id
-        self.quantity = quantity
-        self.ship_date = ship_date
-        self.status = status
-        self.complete = complete
+class Order(Model):
+    __slots__ = ('id', 'pet_id', 'quantity', 'ship_date', 'status', 'complete')
 
 
-class Category:
-    def __init__(self, id, name):
-        self.id = id
-        self.name = name
+class Category(Model):
+    __slots__ = ('id', 'name')
 
 
-class Tag:
-    def __init__(self, id, name):
-        self.id = id
-        self.name = name
+class Tag(Model):
+    __slots__ = ('id', 'name')
 
 
-# Function to create tables if they don't exist
-def init_db():
-    with app.app_context():
-        cursor = get_db().cursor()
-        # Create users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY,
-                username TEXT NOT NULL,
-                email TEXT NOT NULL,
-                phone TEXT NOT NULL,
-                userStatus INTEGER NOT NULL,
-                address TEXT NOT NULL
-            )
-        ''')
+# Columns and constraints of each table as migration 1 creates it, with the column
+# names the handlers use and no NOT NULL on fields the API treats as optional
+TABLE_DEFINITIONS = {
+    'users': ('id INTEGER PRIMARY KEY', 'username TEXT', 'email TEXT', 'phone TEXT', 'address TEXT',
+              'user_status TEXT'),
+    'pets': ('id INTEGER PRIMARY KEY', 'name TEXT', 'category_id INTEGER', 'photo_urls TEXT', 'tags TEXT',
+             'status TEXT', 'FOREIGN KEY (category_id) REFERENCES categories (id)'),
+    'orders': ('id INTEGER PRIMARY KEY', 'pet_id INTEGER', 'quantity INTEGER', 'ship_date TEXT', 'status TEXT',
+               'complete BOOLEAN', 'FOREIGN KEY (pet_id) REFERENCES pets (id)'),
+    'categories': ('id INTEGER PRIMARY KEY', 'name TEXT'),
+    'tags': ('id INTEGER PRIMARY KEY', 'name TEXT'),
+}
+
+
+# Migration 1: create the tables with the column names the handlers use
+def create_tables(cursor):
+    for table, definition in TABLE_DEFINITIONS.items():
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(definition)})")
+
+
+# Columns created under the wrong name by earlier versions of init_db()
+LEGACY_COLUMNS = (
+    ('users', 'userStatus', 'user_status'),
+    ('pets', 'photoUrls', 'photo_urls'),
+    ('orders', 'shipDate', 'ship_date'),
+)
+
+
+# Migrations 2 and 11: rebuild the tables created by earlier versions of init_db() as
+# migration 1 defines them. Those used camelCase names for some columns and NOT NULL on
+# every column, which made inserts without an optional field fail. A rename alone kept
+# the constraints, so databases migrated that way are rebuilt again by migration 11.
+# Columns added by later migrations, and the table's indexes and triggers, are kept.
+def rebuild_legacy_tables(cursor):
+    # Other tables' triggers still name the table while it is dropped and renamed back
+    cursor.execute("PRAGMA legacy_alter_table = ON")
+    for table, definition in TABLE_DEFINITIONS.items():
+        columns = [item.split()[0] for item in definition if not item.startswith('FOREIGN KEY')]
+        constraints = [item for item in definition if item.startswith('FOREIGN KEY')]
+        renamed = {new: old for name, old, new in LEGACY_COLUMNS if name == table}
+        existing = {row[1]: row for row in cursor.execute(f"PRAGMA table_info({table})")}
+        # table_info rows: (cid, name, type, notnull, default, pk)
+        if not any(old in existing for old in renamed.values()) and \
+                not any(existing[column][3] and not existing[column][5] for column in columns if column in existing):
+            continue
+        extra = [row for name, row in existing.items() if name not in columns and name not in renamed.values()]
+        declarations = [f"{name} {kind}" + (" NOT NULL" if notnull else "") +
+                        (f" DEFAULT {default}" if default is not None else "")
+                        for _, name, kind, notnull, default, _ in extra]
+        sources = [renamed[column] if renamed.get(column) in existing else column if column in existing else 'NULL'
+                   for column in columns] + [row[1] for row in extra]
+        deferred = [sql for sql, in cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL",
+            (table,))]
+        definitions = list(definition[:len(columns)]) + declarations + constraints
+        cursor.execute(f"CREATE TABLE {table}_rebuilt ({', '.join(definitions)})")
+        cursor.execute(f"INSERT INTO {table}_rebuilt ({', '.join(columns + [row[1] for row in extra])}) "
+                       f"SELECT {', '.join(sources)} FROM {table}")
+        cursor.execute(f"DROP TABLE {table}")
+        cursor.execute(f"ALTER TABLE {table}_rebuilt RENAME TO {table}")
+        for sql in deferred:
+            cursor.execute(sql)
+    cursor.execute("PRAGMA legacy_alter_table = OFF")
+
 
-        # Create pets table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS pets (
-                id INTEGER PRIMARY KEY,
-                name TEXT NOT NULL,
-                category_id INTEGER NOT NULL,
-                status TEXT NOT NULL,
-                photoUrls TEXT NOT NULL,
-                tags TEXT,
-                FOREIGN KEY (category_id) REFERENCES categories (id)
+# Migration 3: secondary indexes for the filtered and joined access paths
+def create_indexes(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pets_category_id ON pets (category_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pets_status ON pets (status)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_pet_id ON orders (pet_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status)")
+
+
+# Pets keep their tags and photo_urls as comma-separated text, which is what the API
+# accepts and returns. The pet_tags and pet_photos tables hold the same data normalized
+# so tag lookups use an index instead of scanning and splitting every pets row; the
+# handlers below keep both representations in step inside the same transaction.
+
+# Function to split a comma-separated tags or photo_urls value into its items
+def split_list(value):
+    if not value:
+        return []
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+# Function to map tag names to tag ids, creating the tags that do not exist yet unless create=False
+def tag_ids_for(db, names, create=True):
+    names = list(dict.fromkeys(names))
+    ids = {}
+    for start in range(0, len(names), 500):
+        chunk = names[start:start + 500]
+        placeholders = ', '.join('?' * len(chunk))
+        query = f"SELECT name, MIN(id) FROM tags WHERE name IN ({placeholders}) GROUP BY name"
+        ids.update(db.execute(query, chunk).fetchall())
+    for name in names:
+        if name not in ids and create:
+            ids[name] = db.execute("INSERT INTO tags (name) VALUES (?)", (name,)).lastrowid
+    return ids
+
+
+# Function like tag_ids_for() for pet writes on a shard, whose tags are in the catalog.
+# Existing tags are looked up without locking it; missing ones are created under its
+# write lock, so two shards cannot both create a tag, and committed before use.
+def catalog_tag_ids(catalog, names):
+    ids = tag_ids_for(catalog, names, create=False)
+    if len(ids) == len(set(names)):
+        return ids
+    catalog.execute("BEGIN IMMEDIATE")
+    try:
+        ids = tag_ids_for(catalog, names)
+    except BaseException:
+        catalog.rollback()
+        raise
+    catalog.commit()
+    return ids
+
+
+# Function to drop the tag and photo links of the given pets
+def delete_pet_links(db, pet_ids):
+    rows = [(pet_id,) for pet_id in pet_ids]
+    db.executemany("DELETE FROM pet_tags WHERE pet_id = ?", rows)
+    db.executemany("DELETE FROM pet_photos WHERE pet_id = ?", rows)
+
+
+# Function to rewrite the links of pets from their text columns: pets is [(id, tags, photo_urls)]
+def sync_pet_links(db, pets):
+    if not pets:
+        return
+    delete_pet_links(db, [pet_id for pet_id, _, _ in pets])
+    names = [(pet_id, split_list(tags)) for pet_id, tags, _ in pets]
+    wanted = [name for _, pet_names in names for name in pet_names]
+    catalog = catalog_for(db)
+    tag_ids = tag_ids_for(db, wanted) if catalog is db else catalog_tag_ids(catalog, wanted)
+    db.executemany("INSERT OR IGNORE INTO pet_tags (pet_id, tag_id, position) VALUES (?, ?, ?)",
+                   [(pet_id, tag_ids[name], position) for pet_id, pet_names in names
+                    for position, name in enumerate(pet_names)])
+    db.executemany("INSERT INTO pet_photos (pet_id, position, url) VALUES (?, ?, ?)",
+                   [(pet_id, position, url) for pet_id, _, photo_urls in pets
+                    for position, url in enumerate(split_list(photo_urls))])
+
+
+# Function to rebuild pets.tags for the pets linked to a tag that is being renamed or
+# deleted (remove=True also unlinks it); returns the ids of the pets that changed
+def refresh_pet_tags(db, tag_id, remove=False):
+    pet_ids = [row[0] for row in db.execute("SELECT pet_id FROM pet_tags WHERE tag_id = ?", (tag_id,))]
+    if remove:
+        db.execute("DELETE FROM pet_tags WHERE tag_id = ?", (tag_id,))
+    db.executemany('''
+        UPDATE pets SET tags = COALESCE((
+            SELECT group_concat(name, ', ') FROM (
+                SELECT t.name FROM pet_tags pt JOIN tags t ON t.id = pt.tag_id
+                WHERE pt.pet_id = pets.id ORDER BY pt.position
             )
+        ), '')
+        WHERE id = ?
+    ''', [(pet_id,) for pet_id in pet_ids])
+    return pet_ids
+
+
+# Migration 4: normalized pet_tags and pet_photos tables, backfilled from the text columns
+def create_pet_links(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pet_tags (
+            pet_id INTEGER NOT NULL REFERENCES pets (id) ON DELETE CASCADE,
+            tag_id INTEGER NOT NULL REFERENCES tags (id) ON DELETE CASCADE,
+            position INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (pet_id, tag_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pet_photos (
+            id INTEGER PRIMARY KEY,
+            pet_id INTEGER NOT NULL REFERENCES pets (id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            url TEXT NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pet_tags_tag_id ON pet_tags (tag_id, pet_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pet_photos_pet_id ON pet_photos (pet_id, position)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tags_name ON tags (name)")
+    rows = cursor.execute("SELECT id, tags, photo_urls FROM pets").fetchall()
+    for start in range(0, len(rows), 10000):
+        sync_pet_links(cursor, rows[start:start + 10000])
+
+
+# Full-text search: one external-content FTS5 table per searchable collection, named
+# <table>_fts, indexing these columns with these bm25 weights. Triggers keep each index
+# in step with its table, so every write path (single, bulk, tag rename) is covered.
+SEARCH_INDEXES = {
+    'pets': (('name', 10.0), ('tags', 2.0), ('status', 1.0)),
+    'users': (('username', 10.0), ('email', 5.0)),
+    'categories': (('name', 10.0),),
+}
+
+
+# Function to create a table's FTS5 index and its sync triggers
+def create_search_index(cursor, table):
+    columns = [column for column, _ in SEARCH_INDEXES[table]]
+    names = ', '.join(columns)
+    new_values = ', '.join(f"new.{column}" for column in columns)
+    old_values = ', '.join(f"old.{column}" for column in columns)
+    # prefix='2 3' stores short prefixes so prefix queries don't scan the whole term list
+    cursor.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(
+            {names}, content='{table}', content_rowid='id', prefix='2 3'
+        )
+    ''')
+    weights = ', '.join(str(weight) for _, weight in SEARCH_INDEXES[table])
+    cursor.execute(f"INSERT INTO {table}_fts ({table}_fts, rank) VALUES ('rank', 'bm25({weights})')")
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {table}_fts (rowid, {names}) VALUES (new.id, {new_values});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {table}_fts ({table}_fts, rowid, {names}) VALUES ('delete', old.id, {old_values});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE OF id, {names} ON {table} BEGIN
+            INSERT INTO {table}_fts ({table}_fts, rowid, {names}) VALUES ('delete', old.id, {old_values});
+            INSERT INTO {table}_fts (rowid, {names}) VALUES (new.id, {new_values});
+        END
+    ''')
+
+
+# Function to rebuild every full-text index from its content table
+def rebuild_search_indexes(cursor):
+    for table in SEARCH_INDEXES:
+        cursor.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
+        cursor.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('optimize')")
+
+
+# Migration 5: full-text indexes over pets, users and categories, built from existing rows
+def create_search_indexes(cursor):
+    for table in SEARCH_INDEXES:
+        create_search_index(cursor, table)
+    rebuild_search_indexes(cursor)
+
+
+# Tables whose rows are versioned, with the columns a write to them changes
+VERSIONED_TABLES = {
+    'users': User.__slots__,
+    'pets': Pet.__slots__,
+    'orders': Order.__slots__,
+    'categories': Category.__slots__,
+    'tags': Tag.__slots__,
+}
+
+
+# Migration 6: row version/updated_at columns and per-table change counters. Triggers
+# fill updated_at on insert, bump the version of updates that did not bump it
+# themselves (bulk writes, tag renames), and count every change per table.
+def add_row_versions(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    for table, columns in VERSIONED_TABLES.items():
+        existing = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+        if 'version' not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+        if 'updated_at' not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN updated_at REAL")
+        cursor.execute(f"UPDATE {table} SET updated_at = {SQL_NOW} WHERE updated_at IS NULL")
+        cursor.execute("INSERT OR IGNORE INTO table_versions (name) VALUES (?)", (table,))
+        names = ', '.join(columns)
+        count = f"UPDATE table_versions SET version = version + 1 WHERE name = '{table}';"
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_version_insert AFTER INSERT ON {table} BEGIN
+                UPDATE {table} SET updated_at = {SQL_NOW} WHERE id = new.id AND new.updated_at IS NULL;
+                {count}
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_version_update AFTER UPDATE OF {names} ON {table} BEGIN
+                UPDATE {table} SET version = old.version + 1, updated_at = {SQL_NOW}
+                WHERE id = new.id AND new.version = old.version;
+                {count}
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_version_delete AFTER DELETE ON {table} BEGIN
+                {count}
+            END
         ''')
 
-        # Create orders table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS orders (
-                id INTEGER PRIMARY KEY,
-                pet_id INTEGER NOT NULL,
-                quantity INTEGER NOT NULL,
-                shipDate TEXT NOT NULL,
-                status TEXT NOT NULL,
-                complete BOOLEAN NOT NULL,
-                FOREIGN KEY (pet_id) REFERENCES pets (id)
-            )
+
+# Summary tables behind /store/inventory and /orders/stats. Triggers apply every pets
+# and orders write to them in the same transaction, so reads never aggregate the base
+# tables. Each entry maps a summary table to the full recount it must always equal.
+SUMMARY_TABLES = {
+    'pet_status_counts': '''
+        SELECT status, COUNT(*) FROM pets WHERE status IS NOT NULL GROUP BY status
+    ''',
+    'order_status_counts': '''
+        SELECT status, COUNT(*), COALESCE(SUM(quantity), 0) FROM orders
+        WHERE status IS NOT NULL GROUP BY status
+    ''',
+    'order_daily_stats': '''
+        SELECT date(ship_date) AS day, COUNT(*), COALESCE(SUM(quantity), 0) FROM orders
+        WHERE day IS NOT NULL GROUP BY day
+    ''',
+}
+
+
+# Function to compare the summary tables with a full recount; returns
+# {summary table: [(key, stored values, recounted values)]} for every difference
+def verify_summaries(cursor):
+    differences = {}
+    for table, recount in SUMMARY_TABLES.items():
+        # Rows whose counts dropped to zero are kept but are not part of the recount
+        stored = {row[0]: row[1:] for row in cursor.execute(f"SELECT * FROM {table}") if any(row[1:])}
+        expected = {row[0]: row[1:] for row in cursor.execute(recount)}
+        mismatched = [(key, stored.get(key), expected.get(key)) for key in sorted(stored.keys() | expected.keys())
+                      if stored.get(key) != expected.get(key)]
+        if mismatched:
+            differences[table] = mismatched
+    return differences
+
+
+# Function to replace the contents of every summary table with a full recount
+def rebuild_summaries(cursor):
+    for table, recount in SUMMARY_TABLES.items():
+        cursor.execute(f"DELETE FROM {table}")
+        cursor.execute(f"INSERT INTO {table} {recount}")
+
+
+# Migration 7: summary tables for inventory and order statistics, and their triggers
+def create_summaries(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pet_status_counts (
+            status TEXT PRIMARY KEY,
+            count INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS order_status_counts (
+            status TEXT PRIMARY KEY,
+            orders INTEGER NOT NULL,
+            quantity INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS order_daily_stats (
+            day TEXT PRIMARY KEY,
+            orders INTEGER NOT NULL,
+            quantity INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+    # Statements adding (sign 1) or removing (sign -1) one pets row; `row` is new or old
+    def pet_change(row, sign):
+        return f'''
+            INSERT INTO pet_status_counts (status, count) SELECT {row}.status, {sign}
+            WHERE {row}.status IS NOT NULL
+            ON CONFLICT (status) DO UPDATE SET count = count + {sign};
+        '''
+
+    # The same for one orders row, which counts towards its status and its ship day
+    def order_change(row, sign):
+        quantity = f"{sign} * COALESCE({row}.quantity, 0)"
+        return f'''
+            INSERT INTO order_status_counts (status, orders, quantity) SELECT {row}.status, {sign}, {quantity}
+            WHERE {row}.status IS NOT NULL
+            ON CONFLICT (status) DO UPDATE SET orders = orders + {sign}, quantity = quantity + {quantity};
+            INSERT INTO order_daily_stats (day, orders, quantity) SELECT date({row}.ship_date), {sign}, {quantity}
+            WHERE date({row}.ship_date) IS NOT NULL
+            ON CONFLICT (day) DO UPDATE SET orders = orders + {sign}, quantity = quantity + {quantity};
+        '''
+
+    for table, change, columns in (('pets', pet_change, 'status'),
+                                   ('orders', order_change, 'status, quantity, ship_date')):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_summary_insert AFTER INSERT ON {table} BEGIN
+                {change('new', 1)}
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_summary_delete AFTER DELETE ON {table} BEGIN
+                {change('old', -1)}
+            END
         ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_summary_update AFTER UPDATE OF {columns} ON {table} BEGIN
+                {change('old', -1)}
+                {change('new', 1)}
+            END
+        ''')
+    rebuild_summaries(cursor)
 
-        # Create categories table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS categories (
-                id INTEGER PRIMARY KEY,
-                name TEXT NOT NULL
-            )
+
+# Migration 8: append-only change log written by triggers on every versioned table.
+# AUTOINCREMENT keeps sequence numbers from being reused once old entries are removed.
+# changes_retention records the highest seq that retention may have deleted.
+def create_change_log(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            entity_id INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            data TEXT,
+            changed_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_changes_entity ON changes (table_name, entity_id, seq)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS changes_retention (truncated_seq INTEGER NOT NULL)")
+    if cursor.execute("SELECT COUNT(*) FROM changes_retention").fetchone()[0] == 0:
+        cursor.execute("INSERT INTO changes_retention (truncated_seq) VALUES (0)")
+    for table, columns in VERSIONED_TABLES.items():
+        names = ', '.join(columns)
+        new_data = 'json_object(' + ', '.join(f"'{column}', new.{column}" for column in columns) + ')'
+        log = "INSERT INTO changes (table_name, entity_id, op, data, changed_at) VALUES"
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_changes_insert AFTER INSERT ON {table} BEGIN
+                {log} ('{table}', new.id, 'insert', {new_data}, {SQL_NOW});
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_changes_update AFTER UPDATE OF {names} ON {table} BEGIN
+                {log} ('{table}', new.id, 'update', {new_data}, {SQL_NOW});
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_changes_delete AFTER DELETE ON {table} BEGIN
+                {log} ('{table}', old.id, 'delete', NULL, {SQL_NOW});
+            END
         ''')
 
-        # Create tags table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS tags (
-                id INTEGER PRIMARY KEY,
-                name TEXT NOT NULL
-            )
+
+# Migration 9: the counters of the id allocator used when pets and orders are sharded
+def create_id_allocations(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS id_allocations (
+            name TEXT NOT NULL,
+            shard INTEGER NOT NULL,
+            next_slot INTEGER NOT NULL,
+            PRIMARY KEY (name, shard)
+        ) WITHOUT ROWID
+    ''')
+
+
+# Migration 10: a new row's version starts at its table's change counter instead of 1.
+# Ids can be reused once the highest row is deleted, and the counter has passed every
+# version the earlier row with that id ever had, so its ETags never match the new row.
+def start_versions_at_counter(cursor):
+    for table in VERSIONED_TABLES:
+        cursor.execute(f"DROP TRIGGER IF EXISTS {table}_version_insert")
+        cursor.execute(f'''
+            CREATE TRIGGER {table}_version_insert AFTER INSERT ON {table} BEGIN
+                UPDATE table_versions SET version = version + 1 WHERE name = '{table}';
+                UPDATE {table} SET version = (SELECT version FROM table_versions WHERE name = '{table}'),
+                    updated_at = COALESCE(new.updated_at, {SQL_NOW})
+                WHERE id = new.id;
+            END
         ''')
 
-        get_db().commit()
+
+# Migration 12: the log of tag renames for the shards, and how far a shard has applied it
+def create_tag_renames(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tag_renames (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            tag_id INTEGER NOT NULL,
+            old_name TEXT NOT NULL,
+            new_name TEXT
+        )
+    ''')
+    cursor.execute("CREATE TABLE IF NOT EXISTS tag_renames_applied (seq INTEGER NOT NULL)")
+    if cursor.execute("SELECT COUNT(*) FROM tag_renames_applied").fetchone()[0] == 0:
+        cursor.execute("INSERT INTO tag_renames_applied (seq) VALUES (0)")
+
+
+# Schema migrations in order: (version, description, function)
+MIGRATIONS = [
+    (1, 'create tables', create_tables),
+    (2, 'rebuild legacy tables', rebuild_legacy_tables),
+    (3, 'add secondary indexes', create_indexes),
+    (4, 'normalize pet tags and photos', create_pet_links),
+    (5, 'add full-text search', create_search_indexes),
+    (6, 'add row versions and change counters', add_row_versions),
+    (7, 'add inventory and order summaries', create_summaries),
+    (8, 'add change log', create_change_log),
+    (9, 'add id allocator', create_id_allocations),
+    (10, 'start row versions at the change counter', start_versions_at_counter),
+    (11, 'rebuild tables left with legacy NOT NULL columns', rebuild_legacy_tables),
+    (12, 'add tag rename log', create_tag_renames),
+]
+
+
+# Function to read the schema version recorded in the database
+def get_schema_version(db):
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    return db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+# Function to apply pending migrations, each in its own transaction; returns versions applied
+def migrate(db):
+    applied = []
+    for version, description, migration in MIGRATIONS:
+        if version <= get_schema_version(db):
+            continue
+        with transaction():
+            # Re-check under the write lock in case another process migrated first
+            if version <= get_schema_version(db):
+                continue
+            migration(db.cursor())
+            db.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                       (version, description))
+        applied.append(version)
+    if applied:
+        db.execute("ANALYZE")
+    return applied
+
+
+# Function to start the id allocator of every sharded table and shard past the highest
+# id stored anywhere. The data can only be read with the shard count it was split with.
+def init_id_allocations():
+    conn = connect_db(DATABASE)
+    try:
+        split = conn.execute("SELECT COUNT(DISTINCT shard) FROM id_allocations").fetchone()[0]
+        if split not in (0, SHARD_COUNT):
+            raise RuntimeError(f"The data is split across {split} shards but PETSTORE_SHARDS is {SHARD_COUNT}")
+        for table in SHARDED_TABLES:
+            highest = 0
+            for database in DATABASES:
+                source = connect_db(database, READ_PRAGMAS)
+                try:
+                    highest = max(highest, source.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0])
+                finally:
+                    source.close()
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO id_allocations (name, shard, next_slot) VALUES (?, ?, ?)",
+                                 [(table, shard, highest // SHARD_COUNT + 1) for shard in range(SHARD_COUNT)])
+    finally:
+        conn.close()
+
+
+# Function to bring the database schema up to date, in the main database and every shard
+def init_db():
+    for database in DATABASES:
+        # Migrations use their own writable connection; pooled connections may be read-only
+        conn = connect_db(database)
+        try:
+            with app.app_context(), use_connection(conn):
+                migrate(conn)
+        finally:
+            conn.close()
+    if SHARD_COUNT:
+        init_id_allocations()
 
 
-# Function to close database connection
+# Function to return the database connection to the pool
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        g.pop('_database_pool', db_pool).release(db)
+
+
+# Schema setup is lazy, so importing the module never touches the database: the first
+# request of a process (or warm_up() in a pre-fork master, whose workers inherit the
+# result) brings the schema up to date. With PETSTORE_AUTO_MIGRATE=0 it is only checked,
+# and `flask init-db` migrates once per deployment instead.
+AUTO_MIGRATE = os.environ.get('PETSTORE_AUTO_MIGRATE', '1') == '1'
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+
+# Function to fail unless every database is at the latest schema version, without writing to it
+def check_schema():
+    latest = MIGRATIONS[-1][0]
+    for database in DATABASES:
+        if not os.path.exists(database):
+            raise RuntimeError(f"{database} does not exist; run `flask init-db`")
+        conn = connect_db(database, READ_PRAGMAS)
+        try:
+            version = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+        except sqlite3.OperationalError:
+            version = 0
+        finally:
+            conn.close()
+        if version < latest:
+            raise RuntimeError(f"{database} is at schema version {version}, expected {latest}; run `flask init-db`")
+
+
+# Function to refuse serving sharded while the main database still holds pets or orders,
+# which the sharded routes would silently leave out; `flask shard-data` moves them
+def check_unsharded_rows():
+    conn = connect_db(DATABASE, READ_PRAGMAS)
+    try:
+        tables = [table for table in SHARDED_TABLES
+                  if conn.execute(f"SELECT EXISTS (SELECT 1 FROM {table})").fetchone()[0]]
+    finally:
+        conn.close()
+    if tables:
+        raise RuntimeError(f"{DATABASE} still holds {' and '.join(tables)} while PETSTORE_SHARDS is {SHARD_COUNT}; "
+                           "run `flask shard-data` first")
+
+
+# Function to set up or check the schema once per process
+def ensure_db():
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        start = time.perf_counter()
+        if AUTO_MIGRATE:
+            init_db()
+        else:
+            check_schema()
+        if SHARD_COUNT:
+            check_unsharded_rows()
+        startup_times['schema'] = time.perf_counter() - start
+        _schema_ready = True
+
+
+@app.before_request
+def prepare_database():
+    ensure_db()
+
+
+# Page size limits for collection endpoints
+DEFAULT_PAGE_LIMIT = int(os.environ.get('PETSTORE_DEFAULT_PAGE_LIMIT', 100))
+MAX_PAGE_LIMIT = int(os.environ.get('PETSTORE_MAX_PAGE_LIMIT', 1000))
+
+# Rows fetched from the cursor per batch when streaming a collection
+STREAM_BATCH_SIZE = int(os.environ.get('PETSTORE_STREAM_BATCH_SIZE', 500))
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# Columns of each collection, the columns that may be filtered on, and the
+# writable columns as (column, request field, default on create)
+COLLECTIONS = {
+    'users': {
+        'columns': User.__slots__,
+        'filters': ('username', 'email', 'user_status'),
+        'writable': (
+            ('username', 'username', None),
+            ('email', 'email', None),
+            ('phone', 'phone', None),
+            ('address', 'address', None),
+            ('user_status', 'user_status', None),
+        ),
+    },
+    'pets': {
+        'columns': Pet.__slots__,
+        'filters': ('name', 'category_id', 'status'),
+        # Filters answered from another table: argument name -> WHERE clause
+        'relations': {
+            'tag': "id IN (SELECT pt.pet_id FROM pet_tags pt JOIN tags t ON t.id = pt.tag_id WHERE t.name = ?)",
+        },
+        'writable': (
+            ('name', 'name', None),
+            ('category_id', 'category_id', None),
+            ('photo_urls', 'photo_urls', ''),
+            ('tags', 'tags', ''),
+            ('status', 'status', None),
+        ),
+    },
+    'orders': {
+        'columns': Order.__slots__,
+        'filters': ('pet_id', 'quantity', 'ship_date', 'status', 'complete'),
+        'writable': (
+            ('pet_id', 'pet_id', None),
+            ('quantity', 'quantity', None),
+            ('ship_date', 'shipDate', None),
+            ('status', 'status', None),
+            ('complete', 'complete', False),
+        ),
+    },
+    'categories': {
+        'columns': Category.__slots__,
+        'filters': ('name',),
+        'writable': (('name', 'name', None),),
+    },
+    'tags': {
+        'columns': Tag.__slots__,
+        'filters': ('name',),
+        'writable': (('name', 'name', None),),
+    },
+}
+
+# Range filters are written as <column>_<op>, e.g. ?quantity_gte=2
+RANGE_OPERATORS = {'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<='}
+
+# Query arguments that control paging rather than filtering
+PAGING_ARGS = ('after_id', 'limit', 'fields', 'stream')
+
+
+class QueryError(ValueError):
+    pass
+
+
+# Function to parse a non-negative integer query argument
+def int_arg(name, default):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise QueryError(f"{name} must be an integer")
+    if value < 0:
+        raise QueryError(f"{name} must not be negative")
+    return value
+
+
+# Function to turn the fields argument into a column list for the SELECT
+def parse_fields(table):
+    columns = COLLECTIONS[table]['columns']
+    fields = request.args.get('fields')
+    if not fields:
+        return columns
+    selected = ['id']
+    for field in fields.split(','):
+        field = field.strip()
+        if field not in columns:
+            raise QueryError(f"Unknown field: {field}")
+        if field not in selected:
+            selected.append(field)
+    return tuple(selected)
+
+
+# Function to turn filter arguments into a parameterized WHERE clause; `consumed`
+# names arguments the route has already handled itself
+def parse_filters(table, consumed=()):
+    filters = COLLECTIONS[table]['filters']
+    relations = COLLECTIONS[table].get('relations', {})
+    clauses, args = [], []
+    for name, value in request.args.items(multi=True):
+        if name in PAGING_ARGS or name in consumed:
+            continue
+        if name in filters:
+            clauses.append(f"{name} = ?")
+        elif name in relations:
+            clauses.append(relations[name])
+        else:
+            column, _, op = name.rpartition('_')
+            if column not in filters or op not in RANGE_OPERATORS:
+                raise QueryError(f"Unknown filter: {name}")
+            clauses.append(f"{column} {RANGE_OPERATORS[op]} ?")
+        args.append(value)
+    return clauses, args
+
+
+# Function to build the SELECT for a collection: (columns, query, args).
+# `where` is an optional (clause, args) condition added by the route.
+def build_list_query(table, where=None, consumed=()):
+    columns = parse_fields(table)
+    clauses, args = parse_filters(table, consumed)
+    if where is not None:
+        clauses.append(where[0])
+        args.extend(where[1])
+    after_id = int_arg('after_id', None)
+    if after_id is not None:
+        clauses.append("id > ?")
+        args.append(after_id)
+    query = f"SELECT {', '.join(columns)} FROM {table}"
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += " ORDER BY id"
+    return columns, query, args
+
+
+# Function to fetch one keyset page of a collection: (columns, rows, next_after_id)
+def fetch_page(table, where=None, consumed=()):
+    columns, query, args = build_list_query(table, where, consumed)
+    limit = min(int_arg('limit', DEFAULT_PAGE_LIMIT), MAX_PAGE_LIMIT)
+    # Fetch one extra row to learn whether another page exists
+    rows = gather_ordered(table, query, args, limit + 1)
+    next_after_id = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_after_id = rows[-1][0] if rows else None
+    return columns, rows, next_after_id
+
+
+# Function to build the URL of the next page from the current request
+def next_page_url(next_after_id, cursor='after_id'):
+    args = request.args.to_dict(flat=False)
+    args[cursor] = [str(next_after_id)]
+    return f"{request.path}?{urlencode(args, doseq=True)}"
+
+
+# Function to tell whether the client asked for a streamed response: None, 'json' or 'ndjson'
+def stream_mode():
+    stream = request.args.get('stream', '').lower()
+    if stream == 'ndjson' or request.accept_mimetypes.best == NDJSON_MIMETYPE:
+        return 'ndjson'
+    if stream in ('1', 'true', 'json'):
+        return 'json'
+    return None
+
+
+# Generator to encode row batches as NDJSON lines or as one chunked JSON array
+def encode_rows(columns, batches, mode):
+    if mode == 'ndjson':
+        encode_row = row_encoder(columns)
+        for rows in batches:
+            yield ''.join([encode_row(row) + '\n' for row in rows])
+        return
+    encode_batch = rows_encoder(columns)
+    yield '['
+    separator = ''
+    for rows in batches:
+        # Strip the brackets so the batches join into one array
+        yield separator + encode_batch(rows)[1:-1]
+        separator = ','
+    yield ']'
+
+
+# Function to stream a whole collection with constant memory; limit is optional here
+def stream_collection(table, mode, etag, where=None, consumed=()):
+    columns, query, args = build_list_query(table, where, consumed)
+    limit = int_arg('limit', None)
+    if limit is not None:
+        query += " LIMIT ?"
+        args.append(limit)
+    batches = iter_ordered(table, query, args, STREAM_BATCH_SIZE, limit)
+    mimetype = NDJSON_MIMETYPE if mode == 'ndjson' else 'application/json'
+    response = Response(stream_with_context(encode_rows(columns, batches, mode)), mimetype=mimetype)
+    response.set_etag(etag)
+    return response
+
+
+# Function to respond with one page of a collection and a next-cursor link
+def list_collection(table, where=None, consumed=()):
+    etag = collection_etag(table)
+    if etag_matches(request.if_none_match, etag):
+        return not_modified_response(etag)
+    try:
+        mode = stream_mode()
+        if mode is not None:
+            return stream_collection(table, mode, etag, where, consumed)
+        columns, rows, next_after_id = fetch_page(table, where, consumed)
+    except QueryError as e:
+        return jsonify(message=str(e)), 400
+    timed = instrumentation.enabled
+    if timed:
+        start = time.perf_counter()
+    body = rows_encoder(columns)(rows)
+    if timed:
+        instrumentation.record_serialize(time.perf_counter() - start)
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    if next_after_id is not None:
+        response.headers['Link'] = f'<{next_page_url(next_after_id)}>; rel="next"'
+        response.headers['X-Next-Cursor'] = str(next_after_id)
+    return response
+
+
+# Request validation shared by the single-item and bulk handlers.
+# Each model has a declarative schema that compile_schema() turns into a validator once
+# at import time. A validator returns a list of {field, message} errors (empty if the
+# data is valid); partial=True validates an update where every field is optional.
+
+# Declarative rule for one request field
+class Field:
+    __slots__ = ('type', 'required', 'nullable', 'min_value', 'max_value', 'min_length', 'max_length',
+                 'pattern', 'message')
+
+    def __init__(self, type, required=False, nullable=False, min_value=None, max_value=None,
+                 min_length=None, max_length=None, pattern=None, message=None):
+        self.type = type
+        self.required = required
+        self.nullable = nullable
+        self.min_value = min_value
+        self.max_value = max_value
+        self.min_length = min_length
+        self.max_length = max_length
+        self.pattern = re.compile(pattern) if pattern else None
+        self.message = message
+
+
+# Function to build the Python condition that is true when a present, non-null value is valid
+def field_condition(name, field, namespace):
+    if field.type in (str, int, bool, float):
+        # Exact class checks: bool is a subclass of int but never a valid integer field
+        conditions = [f"value.__class__ is {field.type.__name__}"]
+    else:
+        namespace[f'type_{name}'] = field.type
+        conditions = [f"isinstance(value, type_{name})"]
+    if field.min_value is not None:
+        conditions.append(f"value >= {field.min_value!r}")
+    if field.max_value is not None:
+        conditions.append(f"value <= {field.max_value!r}")
+    if field.min_length is not None:
+        conditions.append(f"len(value) >= {field.min_length!r}")
+    if field.max_length is not None:
+        conditions.append(f"len(value) <= {field.max_length!r}")
+    if field.pattern is not None:
+        namespace[f'match_{name}'] = field.pattern.fullmatch
+        conditions.append(f"match_{name}(value) is not None")
+    return ' and '.join(conditions)
+
+
+# Function to compile a schema (field name -> Field) into a validator function.
+# The checks are generated as straight-line Python source and compiled once.
+def compile_schema(schema, name='validate'):
+    namespace = {}
+    lines = [
+        f"def {name}(data, partial=False):",
+        "    if not isinstance(data, dict):",
+        "        return [{'field': None, 'message': 'Request body must be a JSON object'}]",
+        "    errors = []",
+    ]
+    for field_name, field in schema.items():
+        message = field.message or f"Invalid {field_name}"
+        invalid = f"errors.append({{'field': {field_name!r}, 'message': {message!r}}})"
+        lines.append(f"    if {field_name!r} in data:")
+        lines.append(f"        value = data[{field_name!r}]")
+        lines.append("        if value is None:")
+        lines.append(f"            {'pass' if field.nullable else invalid}")
+        lines.append(f"        elif not ({field_condition(field_name, field, namespace)}):")
+        lines.append(f"            {invalid}")
+        if field.required:
+            missing = f"Missing required field: {field_name}"
+            lines.append("    elif not partial:")
+            lines.append(f"        errors.append({{'field': {field_name!r}, 'message': {missing!r}}})")
+    lines.append("    return errors")
+    exec(compile('\n'.join(lines), f'<schema {name}>', 'exec'), namespace)
+    return namespace[name]
+
+
+USER_SCHEMA = {
+    'username': Field(str, required=True, min_length=3, max_length=50,
+                      message="Username must be between 3 and 50 characters long."),
+    'email': Field(str, required=True, pattern=r'[^@]*@.*', message="Invalid email format"),
+    'phone': Field(str, required=True, pattern=r'[0-9]{10}',
+                   message="Invalid phone number format. Phone number must be 10 digits."),
+    'address': Field(str, nullable=True, max_length=100, message="Address must be less than 100 characters long."),
+    'user_status': Field(int, nullable=True, max_value=50, message="User status must be less than 50"),
+}
+
+PET_SCHEMA = {
+    'name': Field(str, required=True, message="Name must be a string"),
+    'category_id': Field(int, required=True, min_value=0, max_value=50, message="Category must be less than 50"),
+    'status': Field(str, required=True, max_length=50, message="Status must be less than 50 characters long"),
+    'photo_urls': Field(str, nullable=True, message="photo_urls must be a string"),
+    'tags': Field(str, nullable=True, message="tags must be a string"),
+}
+
+ORDER_SCHEMA = {
+    'pet_id': Field(int, required=True, min_value=0, message="Invalid pet_id format"),
+    'quantity': Field(int, required=True, min_value=1, message="Invalid quantity format"),
+    'status': Field(str, required=True, max_length=50, message="Status must be less than 50 characters long"),
+    'shipDate': Field(str, required=True, message="Invalid shipDate format"),
+    'complete': Field(bool, message="Invalid complete format"),
+}
+
+NAMED_SCHEMA = {
+    'name': Field(str, required=True, max_length=50, message="Name must be less than 50 characters long"),
+}
 
+validate_user = compile_schema(USER_SCHEMA, 'validate_user')
+validate_pet = compile_schema(PET_SCHEMA, 'validate_pet')
+validate_order = compile_schema(ORDER_SCHEMA, 'validate_order')
+validate_named = compile_schema(NAMED_SCHEMA, 'validate_named')
 
-# Initialize database when the application starts
-init_db()
 
+# Function to build the 400 response listing every validation error
+def validation_error(errors):
+    return jsonify(message=errors[0]['message'], errors=errors), 400
 
-# Function to execute SQL queries and return results
 
 # Define endpoints
 # /users
 @app.route('/users', methods=['GET'])
 def get_users():
-    query = "SELECT * FROM users"
-    users = execute_query(query)
-    user_objects = [User(*user) for user in users]
-    return jsonify([vars(user) for user in user_objects])
+    return list_collection('users')
 
 
 @app.route('/users/<int:user_id>', methods=['GET'])
 def get_user(user_id):
-    query = "SELECT * FROM users WHERE id = ?"
-    user = execute_query(query, (user_id,))
+    query = "SELECT id, username, email, phone, address, user_status, version, updated_at FROM users WHERE id = ?"
+    user = cached_query('users', user_id, query)
     if user:
-        return jsonify(vars(User(*user[0])))
+        return entity_response(User, user[0])
     return jsonify({"error": "User not found"}), 404
 
 
 @app.route('/users', methods=['POST'])
+@transactional
 def create_user():
     data = request.json
-    # Validate required fields
-    required_fields = ['username', 'email', 'phone']
-    for field in required_fields:
-        if field not in data:
-            return jsonify(message=f"Missing required field: {field}"), 400
-    # Validate email format
-    if '@' not in data['email']:
-        return jsonify(message="Invalid email format"), 400
-    # Validate phone number format (e.g., 10 digits)
-    if len(data['phone']) != 10 or not data['phone'].isdigit():
-        return jsonify(message="Invalid phone number format. Phone number must be 10 digits."), 400
-    # Validate username length (e.g., between 3 and 50 characters)
-    if len(data['username']) < 3 or len(data['username']) > 50:
-        return jsonify(message="Username must be between 3 and 50 characters long."), 400
-    # Validate address length (optional, limit to 100 characters)
-    if 'address' in data and len(data['address']) > 100:
-        return jsonify(message="Address must be less than 100 characters long."), 400
-    # Validate user_status length (optional, limit to 50 characters)
-    if 'user_status' in data and data['user_status'] > 50:
-        return jsonify(message="User status must be less than 50"), 400
+    errors = validate_user(data)
+    if errors:
+        return validation_error(errors)
     # Insert user into database
     query = "INSERT INTO users (username, email, phone, address, user_status) VALUES (?, ?, ?, ?, ?)"
     args = (data['username'], data['email'], data['phone'], data.get('address'), data.get('user_status'))
@@ -191,36 +2531,25 @@ def create_user():
 
 
 @app.route('/users/<int:user_id>', methods=['PUT'])
+@transactional
 def update_user(user_id):
     data = request.json
     # Check if user exists
-    query = "SELECT * FROM users WHERE id = ?"
-    user = execute_query(query, (user_id,))
+    query = "SELECT id, username, email, phone, address, user_status, version FROM users WHERE id = ?"
+    user = query_db(query, (user_id,))
     if not user:
         return jsonify(message="User not found"), 404
+    version = user[0][-1]
+    if not if_match(version):
+        return jsonify(message="User has been modified"), 412
 
-    # Validate email format if provided
-    if 'email' in data and '@' not in data['email']:
-        return jsonify(message="Invalid email format"), 400
-
-    # Validate phone number format if provided
-    if 'phone' in data and (len(data['phone']) != 10 or not data['phone'].isdigit()):
-        return jsonify(message="Invalid phone number format. Phone number must be 10 digits."), 400
-
-    # Validate username length if provided
-    if 'username' in data and (len(data['username']) < 3 or len(data['username']) > 50):
-        return jsonify(message="Username must be between 3 and 50 characters long."), 400
-
-    # Validate address length if provided
-    if 'address' in data and len(data['address']) > 100:
-        return jsonify(message="Address must be less than 100 characters long."), 400
-
-    # Validate user_status length if provided
-    if 'user_status' in data and data['user_status'] > 50:
-        return jsonify(message="User status must be less than 50"), 400
+    errors = validate_user(data, partial=True)
+    if errors:
+        return validation_error(errors)
 
     # Update user in database
-    query = "UPDATE users SET username = ?, email = ?, phone = ?, address = ?, user_status = ? WHERE id = ?"
+    query = (f"UPDATE users SET username = ?, email = ?, phone = ?, address = ?, user_status = ?, "
+             f"version = version + 1, updated_at = {SQL_NOW} WHERE id = ?")
     args = (
         data.get('username', user[0][1]),  # Use existing username if not provided in request
         data.get('email', user[0][2]),  # Use existing email if not provided in request
@@ -230,61 +2559,75 @@ def update_user(user_id):
         user_id
     )
     execute_query(query, args)
-    return jsonify({"message": "User updated successfully"})
+    invalidate_entity('users', user_id)
+    response = jsonify({"message": "User updated successfully"})
+    response.set_etag(entity_etag(version + 1))
+    return response
 
 
 @app.route('/users/<int:user_id>', methods=['DELETE'])
+@transactional
 def delete_user(user_id):
     # Check if user exists
-    query = "SELECT * FROM users WHERE id = ?"
-    user = execute_query(query, (user_id,))
+    query = "SELECT id, username, email, phone, address, user_status FROM users WHERE id = ?"
+    user = query_db(query, (user_id,))
     if not user:
         return jsonify(message="User not found"), 404
 
     # Delete user from database
     query = "DELETE FROM users WHERE id = ?"
     execute_query(query, (user_id,))
+    invalidate_entity('users', user_id)
     return jsonify({"message": "User deleted successfully"}), 204
 
 
 # /pets
 @app.route('/pets', methods=['GET'])
 def get_pets():
-    query = "SELECT * FROM pets"
-    pets = execute_query(query)
-    pet_objects = [Pet(*pet) for pet in pets]
-    return jsonify([vars(pet) for pet in pet_objects])
+    return list_collection('pets')
+
+
+# Function to read a list argument given as comma-separated values and/or repeated
+def list_arg(name):
+    return [item for value in request.args.getlist(name) for item in split_list(value)]
+
+
+@app.route('/pets/findByTags', methods=['GET'])
+def find_pets_by_tags():
+    # Pets having any of the tags, found through the pet_tags index
+    tags = list_arg('tags')
+    if not tags:
+        return jsonify(message="tags is required"), 400
+    placeholders = ', '.join('?' * len(tags))
+    clause = ("id IN (SELECT pt.pet_id FROM pet_tags pt JOIN tags t ON t.id = pt.tag_id "
+              f"WHERE t.name IN ({placeholders}))")
+    return list_collection('pets', where=(clause, tags), consumed=('tags',))
 
 
 @app.route('/pets/<int:pet_id>', methods=['GET'])
+@on_shard(lambda pet_id: shard_for(pet_id))
 def get_pet(pet_id):
     # Check if pet exists
-    query = "SELECT * FROM pets WHERE id = ?"
-    pet = execute_query(query, (pet_id,))
+    query = "SELECT id, name, category_id, photo_urls, tags, status, version, updated_at FROM pets WHERE id = ?"
+    pet = cached_query('pets', pet_id, query)
     if not pet:
         return jsonify(message="Pet not found"), 404
 
     # If pet exists, return its data
-    pet_data = pet[0]
-    pet_obj = Pet(*pet_data)
-    return jsonify(vars(pet_obj))
+    return entity_response(Pet, pet[0])
 
 
 @app.route('/pets', methods=['POST'])
+@on_shard(next_shard)
+@transactional
 def create_pet():
     data = request.json
-    # Validate required fields
-    if 'name' not in data or 'category_id' not in data or 'status' not in data:
-        return jsonify(message="Missing required fields: name, category, status"), 400
-    # Validate category length
-    if data['category_id'] > 50:
-        return jsonify(message="Category must be less than 50"), 400
-    # Validate status length
-    if len(data['status']) > 50:
-        return jsonify(message="Status must be less than 50 characters long"), 400
+    errors = validate_pet(data)
+    if errors:
+        return validation_error(errors)
 
     # Insert pet into database
-    query = "INSERT INTO pets (name, category_id, photo_urls, tags, status) VALUES (?, ?, ?, ?, ?)"
+    query = "INSERT INTO pets (id, name, category_id, photo_urls, tags, status) VALUES (?, ?, ?, ?, ?, ?) RETURNING id"
     args = (
         data['name'],
         data['category_id'],
@@ -292,30 +2635,32 @@ def create_pet():
         data.get('tags', ''),  # Allow tags to be optional
         data['status']
     )
-    execute_query(query, args)
+    pet_id = execute_query(query, (new_id('pets'),) + args)[0][0]
+    sync_pet_links(get_db(), [(pet_id, args[3], args[2])])
     return jsonify({"message": "Pet created successfully"}), 201
 
 
 @app.route('/pets/<int:pet_id>', methods=['PUT'])
+@on_shard(lambda pet_id: shard_for(pet_id))
+@transactional
 def update_pet(pet_id):
     data = request.json
     # Check if pet exists
-    query = "SELECT * FROM pets WHERE id = ?"
-    pet = execute_query(query, (pet_id,))
+    query = "SELECT id, name, category_id, photo_urls, tags, status, version FROM pets WHERE id = ?"
+    pet = query_db(query, (pet_id,))
     if not pet:
         return jsonify(message="Pet not found"), 404
+    version = pet[0][-1]
+    if not if_match(version):
+        return jsonify(message="Pet has been modified"), 412
 
-    # Validate category length if provided
-    if 'category' in data and data['category_id'] > 50:
-        return jsonify(message="Category must be less than 50"), 400
-    # Validate status length if provided
-    if 'status' in data and len(data['status']) > 50:
-        return jsonify(message="Status must be less than 50 characters long"), 400
-
-    # Other validations can be added as needed
+    errors = validate_pet(data, partial=True)
+    if errors:
+        return validation_error(errors)
 
     # Update pet in database
-    query = "UPDATE pets SET name = ?, category_id = ?, photo_urls = ?, tags = ?, status = ? WHERE id = ?"
+    query = (f"UPDATE pets SET name = ?, category_id = ?, photo_urls = ?, tags = ?, status = ?, "
+             f"version = version + 1, updated_at = {SQL_NOW} WHERE id = ?")
     args = (
         data.get('name', pet[0][1]),  # Use existing name if not provided in request
         data.get('category_id', pet[0][2]),  # Use existing category if not provided in request
@@ -325,109 +2670,96 @@ def update_pet(pet_id):
         pet_id
     )
     execute_query(query, args)
-    return jsonify({"message": "Pet updated successfully"})
+    if 'tags' in data or 'photo_urls' in data:
+        sync_pet_links(get_db(), [(pet_id, args[3], args[2])])
+    invalidate_entity('pets', pet_id)
+    response = jsonify({"message": "Pet updated successfully"})
+    response.set_etag(entity_etag(version + 1))
+    return response
 
 
 @app.route('/pets/<int:pet_id>', methods=['DELETE'])
+@on_shard(lambda pet_id: shard_for(pet_id))
+@transactional
 def delete_pet(pet_id):
     # Check if pet exists
-    query = "SELECT * FROM pets WHERE id = ?"
-    pet = execute_query(query, (pet_id,))
+    query = "SELECT id, name, category_id, photo_urls, tags, status FROM pets WHERE id = ?"
+    pet = query_db(query, (pet_id,))
     if not pet:
         return jsonify(message="Pet not found"), 404
 
     # Delete pet from database
     query = "DELETE FROM pets WHERE id = ?"
     execute_query(query, (pet_id,))
+    delete_pet_links(get_db(), [pet_id])
+    invalidate_entity('pets', pet_id)
     return jsonify({"message": "Pet deleted successfully"}), 204
 
 
 # /orders
 @app.route('/orders', methods=['GET'])
 def get_orders():
-    query = "SELECT * FROM orders"
-    orders = execute_query(query)
-    order_objects = [Order(*order) for order in orders]
-    return jsonify([vars(order) for order in order_objects])
+    return list_collection('orders')
 
 
 @app.route('/orders/<int:order_id>', methods=['GET'])
+@on_shard(lambda order_id: shard_for(order_id))
 def get_order(order_id):
     # Check if order exists
-    query = "SELECT * FROM orders WHERE id = ?"
-    order = execute_query(query, (order_id,))
+    query = "SELECT id, pet_id, quantity, ship_date, status, complete, version, updated_at FROM orders WHERE id = ?"
+    order = cached_query('orders', order_id, query)
     if not order:
         return jsonify(message="Order not found"), 404
 
     # If order exists, return its data
-    order_data = order[0]
-    order_obj = Order(*order_data)
-    return jsonify(vars(order_obj))
+    return entity_response(Order, order[0])
 
 
 @app.route('/orders', methods=['POST'])
+@on_shard(lambda: order_shard(request.get_json(silent=True)))
+@transactional
 def create_order():
     data = request.json
-    # Validate required fields
-    if 'pet_id' not in data or 'quantity' not in data or 'status' not in data or 'shipDate' not in data:
-        return jsonify(message="Missing required fields: pet_id, quantity, status, shipDate"), 400
-
-    # Validate pet_id format
-    if not isinstance(data['pet_id'], int) or data['pet_id'] < 0:
-        return jsonify(message="Invalid pet_id format"), 400
-    # Validate quantity format
-    if not isinstance(data['quantity'], int) or data['quantity'] <= 0:
-        return jsonify(message="Invalid quantity format"), 400
-
-    # Validate status length
-    if len(data['status']) > 50:
-        return jsonify(message="Status must be less than 50 characters long"), 400
-
-    # Other validations can be added as needed
-    if 'shipDate' not in data:
-        return jsonify(message="Ship date is required"), 400
+    errors = validate_order(data)
+    if errors:
+        return validation_error(errors)
 
     # Insert order into database
-    query = "INSERT INTO orders (pet_id, quantity, ship_date, status, complete) VALUES (?, ?, ?, ?, ?)"
+    query = "INSERT INTO orders (id, pet_id, quantity, ship_date, status, complete) VALUES (?, ?, ?, ?, ?, ?)"
     args = (
         data['pet_id'],
         data['quantity'],
         data['shipDate'],
         data['status'],
-        data['complete']
+        data.get('complete', False)
     )
-    execute_query(query, args)
+    execute_query(query, (new_id('orders'),) + args)
     return jsonify({"message": "Order created successfully"}), 201
 
 
 @app.route('/orders/<int:order_id>', methods=['PUT'])
+@on_shard(lambda order_id: shard_for(order_id))
+@transactional
 def update_order(order_id):
     data = request.json
     # Check if order exists
-    query = "SELECT * FROM orders WHERE id = ?"
-    order = execute_query(query, (order_id,))
+    query = "SELECT id, pet_id, quantity, ship_date, status, complete, version FROM orders WHERE id = ?"
+    order = query_db(query, (order_id,))
     if not order:
         return jsonify(message="Order not found"), 404
+    version = order[0][-1]
+    if not if_match(version):
+        return jsonify(message="Order has been modified"), 412
 
-    # Validate quantity format if provided
-    if 'quantity' in data:
-        if not isinstance(data['quantity'], int) or data['quantity'] <= 0:
-            return jsonify(message="Invalid quantity format"), 400
-    # Validate status length if provided
-    if 'status' in data and len(data['status']) > 50:
-        return jsonify(message="Status must be less than 50 characters long"), 400
-
-    # Validate ship_date format if provided
-    if 'shipDate' not in data:
-        return jsonify(message="Ship date is required"), 400
-
-    # Validate complete format if provided
-    if 'complete' in data:
-        if not isinstance(data['complete'], bool):
-            return jsonify(message="Invalid complete format"), 400
+    errors = validate_order(data, partial=True)
+    if errors:
+        return validation_error(errors)
+    if is_sharded('orders') and shard_for(data.get('pet_id', order[0][1])) != current_shard():
+        return jsonify(message="An order cannot be moved to a pet on another shard"), 400
 
     # Update order in database
-    query = "UPDATE orders SET pet_id = ?, quantity = ?, ship_date = ?, status = ?, complete = ? WHERE id = ?"
+    query = (f"UPDATE orders SET pet_id = ?, quantity = ?, ship_date = ?, status = ?, complete = ?, "
+             f"version = version + 1, updated_at = {SQL_NOW} WHERE id = ?")
     args = (
         data.get('pet_id', order[0][1]),  # Use existing pet_id if not provided in request
         data.get('quantity', order[0][2]),  # Use existing quantity if not provided in request
@@ -437,56 +2769,94 @@ def update_order(order_id):
         order_id
     )
     execute_query(query, args)
-    return jsonify({"message": "Order updated successfully"})
+    invalidate_entity('orders', order_id)
+    response = jsonify({"message": "Order updated successfully"})
+    response.set_etag(entity_etag(version + 1))
+    return response
 
 
 @app.route('/orders/<int:order_id>', methods=['DELETE'])
+@on_shard(lambda order_id: shard_for(order_id))
+@transactional
 def delete_order(order_id):
     # Check if order exists
-    query = "SELECT * FROM orders WHERE id = ?"
-    order = execute_query(query, (order_id,))
+    query = "SELECT id, pet_id, quantity, ship_date, status, complete FROM orders WHERE id = ?"
+    order = query_db(query, (order_id,))
     if not order:
         return jsonify(message="Order not found"), 404
 
     # Delete order from database
     query = "DELETE FROM orders WHERE id = ?"
     execute_query(query, (order_id,))
+    invalidate_entity('orders', order_id)
     return jsonify(message="Order deleted successfully"), 204
 
 
+# Function to add up summary rows (key, *counts) by key, e.g. from several shards; returns sorted (key, counts)
+def sum_counts(rows):
+    totals = {}
+    for key, *counts in rows:
+        previous = totals.get(key)
+        totals[key] = counts if previous is None else [a + b for a, b in zip(previous, counts)]
+    return sorted(totals.items())
+
+
+@app.route('/orders/stats', methods=['GET'])
+def get_order_stats():
+    # Read from the summary tables; ?from= and ?to= (YYYY-MM-DD) bound the daily series
+    etag = collection_etag('orders')
+    if etag_matches(request.if_none_match, etag):
+        return not_modified_response(etag)
+    query = "SELECT status, orders, quantity FROM order_status_counts WHERE orders != 0"
+    by_status = sum_counts(gather('orders', query))
+    query = "SELECT day, orders, quantity FROM order_daily_stats WHERE orders != 0 AND day >= ? AND day <= ?"
+    by_day = sum_counts(gather('orders', query, (request.args.get('from', ''), request.args.get('to', '9999'))))
+    response = jsonify(by_status={status: {"orders": orders, "quantity": quantity}
+                                  for status, (orders, quantity) in by_status},
+                       by_day=[{"day": day, "orders": orders, "quantity": quantity}
+                               for day, (orders, quantity) in by_day])
+    response.set_etag(etag)
+    return response
+
+
+# /store
+@app.route('/store/inventory', methods=['GET'])
+def get_inventory():
+    # Pet counts by status, read from the summary table
+    etag = collection_etag('pets')
+    if etag_matches(request.if_none_match, etag):
+        return not_modified_response(etag)
+    query = "SELECT status, count FROM pet_status_counts WHERE count != 0"
+    response = jsonify({status: count for status, (count,) in sum_counts(gather('pets', query))})
+    response.set_etag(etag)
+    return response
+
+
 # /categories
 @app.route('/categories', methods=['GET'])
 def get_categories():
-    query = "SELECT * FROM categories"
-    categories = execute_query(query)
-    category_objects = [Category(*category) for category in categories]
-    return jsonify([vars(category) for category in category_objects])
+    return list_collection('categories')
 
 
 @app.route('/categories/<int:category_id>', methods=['GET'])
 def get_category(category_id):
     # Check if category exists
-    query = "SELECT * FROM categories WHERE id = ?"
-    category = execute_query(query, (category_id,))
+    query = "SELECT id, name, version, updated_at FROM categories WHERE id = ?"
+    category = cached_query('categories', category_id, query)
     if not category:
         return jsonify(message="Category not found"), 404
 
     # If category exists, return its data
-    category_data = category[0]
-    category_obj = Category(*category_data)
-    return jsonify(vars(category_obj))
+    return entity_response(Category, category[0])
 
 
 @app.route('/categories', methods=['POST'])
+@transactional
 def create_category():
     data = request.json
-    # Validate required fields
-    if 'name' not in data:
-        return jsonify(message="Missing required field: name"), 400
-
-    # Validate name length
-    if len(data['name']) > 50:
-        return jsonify(message="Name must be less than 50 characters long"), 400
+    errors = validate_named(data)
+    if errors:
+        return validation_error(errors)
 
     # Insert category into database
     query = "INSERT INTO categories (name) VALUES (?)"
@@ -496,75 +2866,84 @@ def create_category():
 
 
 @app.route('/categories/<int:category_id>', methods=['PUT'])
+@transactional
 def update_category(category_id):
     data = request.json
     # Check if category exists
-    query = "SELECT * FROM categories WHERE id = ?"
-    category = execute_query(query, (category_id,))
+    query = "SELECT id, name, version FROM categories WHERE id = ?"
+    category = query_db(query, (category_id,))
     if not category:
         return jsonify(message="Category not found"), 404
+    version = category[0][-1]
+    if not if_match(version):
+        return jsonify(message="Category has been modified"), 412
 
-    # Validate name length if provided
-    if 'name' in data and len(data['name']) > 50:
-        return jsonify(message="Name must be less than 50 characters long"), 400
+    errors = validate_named(data, partial=True)
+    if errors:
+        return validation_error(errors)
 
     # Update category in database
-    query = "UPDATE categories SET name = ? WHERE id = ?"
+    query = f"UPDATE categories SET name = ?, version = version + 1, updated_at = {SQL_NOW} WHERE id = ?"
     args = (
         data.get('name', category[0][1]),  # Use existing name if not provided in request
         category_id
     )
     execute_query(query, args)
-    return jsonify({"message": "Category updated successfully"})
+    invalidate_entity('categories', category_id)
+    response = jsonify({"message": "Category updated successfully"})
+    response.set_etag(entity_etag(version + 1))
+    return response
 
 
 @app.route('/categories/<int:category_id>', methods=['DELETE'])
+@transactional
 def delete_category(category_id):
     # Check if category exists
-    query = "SELECT * FROM categories WHERE id = ?"
-    category = execute_query(query, (category_id,))
+    query = "SELECT id, name FROM categories WHERE id = ?"
+    category = query_db(query, (category_id,))
     if not category:
         return jsonify(message="Category not found"), 404
 
     # Delete category from database
     query = "DELETE FROM categories WHERE id = ?"
     execute_query(query, (category_id,))
+    invalidate_entity('categories', category_id)
     return jsonify({"message": "Category deleted successfully"}), 204
 
 
 # /orders
 @app.route('/tags', methods=['GET'])
 def get_tags():
-    query = "SELECT * FROM tags"
-    tags = execute_query(query)
-    tag_objects = [Tag(*tag) for tag in tags]
-    return jsonify([vars(tag) for tag in tag_objects])
+    return list_collection('tags')
 
 
 @app.route('/tags/<int:tag_id>', methods=['GET'])
 def get_tag(tag_id):
     # Check if tag exists
-    query = "SELECT * FROM tags WHERE id = ?"
-    tag = execute_query(query, (tag_id,))
+    query = "SELECT id, name, version, updated_at FROM tags WHERE id = ?"
+    tag = cached_query('tags', tag_id, query)
     if not tag:
         return jsonify(message="Tag not found"), 404
 
     # If tag exists, return its data
-    tag_data = tag[0]
-    tag_obj = Tag(*tag_data)
-    return jsonify(vars(tag_obj))
+    return entity_response(Tag, tag[0])
+
+
+@app.route('/tags/<int:tag_id>/pets', methods=['GET'])
+def get_tag_pets(tag_id):
+    if not cached_query('tags', tag_id, "SELECT id, name, version, updated_at FROM tags WHERE id = ?"):
+        return jsonify(message="Tag not found"), 404
+    clause = "id IN (SELECT pet_id FROM pet_tags WHERE tag_id = ?)"
+    return list_collection('pets', where=(clause, [tag_id]))
 
 
 @app.route('/tags', methods=['POST'])
+@transactional
 def create_tag():
     data = request.json
-    # Validate required field
-    if 'name' not in data:
-        return jsonify(message="Missing required field: name"), 400
-
-    # Validate name length
-    if len(data['name']) > 50:
-        return jsonify(message="Name must be less than 50 characters long"), 400
+    errors = validate_named(data)
+    if errors:
+        return validation_error(errors)
 
     # Insert tag into database
     query = "INSERT INTO tags (name) VALUES (?)"
@@ -574,54 +2953,1565 @@ def create_tag():
 
 
 @app.route('/tags/<int:tag_id>', methods=['PUT'])
+@transactional
 def update_tag(tag_id):
     data = request.json
     # Check if tag exists
-    query = "SELECT * FROM tags WHERE id = ?"
-    tag = execute_query(query, (tag_id,))
+    query = "SELECT id, name, version FROM tags WHERE id = ?"
+    tag = query_db(query, (tag_id,))
     if not tag:
         return jsonify(message="Tag not found"), 404
+    version = tag[0][-1]
+    if not if_match(version):
+        return jsonify(message="Tag has been modified"), 412
 
-    # Validate name length if provided
-    if 'name' in data and len(data['name']) > 50:
-        return jsonify(message="Name must be less than 50 characters long"), 400
+    errors = validate_named(data, partial=True)
+    if errors:
+        return validation_error(errors)
 
     # Update tag in database
-    query = "UPDATE tags SET name = ? WHERE id = ?"
+    query = f"UPDATE tags SET name = ?, version = version + 1, updated_at = {SQL_NOW} WHERE id = ?"
     args = (
         data.get('name', tag[0][1]),  # Use existing name if not provided in request
         tag_id
     )
     execute_query(query, args)
-    return jsonify({"message": "Tag updated successfully"})
+    # Pets carry their tag names as text; rewrite the ones that use this tag
+    for pet_id in refresh_pet_tags(get_db(), tag_id):
+        invalidate_entity('pets', pet_id)
+    if SHARD_COUNT:
+        execute_query("INSERT INTO tag_renames (tag_id, old_name, new_name) VALUES (?, ?, ?)",
+                      (tag_id, tag[0][1], args[0]))
+        after_commit(sync_shard_tags)
+    invalidate_entity('tags', tag_id)
+    response = jsonify({"message": "Tag updated successfully"})
+    response.set_etag(entity_etag(version + 1))
+    return response
 
 
 @app.route('/tags/<int:tag_id>', methods=['DELETE'])
+@transactional
 def delete_tag(tag_id):
     # Check if tag exists
-    query = "SELECT * FROM tags WHERE id = ?"
-    tag = execute_query(query, (tag_id,))
+    query = "SELECT id, name FROM tags WHERE id = ?"
+    tag = query_db(query, (tag_id,))
     if not tag:
         return jsonify(message="Tag not found"), 404
 
     # Delete tag from database
     query = "DELETE FROM tags WHERE id = ?"
     execute_query(query, (tag_id,))
+    for pet_id in refresh_pet_tags(get_db(), tag_id, remove=True):
+        invalidate_entity('pets', pet_id)
+    if SHARD_COUNT:
+        execute_query("INSERT INTO tag_renames (tag_id, old_name, new_name) VALUES (?, ?, NULL)",
+                      (tag_id, tag[0][1]))
+        after_commit(sync_shard_tags)
+    invalidate_entity('tags', tag_id)
     return jsonify({"message": "Tag deleted successfully"}), 204
 
 
+# /search
+# Words of the search text; everything else (FTS5 operators, quotes) is ignored
+SEARCH_TERM = re.compile(r'\w+')
+
+
+# Function to turn free text into an FTS5 query where every word must match as a prefix
+def search_match(text):
+    return ' '.join(f'"{term}"*' for term in SEARCH_TERM.findall(text))
+
+
+@app.route('/search', methods=['GET'])
+def search():
+    match = search_match(request.args.get('q', ''))
+    if not match:
+        return jsonify(message="q is required"), 400
+    types = list_arg('type') or list(SEARCH_INDEXES)
+    for table in types:
+        if table not in SEARCH_INDEXES:
+            return jsonify(message=f"Unknown type: {table}"), 400
+    try:
+        limit = min(int_arg('limit', DEFAULT_PAGE_LIMIT), MAX_PAGE_LIMIT)
+        offset = int_arg('offset', 0)
+    except QueryError as e:
+        return jsonify(message=str(e)), 400
+    # Take the best offset + limit + 1 matches of each type, then merge them by rank
+    window = offset + limit + 1
+    matches = []
+    for table in types:
+        columns = COLLECTIONS[table]['columns']
+        query = (f"SELECT {table}_fts.rank, {', '.join(f'c.{column}' for column in columns)} "
+                 f"FROM {table}_fts JOIN {table} c ON c.id = {table}_fts.rowid "
+                 f"WHERE {table}_fts MATCH ? ORDER BY {table}_fts.rank, c.id LIMIT ?")
+        for row in gather(table, query, (match, window)):
+            matches.append((row[0], table, row[1], dict(zip(columns, row[1:]))))
+    matches.sort(key=lambda match: match[:3])
+    page = matches[offset:offset + limit]
+    response = jsonify([{"type": table, "rank": rank, "item": item} for rank, table, _, item in page])
+    if len(matches) > offset + limit:
+        response.headers['Link'] = f'<{next_page_url(offset + limit, cursor="offset")}>; rel="next"'
+    return response
+
+
+# /changes: the change log as a long-polling endpoint and a server-sent events stream.
+# Every database keeps its own log, so with shards the pet and order changes are in the
+# shards' logs. A cursor holds the last seq read from each database, the main one first,
+# and is written as that seq when there is one database, or as the seqs joined by dots.
+# Seconds a long-poll may wait, and between keep-alive comments on an idle stream
+CHANGES_MAX_WAIT = float(os.environ.get('PETSTORE_CHANGES_MAX_WAIT', 30.0))
+CHANGES_HEARTBEAT = float(os.environ.get('PETSTORE_CHANGES_HEARTBEAT', 15.0))
+# Seconds between checks for changes committed by other processes
+CHANGES_POLL_INTERVAL = float(os.environ.get('PETSTORE_CHANGES_POLL_INTERVAL', 1.0))
+# Recent changes kept in memory for subscribers
+CHANGES_BUFFER_SIZE = int(os.environ.get('PETSTORE_CHANGES_BUFFER_SIZE', 10000))
+# Request handler threads per process; serve.py and asgi.py pass theirs to configure_app()
+# as HANDLER_THREADS
+HANDLER_THREADS = int(os.environ.get('PETSTORE_THREADS', 4))
+
+
+# Function to pick the concurrent waiting subscribers allowed per process. Each one holds
+# a handler thread, so by default half of them are left for ordinary requests. Streams
+# served by asgi.py hold no thread and are limited by CHANGES_MAX_STREAMS instead.
+def changes_max_subscribers(threads):
+    return int(os.environ.get('PETSTORE_CHANGES_MAX_SUBSCRIBERS', max(1, threads // 2)))
+
+
+CHANGES_MAX_SUBSCRIBERS = changes_max_subscribers(HANDLER_THREADS)
+# Concurrent /changes/stream clients per process when the event loop serves them (asgi.py)
+CHANGES_MAX_STREAMS = int(os.environ.get('PETSTORE_CHANGES_MAX_STREAMS', 1000))
+# Retention in seconds, and the age after which only the latest change per entity is kept
+CHANGES_RETENTION = float(os.environ.get('PETSTORE_CHANGES_RETENTION', 7 * 86400))
+CHANGES_COMPACT_AFTER = float(os.environ.get('PETSTORE_CHANGES_COMPACT_AFTER', 86400))
+
+# Each change as (seq, changed_at, JSON object text), built by SQLite without decoding the stored data
+CHANGES_QUERY = '''
+    SELECT seq, changed_at, json_object('seq', seq, 'table', table_name, 'id', entity_id, 'op', op,
+                                        'at', changed_at, 'data', json(data))
+    FROM changes WHERE seq > ? ORDER BY seq LIMIT ?
+'''
+
+
+# Function to parse a cursor given as `since` or Last-Event-ID into one seq per database
+def parse_cursor(value):
+    try:
+        cursor = tuple(int(seq) for seq in value.split('.'))
+    except ValueError:
+        raise QueryError("since must be a seq or a cursor returned by /changes")
+    if min(cursor) < 0:
+        raise QueryError("since must not be negative")
+    # 0 is the start of every log
+    if cursor == (0,):
+        return (0,) * len(DATABASES)
+    if len(cursor) != len(DATABASES):
+        raise QueryError("since must be a seq or a cursor returned by /changes")
+    return cursor
+
+
+# Function to write a cursor for a response: the seq itself with a single database
+def format_cursor(cursor):
+    if len(cursor) == 1:
+        return cursor[0]
+    return '.'.join(str(seq) for seq in cursor)
+
+
+# Function to move a cursor past changes given as (database, seq, text)
+def advance_cursor(cursor, changes):
+    cursor = list(cursor)
+    for source, seq, _ in changes:
+        cursor[source] = seq
+    return tuple(cursor)
+
+
+# Function to read up to `limit` changes after `cursor` from every database's log, on
+# pooled connections that are released right away, so a subscriber never holds one while
+# it waits. Returns (changes, truncated cursor); changes are (database, seq, text) in
+# commit time order, or None when a log no longer reaches back to the cursor.
+def read_changes(cursor, limit):
+    truncated, logs = [], []
+    for source, (pool, since) in enumerate(zip([db_pool] + shard_pools, cursor)):
+        conn = pool.acquire()
+        try:
+            truncated.append(conn.execute("SELECT truncated_seq FROM changes_retention").fetchone()[0])
+            rows = conn.execute(CHANGES_QUERY, (since, limit)).fetchall() if since >= truncated[-1] else []
+        finally:
+            pool.release(conn)
+        logs.append([(changed_at, source, seq, text) for seq, changed_at, text in rows])
+    if any(since < seq for since, seq in zip(cursor, truncated)):
+        return None, tuple(truncated)
+    merged = itertools.islice(heapq.merge(*logs), limit)
+    return [(source, seq, text) for _, source, seq, text in merged], tuple(truncated)
+
+
+# In-process broadcaster: one thread per process reads new changes from every database
+# once and hands them to every subscriber from a memory buffer. Commits in this process
+# wake it up at once; commits by other processes are picked up every CHANGES_POLL_INTERVAL
+# seconds.
+class ChangeFeed:
+    def __init__(self, buffer_size=CHANGES_BUFFER_SIZE, poll_interval=CHANGES_POLL_INTERVAL,
+                 max_subscribers=CHANGES_MAX_SUBSCRIBERS, max_streams=CHANGES_MAX_STREAMS):
+        self.buffer_size = buffer_size
+        self.poll_interval = poll_interval
+        self.max_subscribers = max_subscribers
+        self.max_streams = max_streams
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _start(self):
+        # Threads do not survive a fork, so each process starts its own reader
+        self._pid = os.getpid()
+        self._condition = threading.Condition()
+        self._wakeup = threading.Event()
+        self._buffer = deque()
+        # Every change of database i with seq > _covered_from[i] is in the buffer; None until the first read
+        self._covered_from = None
+        self.last_seq = None
+        self._listeners = set()
+        self.subscribers = 0
+        self.streams = 0
+        self.reads = 0
+        thread = threading.Thread(target=self._run, name='petstore-changes', daemon=True)
+        thread.start()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start()
+
+    # Called after every local commit; cheap, and a no-op until someone subscribes
+    def notify(self):
+        if self._pid == os.getpid():
+            self._wakeup.set()
+
+    def _run(self):
+        databases = list(DATABASES)
+        conns = [connect_db(database, READ_PRAGMAS) for database in databases]
+        last_seq = [conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0] for conn in conns]
+        with self._condition:
+            self._covered_from = list(last_seq)
+            self.last_seq = tuple(last_seq)
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            changes, more = [], False
+            for source, conn in enumerate(conns):
+                try:
+                    rows = conn.execute(CHANGES_QUERY, (last_seq[source], 1000)).fetchall()
+                except sqlite3.Error:
+                    app.logger.exception("Reading the change log of %s failed", databases[source])
+                    continue
+                if rows:
+                    changes.extend((source, seq, text) for seq, _, text in rows)
+                    last_seq[source] = rows[-1][0]
+                    more = more or len(rows) == 1000
+            if not changes:
+                continue
+            with self._condition:
+                self._buffer.extend(changes)
+                # A change pushed out of the buffer is no longer covered, nor is anything before it
+                while len(self._buffer) > self.buffer_size:
+                    source, seq, _ = self._buffer.popleft()
+                    self._covered_from[source] = seq
+                self.last_seq = tuple(last_seq)
+                self.reads += 1
+                self._condition.notify_all()
+                listeners = list(self._listeners)
+            for listener in listeners:
+                listener()
+            if more:
+                self._wakeup.set()
+
+    # Function to take up a subscriber slot; False when all are in use
+    def subscribe(self):
+        self._ensure_started()
+        with self._condition:
+            if self.subscribers >= self.max_subscribers:
+                return False
+            self.subscribers += 1
+            return True
+
+    def unsubscribe(self):
+        with self._condition:
+            self.subscribers -= 1
+
+    # Function to take up a slot for a stream served without a thread; False when all are in use
+    def open_stream(self):
+        self._ensure_started()
+        with self._condition:
+            if self.streams >= self.max_streams:
+                return False
+            self.streams += 1
+            return True
+
+    def close_stream(self):
+        with self._condition:
+            self.streams -= 1
+
+    # Function to have callback() called on the reader thread whenever changes arrive, for
+    # waiters that cannot block on the condition, like an event loop
+    def add_listener(self, callback):
+        self._ensure_started()
+        with self._condition:
+            self._listeners.add(callback)
+
+    def remove_listener(self, callback):
+        with self._condition:
+            self._listeners.discard(callback)
+
+    # Function to return up to `limit` buffered changes after the cursor `since`, or None if
+    # the buffer does not reach back that far (the caller then reads the tables)
+    def changes_since(self, since, limit):
+        self._ensure_started()
+        with self._condition:
+            if self._covered_from is None or any(seq < covered for seq, covered in zip(since, self._covered_from)):
+                return None
+            newer, done = [], set()
+            for change in reversed(self._buffer):
+                source, seq, _ = change
+                if seq > since[source]:
+                    newer.append(change)
+                    continue
+                # Everything older from this database is behind the cursor too
+                done.add(source)
+                if len(done) == len(since):
+                    break
+            newer.reverse()
+            return newer[:limit]
+
+    # Function to tell whether a change after the cursor `since` has arrived
+    def arrived(self, since):
+        with self._condition:
+            return self._arrived(since)
+
+    def _arrived(self, since):
+        return self.last_seq is not None and any(last > seq for last, seq in zip(self.last_seq, since))
+
+    # Function to wait until a change after the cursor `since` arrives; False on timeout
+    def wait(self, since, timeout):
+        with self._condition:
+            return self._condition.wait_for(partial(self._arrived, since), timeout)
+
+    def metrics(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                return {'running': False}
+        with self._condition:
+            return {
+                'running': True,
+                'subscribers': self.subscribers,
+                'streams': self.streams,
+                'buffered': len(self._buffer),
+                # Summed over the databases, so it grows with every change
+                'last_seq': sum(self.last_seq or ()),
+                'reads': self.reads,
+            }
+
+
+change_feed = ChangeFeed()
+COMMIT_HOOKS.append(change_feed.notify)
+
+
+# Function to fetch changes after the cursor `since`: (changes, truncated cursor), changes
+# being None when a log no longer reaches back to `since`. The broadcaster's buffer answers
+# when it has newer changes; otherwise the tables are read, since the buffer may lag a commit.
+def fetch_changes(since, limit):
+    changes = change_feed.changes_since(since, limit)
+    if changes:
+        return changes, None
+    return read_changes(since, limit)
+
+
+# Function to build the 410 response for a cursor older than the retained log
+def changes_gone(truncated):
+    truncated = format_cursor(truncated)
+    return jsonify(message=f"Changes up to seq {truncated} are no longer retained; "
+                           "reload the collections and continue from the cursor returned by /changes",
+                   truncated_seq=truncated), 410
+
+
+@app.route('/changes', methods=['GET'])
+def get_changes():
+    try:
+        since = parse_cursor(request.args.get('since') or '0')
+        limit = min(int_arg('limit', DEFAULT_PAGE_LIMIT), MAX_PAGE_LIMIT)
+        wait = min(int_arg('wait', 0), CHANGES_MAX_WAIT)
+    except QueryError as e:
+        return jsonify(message=str(e)), 400
+    if wait and not change_feed.subscribe():
+        return jsonify(message="Too many change subscribers"), 503, {'Retry-After': '1'}
+    try:
+        changes, truncated = fetch_changes(since, limit)
+        if changes is None:
+            return changes_gone(truncated)
+        # Long-poll: answer as soon as a change arrives, or empty once `wait` seconds pass
+        if not changes and wait and change_feed.wait(since, wait):
+            changes, truncated = fetch_changes(since, limit)
+            if changes is None:
+                return changes_gone(truncated)
+    finally:
+        if wait:
+            change_feed.unsubscribe()
+    next_cursor = encode_json(format_cursor(advance_cursor(since, changes)))
+    body = f'{{"changes":[{",".join(text for _, _, text in changes)}],"next":{next_cursor}}}'
+    return Response(body, mimetype='application/json')
+
+
+CHANGES_RETRY_EVENT = f"retry: {int(CHANGES_POLL_INTERVAL * 1000)}\n\n"
+CHANGES_KEEPALIVE_EVENT = ": keep-alive\n\n"
+
+
+# Function to build the event telling a stream its cursor is older than the retained log
+def changes_gone_event(truncated):
+    return f"event: gone\ndata: {encode_json({'truncated_seq': format_cursor(truncated)})}\n\n"
+
+
+# Function to render changes after the cursor `since` as server-sent events, each with the
+# cursor just past it as its id; returns (events, cursor past the last change)
+def change_events_text(since, changes):
+    cursor, events = list(since), []
+    for source, seq, text in changes:
+        cursor[source] = seq
+        events.append(f"id: {format_cursor(cursor)}\nevent: change\ndata: {text}\n\n")
+    return ''.join(events), tuple(cursor)
+
+
+# Generator producing the server-sent events of every change after the cursor `since`
+def change_events(since):
+    yield CHANGES_RETRY_EVENT
+    while True:
+        changes, truncated = fetch_changes(since, MAX_PAGE_LIMIT)
+        if changes is None:
+            yield changes_gone_event(truncated)
+            return
+        if changes:
+            events, since = change_events_text(since, changes)
+            yield events
+        elif not change_feed.wait(since, CHANGES_HEARTBEAT):
+            yield CHANGES_KEEPALIVE_EVENT
+
+
+# Async generator producing the same events on an event loop (asgi.py), so a stream holds
+# no thread while it waits: `run(function, *args)` runs blocking reads off the loop and
+# `wait(since, timeout)` waits for a change like ChangeFeed.wait()
+async def change_events_async(since, run, wait):
+    yield CHANGES_RETRY_EVENT
+    while True:
+        changes, truncated = await run(fetch_changes, since, MAX_PAGE_LIMIT)
+        if changes is None:
+            yield changes_gone_event(truncated)
+            return
+        if changes:
+            events, since = change_events_text(since, changes)
+            yield events
+        elif not await wait(since, CHANGES_HEARTBEAT):
+            yield CHANGES_KEEPALIVE_EVENT
+
+
+@app.route('/changes/stream', methods=['GET'])
+def stream_changes():
+    # Reconnecting EventSource clients send the last id they saw as Last-Event-ID
+    try:
+        since = parse_cursor(request.args.get('since') or request.headers.get('Last-Event-ID') or '0')
+    except QueryError as e:
+        return jsonify(message=str(e)), 400
+    changes, truncated = read_changes(since, 0)
+    if changes is None:
+        return changes_gone(truncated)
+    # asgi.py offers to serve the events on its event loop, freeing this thread at once;
+    # it then owns the stream slot and closes it when the client goes away
+    handoff = request.environ.get('petstore.stream_changes')
+    if handoff is not None and request.method == 'GET':
+        if not change_feed.open_stream():
+            return jsonify(message="Too many change streams"), 503, {'Retry-After': '1'}
+        handoff(since)
+        response = Response(iter(()), mimetype='text/event-stream')
+    else:
+        if not change_feed.subscribe():
+            return jsonify(message="Too many change subscribers"), 503, {'Retry-After': '1'}
+        response = Response(change_events(since), mimetype='text/event-stream')
+        # Closing the response frees the slot even if the stream was never iterated (HEAD,
+        # or a client gone before the first chunk), which a finally in the generator misses
+        response.call_on_close(change_feed.unsubscribe)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# Function to apply retention and compaction to the change log; returns rows removed.
+# Entries older than CHANGES_RETENTION are deleted; entries older than CHANGES_COMPACT_AFTER
+# are deleted when a later change of the same entity exists, so replaying the log still
+# ends in the current state.
+def compact_changes(cursor, now=None):
+    now = time.time() if now is None else now
+    expired = cursor.execute(
+        "SELECT seq FROM changes WHERE changed_at >= ? ORDER BY seq LIMIT 1", (now - CHANGES_RETENTION,)
+    ).fetchone()
+    if expired is None:
+        expired = cursor.execute("SELECT seq + 1 FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+    removed = 0
+    if expired is not None:
+        removed += cursor.execute("DELETE FROM changes WHERE seq < ?", expired).rowcount
+        cursor.execute("UPDATE changes_retention SET truncated_seq = MAX(truncated_seq, ? - 1)", expired)
+    removed += cursor.execute('''
+        DELETE FROM changes WHERE changed_at < ? AND EXISTS (
+            SELECT 1 FROM changes later
+            WHERE later.table_name = changes.table_name AND later.entity_id = changes.entity_id
+            AND later.seq > changes.seq
+        )
+    ''', (now - CHANGES_COMPACT_AFTER,)).rowcount
+    return removed
+
+
+# Bulk endpoints: /<collection>/bulk
+BULK_COLLECTIONS = 'users, pets, orders, categories, tags'
+BULK_VALIDATORS = {
+    'users': validate_user,
+    'pets': validate_pet,
+    'orders': validate_order,
+    'categories': validate_named,
+    'tags': validate_named,
+}
+MAX_BULK_ITEMS = int(os.environ.get('PETSTORE_MAX_BULK_ITEMS', 50000))
+
+
+class BulkError(ValueError):
+    pass
+
+
+# Function to read the bulk request body as a list of items (JSON array or NDJSON)
+def read_bulk_items():
+    if request.mimetype == NDJSON_MIMETYPE:
+        items = []
+        for line in request.stream:
+            line = line.strip()
+            if line:
+                try:
+                    items.append(json.loads(line))
+                except ValueError:
+                    raise BulkError(f"Invalid JSON on line {len(items) + 1}")
+                if len(items) > MAX_BULK_ITEMS:
+                    break
+    else:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            raise BulkError("Request body must be a JSON array or NDJSON")
+    if len(items) > MAX_BULK_ITEMS:
+        raise BulkError(f"At most {MAX_BULK_ITEMS} items are allowed per request")
+    return items
+
+
+# Function to read the partial-failure mode: 'rollback' (all or nothing) or 'skip' (write the valid items)
+def bulk_on_error():
+    on_error = request.args.get('on_error', 'rollback')
+    if on_error not in ('rollback', 'skip'):
+        raise BulkError("on_error must be 'rollback' or 'skip'")
+    return on_error
+
+
+# Function to run executemany, isolating failing rows one by one when skipping errors
+def execute_many(db, query, rows, results, on_error):
+    if not rows:
+        return
+    db.execute("SAVEPOINT bulk")
+    try:
+        timed = instrumentation.enabled
+        if timed:
+            start = time.perf_counter()
+        db.executemany(query, [args for _, args in rows])
+        if timed:
+            instrumentation.record_sql(query, time.perf_counter() - start, len(rows))
+        db.execute("RELEASE bulk")
+        return
+    except sqlite3.Error:
+        db.execute("ROLLBACK TO bulk")
+        db.execute("RELEASE bulk")
+        if on_error == 'rollback':
+            raise
+    for index, args in rows:
+        try:
+            db.execute(query, args)
+        except sqlite3.Error as e:
+            results[index] = {"index": index, "status": 409, "message": str(e)}
+
+
+# Function to run a bulk write function on the entries: once, or for a sharded table once
+# per shard, on that shard's writer, with the entries `shard_of` maps to it. Shards commit
+# separately, so all-or-nothing writes must stay on one shard.
+def write_bulk(write, table, entries, shard_of, results, on_error):
+    if not is_sharded(table):
+        return write(table, entries, results, on_error)
+    groups = {}
+    for entry in entries:
+        groups.setdefault(shard_of(entry), []).append(entry)
+    if len(groups) > 1 and on_error == 'rollback':
+        raise BulkError("The items are stored on several shards, which cannot be written all or nothing; "
+                        "send them per shard or use on_error=skip")
+    try:
+        for shard, group in sorted(groups.items()):
+            g._shard = shard
+            write(table, group, results, on_error)
+    finally:
+        g.pop('_shard', None)
+
+
+# Function to build the bulk response; rollback mode reports failures without writing anything
+def bulk_response(results, on_error, success_status):
+    failed = [result for result in results if result['status'] >= 400]
+    if failed and on_error == 'rollback':
+        # The valid items were not written either, so none of them reports success
+        for result in results:
+            if result['status'] < 400:
+                result['status'] = 424
+                result['message'] = "Rolled back because other items failed"
+        return jsonify(results=results, message="No items were written"), 400
+    status = 207 if failed else success_status
+    return jsonify(results=results), status
+
+
+# Function to build the per-item result for a bulk item that failed validation
+def bulk_item_error(index, errors, item_id=None):
+    result = {"index": index, "status": 400, "message": errors[0]['message'], "errors": errors}
+    if item_id is not None:
+        result['id'] = item_id
+    return result
+
+
+# Function to pick out a valid integer id from a bulk update/delete item
+def bulk_item_id(item):
+    item_id = item.get('id') if isinstance(item, dict) else item
+    if isinstance(item_id, bool) or not isinstance(item_id, int):
+        return None
+    return item_id
+
+
+# Function to fetch existing rows by id inside the current transaction
+def fetch_rows_by_id(table, ids):
+    rows = {}
+    columns = ', '.join(COLLECTIONS[table]['columns'])
+    ids = list(ids)
+    # Stay below SQLite's bound-parameter limit
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        placeholders = ', '.join('?' * len(chunk))
+        for row in query_db(f"SELECT {columns} FROM {table} WHERE id IN ({placeholders})", chunk):
+            rows[row[0]] = row
+    return rows
+
+
+# Function to sync pet_tags and pet_photos for pets written in bulk; values is [(pet id, writable values)]
+def sync_bulk_pet_links(db, values):
+    fields = [column for column, _, _ in COLLECTIONS['pets']['writable']]
+    tags, photo_urls = fields.index('tags'), fields.index('photo_urls')
+    sync_pet_links(db, [(pet_id, row[tags], row[photo_urls]) for pet_id, row in values])
+
+
+# The bulk routes read and validate the items on the request thread and leave only
+# the database work, in the @transactional functions below each, to the writer.
+@app.route(f'/<any({BULK_COLLECTIONS}):table>/bulk', methods=['POST'])
+def bulk_create(table):
+    try:
+        on_error = bulk_on_error()
+        items = read_bulk_items()
+    except BulkError as e:
+        return jsonify(message=str(e)), 400
+    validate = BULK_VALIDATORS[table]
+    results, valid = [], []
+    for index, item in enumerate(items):
+        errors = validate(item)
+        if errors:
+            results.append(bulk_item_error(index, errors))
+        else:
+            results.append({"index": index, "status": 201})
+            valid.append((index, item))
+    if len(valid) < len(items) and on_error == 'rollback':
+        return bulk_response(results, on_error, 201)
+    # New pets can go to any shard, so they all go to one and commit together; orders go to their pets'
+    pet_shard = next_shard() if table == 'pets' and is_sharded(table) else None
+    try:
+        write_bulk(insert_bulk, table, valid, lambda entry: order_shard(entry[1]) if pet_shard is None else pet_shard,
+                   results, on_error)
+    except BulkError as e:
+        return jsonify(message=str(e)), 400
+    except sqlite3.Error as e:
+        return jsonify(message=f"Bulk insert failed: {e}"), 409
+    for result in results:
+        if result['status'] >= 400:
+            result.pop('id', None)
+    return bulk_response(results, on_error, 201)
+
+
+# Function to insert validated bulk items, filling in their ids and failures in `results`
+@transactional
+def insert_bulk(table, valid, results, on_error):
+    writable = COLLECTIONS[table]['writable']
+    columns = ', '.join(['id'] + [column for column, _, _ in writable])
+    query = f"INSERT INTO {table} ({columns}) VALUES ({', '.join('?' * (len(writable) + 1))})"
+    db = get_db()
+    # Ids are assigned explicitly while holding the write lock so they can be returned
+    if is_sharded(table):
+        ids = [new_id(table) for _ in valid]
+    else:
+        next_id = db.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0] + 1
+        ids = range(next_id, next_id + len(valid))
+    rows = []
+    for item_id, (index, item) in zip(ids, valid):
+        results[index]['id'] = item_id
+        rows.append((index, (item_id,) + tuple(item.get(field, default) for _, field, default in writable)))
+    execute_many(db, query, rows, results, on_error)
+    if table == 'pets':
+        sync_bulk_pet_links(db, [(args[0], args[1:]) for index, args in rows if results[index]['status'] < 400])
+
+
+@app.route(f'/<any({BULK_COLLECTIONS}):table>/bulk', methods=['PATCH'])
+def bulk_update(table):
+    try:
+        on_error = bulk_on_error()
+        items = read_bulk_items()
+    except BulkError as e:
+        return jsonify(message=str(e)), 400
+    validate = BULK_VALIDATORS[table]
+    results, pending = [None] * len(items), []
+    for index, item in enumerate(items):
+        item_id = bulk_item_id(item)
+        if item_id is None or not isinstance(item, dict):
+            results[index] = {"index": index, "status": 400, "message": "Item must be an object with an integer id"}
+        else:
+            # Validation errors are reported after the existence check, like a single PUT
+            pending.append((index, item_id, item, validate(item, partial=True)))
+    try:
+        write_bulk(update_bulk, table, pending, lambda entry: shard_for(entry[1]), results, on_error)
+    except BulkError as e:
+        return jsonify(message=str(e)), 400
+    except sqlite3.Error as e:
+        return jsonify(message=f"Bulk update failed: {e}"), 409
+    return bulk_response(results, on_error, 200)
+
+
+# Function to apply validated bulk updates to the rows that exist, filling in `results`
+@transactional
+def update_bulk(table, pending, results, on_error):
+    writable = COLLECTIONS[table]['writable']
+    assignments = ', '.join(f"{column} = ?" for column, _, _ in writable)
+    query = f"UPDATE {table} SET {assignments} WHERE id = ?"
+    db = get_db()
+    existing = fetch_rows_by_id(table, [item_id for _, item_id, _, _ in pending])
+    rows = []
+    for index, item_id, item, errors in pending:
+        if item_id not in existing:
+            results[index] = {"index": index, "status": 404, "id": item_id, "message": "Not found"}
+            continue
+        if errors:
+            results[index] = bulk_item_error(index, errors, item_id)
+            continue
+        pet_id = item.get('pet_id', existing[item_id][1]) if table == 'orders' else None
+        if is_sharded(table) and pet_id is not None and shard_for(pet_id) != current_shard():
+            results[index] = {"index": index, "status": 400, "id": item_id,
+                              "message": "An order cannot be moved to a pet on another shard"}
+            continue
+        current = existing[item_id]
+        # Use the existing value for every field not provided in the item
+        args = tuple(item.get(field, current[position + 1]) for position, (_, field, _) in enumerate(writable))
+        results[index] = {"index": index, "status": 200, "id": item_id}
+        rows.append((index, args + (item_id,)))
+    if len(rows) < len(results) and on_error == 'rollback':
+        return
+    execute_many(db, query, rows, results, on_error)
+    if table == 'pets':
+        sync_bulk_pet_links(db, [(args[-1], args[:-1]) for index, args in rows if results[index]['status'] < 400])
+    for index, args in rows:
+        invalidate_entity(table, args[-1])
+
+
+@app.route(f'/<any({BULK_COLLECTIONS}):table>/bulk', methods=['DELETE'])
+def bulk_delete(table):
+    try:
+        on_error = bulk_on_error()
+        items = read_bulk_items()
+    except BulkError as e:
+        return jsonify(message=str(e)), 400
+    results, pending = [None] * len(items), []
+    for index, item in enumerate(items):
+        item_id = bulk_item_id(item)
+        if item_id is None:
+            results[index] = {"index": index, "status": 400,
+                              "message": "Item must be an integer id or an object with one"}
+        else:
+            pending.append((index, item_id))
+    try:
+        write_bulk(delete_bulk, table, pending, lambda entry: shard_for(entry[1]), results, on_error)
+    except BulkError as e:
+        return jsonify(message=str(e)), 400
+    except sqlite3.Error as e:
+        return jsonify(message=f"Bulk delete failed: {e}"), 409
+    return bulk_response(results, on_error, 200)
+
+
+# Function to delete the bulk ids that exist, filling in `results`
+@transactional
+def delete_bulk(table, pending, results, on_error):
+    db = get_db()
+    existing = fetch_rows_by_id(table, [item_id for _, item_id in pending])
+    rows = []
+    for index, item_id in pending:
+        if item_id not in existing:
+            results[index] = {"index": index, "status": 404, "id": item_id, "message": "Not found"}
+        else:
+            results[index] = {"index": index, "status": 200, "id": item_id}
+            rows.append((index, (item_id,)))
+    if len(rows) < len(results) and on_error == 'rollback':
+        return
+    execute_many(db, f"DELETE FROM {table} WHERE id = ?", rows, results, on_error)
+    if table == 'pets':
+        delete_pet_links(db, [args[0] for index, args in rows if results[index]['status'] < 400])
+    for index, args in rows:
+        invalidate_entity(table, args[0])
+
+
+@app.route('/db-pool', methods=['GET'])
+def get_db_pool_stats():
+    return jsonify(db_pool.metrics())
+
+
+@app.route('/replicas', methods=['GET'])
+def get_replica_stats():
+    return jsonify(replica_set.metrics())
+
+
+@app.route('/shards', methods=['GET'])
+def get_shard_stats():
+    return jsonify([{'path': path, 'pool': pool.metrics(), 'write_queue': writer.metrics()}
+                    for path, pool, writer in zip(SHARD_PATHS, shard_pools, shard_write_queues)])
+
+
+@app.route('/write-queue', methods=['GET'])
+def get_write_queue_stats():
+    return jsonify(write_queue.metrics())
+
+
+# Function to turn a component's metrics into Prometheus gauges: flags become 0/1 and
+# anything that is not a number (lists, dicts) is left to the component's own endpoint
+def numeric_gauges(prefix, metrics):
+    return [(f'{prefix}_{name}', int(value) if isinstance(value, bool) else value)
+            for name, value in metrics.items() if isinstance(value, (int, float))]
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    gauges = numeric_gauges('petstore_db_pool', db_pool.metrics())
+    gauges += numeric_gauges('petstore_entity_cache', entity_cache.metrics())
+    gauges += numeric_gauges('petstore_write_queue', write_queue.metrics())
+    gauges += numeric_gauges('petstore_change_feed', change_feed.metrics())
+    if replica_set.paths:
+        gauges += numeric_gauges('petstore_replicas', replica_set.metrics())
+    gauges += [(f'petstore_startup_{phase}_seconds', seconds) for phase, seconds in startup_times.items()]
+    return Response(instrumentation.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/metrics/slow-queries', methods=['GET'])
+def get_slow_queries():
+    return jsonify(list(instrumentation.slow_queries))
+
+
+@app.route('/metrics/config', methods=['GET', 'PUT'])
+def metrics_config():
+    if request.method == 'PUT':
+        data = request.json
+        if not isinstance(data, dict):
+            return jsonify(message="Request body must be a JSON object"), 400
+        if 'enabled' in data:
+            if not isinstance(data['enabled'], bool):
+                return jsonify(message="enabled must be a boolean"), 400
+            instrumentation.enabled = data['enabled']
+        if 'slow_query_ms' in data:
+            if isinstance(data['slow_query_ms'], bool) or not isinstance(data['slow_query_ms'], (int, float)):
+                return jsonify(message="slow_query_ms must be a number"), 400
+            instrumentation.slow_query_ms = data['slow_query_ms']
+        if data.get('reset'):
+            instrumentation.reset()
+            instrumentation.slow_queries.clear()
+    return jsonify(enabled=instrumentation.enabled, slow_query_ms=instrumentation.slow_query_ms)
+
+
+@app.route('/entity-cache', methods=['GET'])
+def get_entity_cache_stats():
+    return jsonify(entity_cache.metrics())
+
+
+# Function to summarize the startup phases this process has been through so far
+def startup_report():
+    phases = {phase: round(startup_times[phase], 6) for phase in ('import', 'schema', 'warm_up')
+              if phase in startup_times}
+    return {
+        'pid': os.getpid(),
+        'database': DATABASE,
+        'auto_migrate': AUTO_MIGRATE,
+        'phases': phases,
+        'total': round(sum(phases.values()), 6),
+    }
+
+
+@app.route('/startup', methods=['GET'])
+def get_startup_report():
+    return jsonify(startup_report())
+
+
+# Static JSON document, resolved next to this module rather than the CWD
+JSON_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'complex_data.json')
+
+
+# In-memory copy of a JSON file, kept as pre-encoded bytes and reloaded when the file changes
+class JSONFileCache:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._signature = None
+        self.etag = None
+        self.last_modified = None
+        self.variants = {}
+
+    def _load(self, signature, mtime):
+        with open(self.path, 'rb') as file:
+            data = json.load(file)
+        body = encode_json(data).encode('utf-8')
+        variants = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9)}
+        if brotli is not None:
+            variants['br'] = brotli.compress(body)
+        self.variants = variants
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        self.last_modified = mtime
+        self._signature = signature
+
+    def refresh(self):
+        stat = os.stat(self.path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature != self._signature:
+            with self._lock:
+                if signature != self._signature:
+                    self._load(signature, stat.st_mtime)
+        return self
+
+    # Pick the smallest encoding the client accepts
+    def negotiate(self, accept_encodings):
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accept_encodings[encoding]:
+                return encoding
+        return 'identity'
+
+
+json_file_cache = JSONFileCache(JSON_FILE)
+
+
 @app.route('/complex-json-file', methods=['GET'])
 def get_json_file():
     try:
-        # Read the JSON file
-        with open('complex_data.json', 'r') as file:
-            json_data = json.load(file)
-        # Return the JSON data as the response
-        return jsonify(json_data)
+        # Reload the JSON file only if it changed on disk
+        document = json_file_cache.refresh()
     except Exception as e:
         # Handle any exceptions and return an error response
         return jsonify({'error': str(e)}), 500
+    encoding = document.negotiate(request.accept_encodings)
+    etag = document.etag if encoding == 'identity' else f"{document.etag}-{encoding}"
+    if request.if_none_match.contains(etag) or etag_matches(request.if_none_match, document.etag):
+        response = Response(status=304)
+    else:
+        response = Response(document.variants[encoding], mimetype='application/json')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.last_modified = document.last_modified
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+# Bulk export and import of whole tables, used by /admin/export, /admin/import and the
+# export-data and import-data commands. A sharded table is exported from every shard,
+# merged by id, and each imported row goes to the shard of its id; every shard is read
+# from its own snapshot and written in its own transaction.
+EXPORT_TABLES = ('users', 'pets', 'orders', 'categories', 'tags')
+EXPORT_BATCH_SIZE = int(os.environ.get('PETSTORE_EXPORT_BATCH_SIZE', 5000))
+# How NULL is written in CSV, to tell it apart from an empty string
+CSV_NULL = '\\N'
+
+
+# Context manager for a read connection holding one snapshot of the whole database.
+# In WAL mode the snapshot does not block writers, and every table read through it is
+# consistent with the others.
+@contextmanager
+def snapshot():
+    conn = connect_db(DATABASE, READ_PRAGMAS)
+    try:
+        conn.execute("BEGIN")
+        yield conn
+    finally:
+        conn.close()
+
+
+# Generator of a table's rows in batches of EXPORT_BATCH_SIZE
+def export_batches(conn, table):
+    query = f"SELECT {', '.join(COLLECTIONS[table]['columns'])} FROM {table} ORDER BY id"
+    if is_sharded(table):
+        yield from iter_ordered(table, query, (), EXPORT_BATCH_SIZE)
+        return
+    cursor = conn.execute(query)
+    while True:
+        rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+        if not rows:
+            return
+        yield rows
+
+
+def export_ndjson(conn, table):
+    encode_row = row_encoder(COLLECTIONS[table]['columns'])
+    for rows in export_batches(conn, table):
+        yield ''.join([encode_row(row) + '\n' for row in rows]).encode('utf-8')
+
+
+def export_csv_gz(conn, table):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLLECTIONS[table]['columns'])
+    for rows in export_batches(conn, table):
+        writer.writerows([CSV_NULL if value is None else value for value in row] for row in rows)
+        yield compressor.compress(buffer.getvalue().encode('utf-8'))
+        buffer.seek(0)
+        buffer.truncate()
+    yield compressor.compress(buffer.getvalue().encode('utf-8')) + compressor.flush()
+
+
+# Function to map a table's declared column types to an Arrow schema
+def arrow_schema(conn, table):
+    declared = {row[1]: row[2].upper() for row in conn.execute(f"PRAGMA table_info({table})")}
+    fields = []
+    for column in COLLECTIONS[table]['columns']:
+        kind = declared.get(column, '')
+        if 'INT' in kind or 'BOOL' in kind:
+            arrow_type = pyarrow.int64()
+        elif any(name in kind for name in ('REAL', 'FLOA', 'DOUB')):
+            arrow_type = pyarrow.float64()
+        else:
+            arrow_type = pyarrow.string()
+        fields.append(pyarrow.field(column, arrow_type))
+    return pyarrow.schema(fields)
+
+
+# File object that collects what is written to it so it can be streamed out
+class ChunkSink(io.RawIOBase):
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+# Parquet export: one row group per batch
+def export_parquet(conn, table):
+    schema = arrow_schema(conn, table)
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    for rows in export_batches(conn, table):
+        columns = list(zip(*rows))
+        writer.write_table(pyarrow.table([pyarrow.array(values, type=field.type)
+                                          for values, field in zip(columns, schema)], schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+# Export formats: name -> (generator of bytes, mimetype, file extension)
+EXPORT_FORMATS = {
+    'ndjson': (export_ndjson, 'application/x-ndjson', 'ndjson'),
+    'csv.gz': (export_csv_gz, 'application/gzip', 'csv.gz'),
+}
+if pyarrow is not None:
+    EXPORT_FORMATS['parquet'] = (export_parquet, 'application/vnd.apache.parquet', 'parquet')
+
+
+# Readers turning an uploaded binary stream into row tuples in the table's column order
+def import_ndjson(stream, columns):
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if line:
+            item = json.loads(line)
+            if not isinstance(item, dict):
+                raise ValueError(f"line {number}: expected an object")
+            yield tuple(item.get(column) for column in columns)
+
+
+def import_csv_gz(stream, columns):
+    reader = csv.reader(io.TextIOWrapper(gzip.GzipFile(fileobj=stream), encoding='utf-8', newline=''))
+    header = next(reader)
+    positions = [header.index(column) for column in columns]
+    for record in reader:
+        yield tuple(None if record[position] == CSV_NULL else record[position] for position in positions)
+
+
+def import_parquet(stream, columns):
+    # Parquet keeps its footer at the end, so the upload is read into memory first
+    parquet_file = pq.ParquetFile(io.BytesIO(stream.read()))
+    for batch in parquet_file.iter_batches(batch_size=EXPORT_BATCH_SIZE, columns=list(columns)):
+        yield from zip(*(batch.column(column).to_pylist() for column in columns))
+
+
+IMPORT_FORMATS = {'ndjson': import_ndjson, 'csv.gz': import_csv_gz}
+if pyarrow is not None:
+    IMPORT_FORMATS['parquet'] = import_parquet
+
+
+# Generator of the imported rows that belong to a shard; on a sharded table every row needs an id
+def shard_rows(rows, shard):
+    for row in rows:
+        if row[0] is None:
+            raise ValueError("Every row needs an id when the table is sharded")
+        if shard_for(int(row[0])) == shard:
+            yield row
+
+
+# Function to bulk-insert rows into a table inside the current write transaction; returns
+# the number of rows. The table's secondary indexes and triggers are dropped for the load
+# and recreated afterwards, and the work the triggers would have done (search index,
+# summaries, versions, change log) and the pet tag links are then applied in bulk.
+def import_rows(cursor, table, rows):
+    columns = COLLECTIONS[table]['columns']
+    deferred = cursor.execute(
+        "SELECT type, name, sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') "
+        "AND sql IS NOT NULL ORDER BY type, name", (table,)
+    ).fetchall()
+    for kind, name, _ in deferred:
+        cursor.execute(f"DROP {kind.upper()} {name}")
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS import_ids (id INTEGER PRIMARY KEY)")
+    cursor.execute("DELETE FROM temp.import_ids")
+    query = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    count = 0
+    rows = iter(rows)
+    while True:
+        batch = [row for _, row in zip(range(EXPORT_BATCH_SIZE), rows)]
+        if not batch:
+            break
+        cursor.executemany(query, batch)
+        cursor.executemany("INSERT INTO temp.import_ids (id) VALUES (?)", [(row[0],) for row in batch])
+        count += len(batch)
+    for _, _, sql in deferred:
+        cursor.execute(sql)
+
+    imported = "id IN (SELECT id FROM temp.import_ids)"
+    cursor.execute("UPDATE table_versions SET version = version + 1 WHERE name = ?", (table,))
+    cursor.execute(f"UPDATE {table} SET version = (SELECT version FROM table_versions WHERE name = ?), "
+                   f"updated_at = COALESCE(updated_at, {SQL_NOW}) WHERE {imported}", (table,))
+    data = 'json_object(' + ', '.join(f"'{column}', {column}" for column in columns) + ')'
+    cursor.execute(f"INSERT INTO changes (table_name, entity_id, op, data, changed_at) "
+                   f"SELECT '{table}', id, 'insert', {data}, {SQL_NOW} FROM {table} WHERE {imported} ORDER BY id")
+    if table in SEARCH_INDEXES:
+        names = ', '.join(column for column, _ in SEARCH_INDEXES[table])
+        cursor.execute(f"INSERT INTO {table}_fts (rowid, {names}) SELECT id, {names} FROM {table} WHERE {imported}")
+    if table == 'pets':
+        links = cursor.connection.execute(f"SELECT id, tags, photo_urls FROM pets WHERE {imported}")
+        while True:
+            batch = links.fetchmany(EXPORT_BATCH_SIZE)
+            if not batch:
+                break
+            sync_pet_links(cursor, batch)
+    if table in ('pets', 'orders'):
+        rebuild_summaries(cursor)
+    cursor.execute("DELETE FROM temp.import_ids")
+    return count
+
+
+# Function to pick the export/import format from ?format=, defaulting to NDJSON
+def transfer_format(formats):
+    name = request.args.get('format', 'ndjson')
+    if name not in formats:
+        raise QueryError(f"format must be one of: {', '.join(formats)}")
+    return name
+
+
+@app.route(f'/admin/export/<any({", ".join(EXPORT_TABLES)}):table>', methods=['GET'])
+def export_table(table):
+    try:
+        name = transfer_format(EXPORT_FORMATS)
+    except QueryError as e:
+        return jsonify(message=str(e)), 400
+    exporter, mimetype, extension = EXPORT_FORMATS[name]
+
+    def generate():
+        with snapshot() as conn:
+            yield from exporter(conn, table)
+
+    response = Response(generate(), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{table}.{extension}"'
+    return response
+
+
+@app.route(f'/admin/import/<any({", ".join(EXPORT_TABLES)}):table>', methods=['POST'])
+def import_table(table):
+    try:
+        reader = IMPORT_FORMATS[transfer_format(IMPORT_FORMATS)]
+    except QueryError as e:
+        return jsonify(message=str(e)), 400
+    # Each shard reads the whole upload for the rows of its ids, so a malformed upload
+    # fails on the first shard, before anything commits
+    body = buffer_request_body()
+    count = 0
+    try:
+        for shard in range(SHARD_COUNT) if is_sharded(table) else [None]:
+            g._shard = shard
+            if body is not None:
+                body.seek(0)
+            imported, error = import_upload(table, reader)
+            if error is not None:
+                if shard:
+                    error += f" (shards 0 to {shard - 1} were imported)"
+                return jsonify(message=error), 400
+            count += imported
+    finally:
+        g.pop('_shard', None)
+        if body is not None:
+            body.close()
+    return jsonify(table=table, imported=count), 201
+
+
+# Function to import the uploaded rows into a table, or on a sharded table the rows of
+# this writer's shard; returns (row count, None) or (None, error message)
+@transactional
+def import_upload(table, reader):
+    rows = reader(request_stream(), COLLECTIONS[table]['columns'])
+    shard = current_shard()
+    if shard is not None:
+        rows = shard_rows(rows, shard)
+    db = get_db()
+    # A failed import must also bring back the indexes and triggers it dropped
+    db.execute("SAVEPOINT import")
+    try:
+        count = import_rows(db.cursor(), table, rows)
+    except (ValueError, OSError, sqlite3.IntegrityError) as e:
+        db.execute("ROLLBACK TO import")
+        db.execute("RELEASE import")
+        return None, f"Import failed: {e}"
+    db.execute("RELEASE import")
+    if shard is not None:
+        highest = db.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+        id_allocator.advance(catalog_for(db), table, shard, highest)
+    after_commit(entity_cache.clear)
+    return count, None
+
+
+# Function to point the pools, writers, id allocator and change feed at another
+# database file (and its shards); only possible before the schema has been set up
+def configure_database(database):
+    global DATABASE, SHARD_PATHS, DATABASES, shard_pools, shard_write_queues
+    if _schema_ready:
+        raise RuntimeError("The database is already in use; set DATABASE before the first request")
+    DATABASE = app.config['DATABASE'] = database
+    SHARD_PATHS = shard_paths(database)
+    DATABASES = [database] + SHARD_PATHS
+    for component in (db_pool, write_queue, id_allocator):
+        component.database = database
+    shard_pools = [ShardPool(path) for path in SHARD_PATHS]
+    shard_write_queues = [ShardWriteQueue(path, shard) for shard, path in enumerate(SHARD_PATHS)]
+
+
+# Function to configure the process-wide app for a server, a benchmark or a test, and
+# return it. This is not an app factory: there is one module-level `app` with module-level
+# pools, writers and caches, and every call reconfigures that same singleton. `config` is
+# applied to app.config, whose DATABASE picks the database file (only before the first
+# request), HANDLER_THREADS the server's threads per process and ENTITY_CACHE_TTL the
+# entity cache's time to live. The database is not opened here: the schema is set up by
+# the first request, or by warm_up() in a pre-fork master.
+def configure_app(config=None):
+    if config:
+        app.config.update(config)
+    if app.config['DATABASE'] != DATABASE:
+        configure_database(app.config['DATABASE'])
+    if 'ENTITY_CACHE_TTL' in app.config:
+        entity_cache.ttl = app.config['ENTITY_CACHE_TTL']
+    if 'HANDLER_THREADS' in app.config:
+        change_feed.max_subscribers = changes_max_subscribers(app.config['HANDLER_THREADS'])
+    return app
+
+
+# Number of pets preloaded into the entity cache by warm_up()
+WARM_UP_PETS = int(os.environ.get('PETSTORE_WARM_UP_PETS', 1000))
+
+
+# Function to set up the schema and preload the static JSON file and, unless `entities`
+# is false, the hot rows, e.g. once in a pre-fork master so every worker starts with a
+# warm, copy-on-write cache
+def warm_up(entities=True):
+    ensure_db()
+    start = time.perf_counter()
+    preloads = (('categories', -1), ('tags', -1), ('pets', WARM_UP_PETS)) if entities else ()
+    with app.app_context():
+        for table, limit in preloads:
+            # Cached rows carry the version columns, like the single-entity GETs select them
+            columns = ', '.join(COLLECTIONS[table]['columns'] + ('version', 'updated_at'))
+            for row in gather_ordered(table, f"SELECT {columns} FROM {table} ORDER BY id", [], limit):
+                entity_cache.set((table, row[0]), row)
+        json_file_cache.refresh()
+    # Workers must open their own connections rather than inherit these
+    db_pool.close_all()
+    for pool in shard_pools:
+        pool.close_all()
+    startup_times['warm_up'] = time.perf_counter() - start
+
+
+# Function to run `task(cursor)` in one write transaction on its own writable
+# connection, after bringing the schema up to date; returns the task's result
+def run_maintenance(task, database=None):
+    conn = connect_db(database or DATABASE)
+    try:
+        with app.app_context(), use_connection(conn):
+            migrate(conn)
+            with transaction():
+                return task(conn.cursor())
+    finally:
+        conn.close()
+
+
+@app.cli.command('init-db', help='Create the database or bring its schema up to date. Run once per '
+                                  'deployment when the servers have PETSTORE_AUTO_MIGRATE=0.')
+def init_db_command():
+    init_db()
+    print(f"Schema at version {MIGRATIONS[-1][0]}: {', '.join(DATABASES)}")
+
+
+# Function to parse `python -X importtime` output into (module, self seconds, cumulative seconds)
+def parse_import_times(lines):
+    modules = []
+    for line in lines:
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(own) / 1e6, int(cumulative) / 1e6))
+    return modules
+
+
+@app.cli.command('startup-report', help='Start the app in a fresh process and report the time spent '
+                                        'importing, setting up the schema and warming up.')
+@click.option('--modules', type=int, default=10, show_default=True,
+              help='Number of slowest imported modules to list.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the report as JSON.')
+def startup_report_command(modules, as_json):
+    code = (f"import json, sys, {__name__} as api; api.configure_app({{'DATABASE': {DATABASE!r}}}); "
+            "api.warm_up(); sys.stdout.write(json.dumps(api.startup_report()))")
+    environ = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        filter(None, (os.path.dirname(os.path.abspath(__file__)), os.environ.get('PYTHONPATH')))))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, env=environ)
+    if result.returncode:
+        sys.exit(result.stderr)
+    report = json.loads(result.stdout)
+    report['slowest_imports'] = [
+        {'module': name, 'self': round(own, 6), 'cumulative': round(cumulative, 6)}
+        for name, own, cumulative in sorted(parse_import_times(result.stderr.splitlines()),
+                                            key=lambda module: module[1], reverse=True)[:modules]
+    ]
+    if as_json:
+        print(json.dumps(report, indent=2))
+        return
+    for phase, seconds in report['phases'].items():
+        print(f"{phase:<10} {seconds * 1000:9.1f} ms")
+    print(f"{'total':<10} {report['total'] * 1000:9.1f} ms")
+    for module in report['slowest_imports']:
+        print(f"  {module['module']:<40} {module['self'] * 1000:8.1f} ms self "
+              f"{module['cumulative'] * 1000:9.1f} ms cumulative")
+
+
+@app.cli.command('rebuild-search', help='Rebuild the full-text search indexes from their tables.')
+def rebuild_search_command():
+    for database in DATABASES:
+        run_maintenance(rebuild_search_indexes, database)
+    print(f"Rebuilt search indexes: {', '.join(SEARCH_INDEXES)}")
+
+
+@app.cli.command('verify-summaries', help='Check the inventory and order summaries against a full '
+                                          'recount, and rebuild them if they differ.')
+@click.option('--check', is_flag=True, help='Only report differences; exit with status 1 if there are any.')
+def verify_summaries_command(check):
+    def task(cursor):
+        differences = verify_summaries(cursor)
+        if differences and not check:
+            rebuild_summaries(cursor)
+        return differences
+
+    found = False
+    for database in DATABASES:
+        differences = run_maintenance(task, database)
+        # Shards are named; the main database keeps the plain output
+        prefix = '' if database == DATABASE else f"{database}: "
+        for table, mismatched in differences.items():
+            for key, stored, expected in mismatched:
+                print(f"{prefix}{table} {key!r}: stored {stored}, recount {expected}")
+        if differences and not check:
+            print(f"{prefix}Rebuilt summaries: {', '.join(differences)}")
+        found = found or bool(differences)
+    if not found:
+        print("Summaries match a full recount")
+    elif check:
+        sys.exit(1)
+
+
+@app.cli.command('export-data', help='Export tables from one consistent snapshot, one file per table.')
+@click.option('--format', 'name', type=click.Choice(list(EXPORT_FORMATS)), default='ndjson', show_default=True)
+@click.option('--output', type=click.Path(file_okay=False), default='export', show_default=True,
+              help='Directory to write the files to.')
+@click.argument('tables', nargs=-1, type=click.Choice(EXPORT_TABLES))
+def export_data_command(name, output, tables):
+    exporter, _, extension = EXPORT_FORMATS[name]
+    ensure_db()
+    os.makedirs(output, exist_ok=True)
+    with snapshot() as conn:
+        for table in tables or EXPORT_TABLES:
+            path = os.path.join(output, f"{table}.{extension}")
+            with open(path, 'wb') as file:
+                for chunk in exporter(conn, table):
+                    file.write(chunk)
+            print(f"Exported {table} to {path}")
+
+
+@app.cli.command('import-data', help='Bulk-load a file written by export-data into a table.')
+@click.option('--format', 'name', type=click.Choice(list(IMPORT_FORMATS)),
+              help='Defaults to the format matching the file extension.')
+@click.argument('table', type=click.Choice(EXPORT_TABLES))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_data_command(name, table, path):
+    if name is None:
+        name = next((format_name for format_name, (_, _, extension) in EXPORT_FORMATS.items()
+                     if path.endswith(f".{extension}")), 'ndjson')
+    reader = IMPORT_FORMATS[name]
+    columns = COLLECTIONS[table]['columns']
+    if not is_sharded(table):
+        with open(path, 'rb') as file:
+            count = run_maintenance(lambda cursor: import_rows(cursor, table, reader(file, columns)))
+        print(f"Imported {count} rows into {table}")
+        return
+    init_db()
+    catalog = connect_db(DATABASE)
+    try:
+        # Each shard reads the whole file for the rows of its ids
+        for shard, database in enumerate(SHARD_PATHS):
+            with open(path, 'rb') as file:
+                count = import_shard_rows(table, shard, shard_rows(reader(file, columns), shard), catalog)
+            print(f"Imported {count} rows into {table} on {database}")
+    finally:
+        catalog.close()
+
+
+# Function to import rows into a table of one shard in a transaction of its own, from a
+# command rather than the shard's writer; the shard's id allocator is moved past them
+def import_shard_rows(table, shard, rows, catalog):
+    conn = connect_db(SHARD_PATHS[shard])
+    try:
+        _pinned.catalog = catalog
+        with app.app_context(), use_connection(conn), transaction():
+            count = import_rows(conn.cursor(), table, rows)
+            highest = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+        id_allocator.advance(catalog, table, shard, highest)
+        return count
+    finally:
+        _pinned.catalog = None
+        conn.close()
+
+
+@app.cli.command('backup', help='Copy the database to PATH while the API keeps serving.')
+@click.option('--pages', type=int, default=BACKUP_STEP_PAGES, show_default=True,
+              help='Pages copied per step; -1 copies everything in one step.')
+@click.option('--sleep-ms', type=float, default=BACKUP_STEP_SLEEP * 1000, show_default=True,
+              help='Pause between steps.')
+@click.argument('path', type=click.Path(dir_okay=False))
+def backup_command(pages, sleep_ms, path):
+    init_db()
+    # Shards are copied next to PATH, named like the shard files next to the database
+    root, ext = os.path.splitext(path)
+    targets = [(DATABASE, path)] + [(database, f"{root}-shard{shard}{ext}")
+                                    for shard, database in enumerate(SHARD_PATHS)]
+    for database, target in targets:
+        # Written next to the target and renamed into place, so it is only ever a complete copy
+        partial = f"{target}.partial"
+        conn = sqlite3.connect(partial)
+        try:
+            start = time.perf_counter()
+            restarts = backup_database(conn, pages=pages, sleep=sleep_ms / 1000, database=database)
+            # A single self-contained file, without a -wal beside it
+            conn.execute("PRAGMA journal_mode = DELETE")
+            conn.close()
+            os.replace(partial, target)
+        except BaseException:
+            conn.close()
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        print(f"Backed up {database} to {target} in {time.perf_counter() - start:.2f}s ({restarts} restarts)")
+
+
+@app.cli.command('sync-replicas', help='Keep the replicas in PETSTORE_REPLICAS refreshed, for servers '
+                                       'running with PETSTORE_REPLICA_SYNC=0.')
+@click.option('--once', is_flag=True, help='Refresh every replica once and exit.')
+def sync_replicas_command(once):
+    if not REPLICAS:
+        sys.exit("No replicas configured; set PETSTORE_REPLICAS")
+    init_db()
+    # This process is the refresher, so no background thread
+    replicas = ReplicaSet(REPLICAS, sync=False)
+    while True:
+        started = time.monotonic()
+        for path in replicas.sync_all(force=once):
+            print(f"Synced {path} ({replicas.last_sync_seconds:.2f}s)")
+        if once:
+            return
+        time.sleep(max(0.0, replicas.sync_interval - (time.monotonic() - started)))
+
+
+@app.cli.command('compact-changes', help='Apply the change log retention and compaction settings.')
+def compact_changes_command():
+    removed = sum(run_maintenance(compact_changes, database) for database in DATABASES)
+    print(f"Removed {removed} change log entries")
+
+
+@app.cli.command('shard-data', help='Move the pets and orders stored in the main database to the shards '
+                                    'set by PETSTORE_SHARDS.')
+def shard_data_command():
+    if not SHARD_COUNT:
+        sys.exit("Sharding is off; set PETSTORE_SHARDS")
+    init_db()
+    catalog = connect_db(DATABASE)
+    try:
+        for table in SHARDED_TABLES:
+            columns = ', '.join(COLLECTIONS[table]['columns'])
+            # Rows go to the shard of their id; orders created before sharding therefore
+            # stay reachable by id but are not necessarily stored with their pet
+            with snapshot() as source:
+                for shard, database in enumerate(SHARD_PATHS):
+                    conn = connect_db(database, READ_PRAGMAS)
+                    try:
+                        present = {row[0] for row in conn.execute(f"SELECT id FROM {table}")}
+                    finally:
+                        conn.close()
+                    rows = (row for row in source.execute(f"SELECT {columns} FROM {table} WHERE id % ? = ? ORDER BY id",
+                                                          (SHARD_COUNT, shard))
+                            if row[0] not in present)
+                    count = import_shard_rows(table, shard, rows, catalog)
+                    print(f"Moved {count} {table} to {database}")
+
+            # Only once every shard has committed its rows are they removed here
+            def remove(cursor):
+                if table == 'pets':
+                    cursor.execute("DELETE FROM pet_tags")
+                    cursor.execute("DELETE FROM pet_photos")
+                cursor.execute(f"DELETE FROM {table}")
+            run_maintenance(remove)
+    finally:
+        catalog.close()
+
 
+startup_times['import'] = time.perf_counter() - IMPORT_STARTED
 
 if __name__ == '__main__':
     app.run(debug=True, port=8000)
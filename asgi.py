@@ -0,0 +1,274 @@
+import asyncio
+import io
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from werkzeug.exceptions import ClientDisconnected
+
+from FakeAPI import DB_POOL_SIZE, change_events_async, change_feed, configure_app, warm_up
+
+# Threads that run request handlers (and therefore SQLite work). Defaults to the
+# connection pool size so a handler never waits for a connection.
+ASGI_THREADS = int(os.environ.get('PETSTORE_ASGI_THREADS', DB_POOL_SIZE))
+# Response chunks buffered per request before the handler thread waits for the client
+ASGI_SEND_BUFFER = int(os.environ.get('PETSTORE_ASGI_SEND_BUFFER', 8))
+
+
+# wsgi.input that pulls the request body from the ASGI receive channel as the handler
+# reads it, so streamed uploads (NDJSON bulk writes, imports) are never held in memory
+# whole. Read on the handler thread; each chunk is awaited on the event loop.
+class ReceiveStream(io.RawIOBase):
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b''
+        self._more = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer and self._more:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message['type'] == 'http.disconnect':
+                # Answered with a 400 nobody reads, as for a short body under a WSGI server
+                self._more = False
+                raise ClientDisconnected()
+            self._buffer = message.get('body', b'')
+            self._more = message.get('more_body', False)
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+# Function to translate an ASGI HTTP scope and request body stream into a WSGI environ
+def build_environ(scope, stream):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    path = scope.get('raw_path') or scope['path'].encode('utf-8')
+    root_path = scope.get('root_path', '').encode('utf-8')
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.decode('latin-1'),
+        'PATH_INFO': path.split(b'?', 1)[0].decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': str(client[0]),
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': stream,
+        # The stream ends with the body, so chunked requests without a length can be read
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+        else:
+            key = f'HTTP_{name}'
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+# Function to wait on the event loop until a change after the cursor `since` arrives, like
+# ChangeFeed.wait() but without blocking a thread; False on timeout
+async def wait_for_change(since, timeout):
+    loop = asyncio.get_running_loop()
+    arrived = asyncio.Event()
+
+    def wake():
+        try:
+            loop.call_soon_threadsafe(arrived.set)
+        except RuntimeError:
+            pass  # The loop is closed; nobody is waiting any more
+
+    deadline = loop.time() + timeout
+    change_feed.add_listener(wake)
+    try:
+        while True:
+            # Cleared before the check, so a change arriving in between still wakes us
+            arrived.clear()
+            if change_feed.arrived(since):
+                return True
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(arrived.wait(), remaining)
+            except asyncio.TimeoutError:
+                return change_feed.arrived(since)
+    finally:
+        change_feed.remove_listener(wake)
+
+
+# ASGI application serving the Flask routes. Connections and keep-alive are handled on
+# the event loop; only requests that are actually running a handler occupy one of the
+# bounded executor threads, where the SQLite work happens. The handler reads the
+# request body as it arrives. /changes/stream is validated by its handler and then
+# streamed from the event loop, so idle subscribers do not hold executor threads.
+# `startup` runs in an executor thread before the server accepts requests.
+class AsyncPetStore:
+    def __init__(self, wsgi_app, threads=ASGI_THREADS, send_buffer=ASGI_SEND_BUFFER, startup=None):
+        self.wsgi_app = wsgi_app
+        self.startup = startup
+        self.threads = threads
+        self.send_buffer = send_buffer
+        self.executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='petstore-db')
+            return self.executor
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                executor = self._get_executor()
+                if self.startup is not None:
+                    try:
+                        await asyncio.get_running_loop().run_in_executor(executor, self.startup)
+                    except Exception as e:
+                        await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                        return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.executor is not None:
+                    self.executor.shutdown(wait=True)
+                    self.executor = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        stream = io.BufferedReader(ReceiveStream(receive, loop))
+        messages = asyncio.Queue(maxsize=self.send_buffer)
+        cancelled = threading.Event()
+        # Cursor of a change stream the handler handed over to the loop
+        streams = []
+
+        # Runs in an executor thread: call the WSGI app and hand messages to the loop
+        def put(message):
+            if not cancelled.is_set():
+                asyncio.run_coroutine_threadsafe(messages.put(message), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            code = int(status.split(' ', 1)[0])
+            put(('start', code, [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]))
+
+        def run():
+            try:
+                environ = build_environ(scope, stream)
+                environ['petstore.stream_changes'] = streams.append
+                result = self.wsgi_app(environ, start_response)
+                try:
+                    for chunk in result:
+                        if cancelled.is_set():
+                            break
+                        if chunk:
+                            put(('body', chunk))
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+                put(('end', None))
+            except BaseException as e:
+                put(('error', e))
+
+        worker = loop.run_in_executor(self._get_executor(), run)
+        started = False
+        try:
+            while True:
+                kind, *payload = await messages.get()
+                if kind == 'start':
+                    code, headers = payload
+                    await send({'type': 'http.response.start', 'status': code, 'headers': headers})
+                    started = True
+                elif kind == 'body':
+                    await send({'type': 'http.response.body', 'body': payload[0], 'more_body': True})
+                elif kind == 'end':
+                    if streams:
+                        await self._stream_changes(streams.pop(), receive, send)
+                    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+                    break
+                else:
+                    if not started:
+                        await send({'type': 'http.response.start', 'status': 500,
+                                    'headers': [(b'content-type', b'text/plain')]})
+                        await send({'type': 'http.response.body', 'body': b'Internal Server Error'})
+                    raise payload[0]
+        finally:
+            # Unblock the handler thread if the client went away mid-response
+            cancelled.set()
+            while not worker.done():
+                try:
+                    messages.get_nowait()
+                except asyncio.QueueEmpty:
+                    await asyncio.sleep(0.001)
+            await worker
+            # A stream handed over but never started still holds its slot
+            if streams:
+                change_feed.close_stream()
+
+    # Sends the change events after the cursor `since` until the client disconnects; the
+    # database reads run on the executor, the waits on the loop
+    async def _stream_changes(self, since, receive, send):
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+
+        async def run(function, *args):
+            return await loop.run_in_executor(executor, partial(function, *args))
+
+        async def events():
+            async for text in change_events_async(since, run, wait_for_change):
+                await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': True})
+
+        async def disconnected():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        tasks = [asyncio.ensure_future(events()), asyncio.ensure_future(disconnected())]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            change_feed.close_stream()
+
+
+application = AsyncPetStore(configure_app({'HANDLER_THREADS': ASGI_THREADS}), startup=warm_up)
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit("The async mode needs an ASGI server: pip install uvicorn")
+    uvicorn.run(application, host=os.environ.get('PETSTORE_HOST', '127.0.0.1'),
+                port=int(os.environ.get('PETSTORE_PORT', 8000)), lifespan='on')
@@ -0,0 +1,120 @@
+# Bytes on the wire vs CPU for each response encoding, per endpoint.
+# Seeds a scratch database, then fetches every endpoint through the Flask test client
+# with each JSON encoder and each Content-Encoding/level, and reports the response
+# size, compression ratio and CPU time per request.
+#
+# Usage:
+#   python benchmarks/bench_compression.py --pets 10000 --orders 10000
+#   python benchmarks/bench_compression.py --level gzip=1 --level gzip=9 --output compression.json
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_endpoints import git_revision, seed  # noqa: E402
+
+ENDPOINTS = (
+    '/pets?limit=1000',
+    '/orders?limit=1000',
+    '/users?limit=1000',
+    '/pets?stream=ndjson',
+    '/pets/1',
+    '/categories',
+    '/search?q=pet&limit=100',
+)
+DEFAULT_LEVELS = {'gzip': (1, 6, 9), 'br': (1, 4, 9), 'zstd': (1, 3, 9)}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare response encodings per endpoint.")
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--pets', type=int, default=5000)
+    parser.add_argument('--orders', type=int, default=5000)
+    parser.add_argument('--endpoint', action='append', help="only fetch these paths (repeatable)")
+    parser.add_argument('--level', action='append', metavar='ENCODING=LEVEL',
+                        help="compression levels to try (repeatable; default: a low, the default and a high level)")
+    parser.add_argument('--repeat', type=int, default=20, help="requests per combination")
+    parser.add_argument('--output', help="also write the results to this JSON file")
+    return parser.parse_args()
+
+
+# Function to parse --level options into {encoding: [levels]}
+def parse_levels(options):
+    if not options:
+        return {encoding: list(levels) for encoding, levels in DEFAULT_LEVELS.items()}
+    levels = {}
+    for option in options:
+        encoding, _, level = option.partition('=')
+        levels.setdefault(encoding, []).append(int(level))
+    return levels
+
+
+# Function to fetch `path` `repeat` times; returns (bytes per response, CPU ms per request)
+def measure(client, path, headers, repeat):
+    size = 0
+    # Warm the entity cache and the statement cache first
+    client.get(path, headers=headers)
+    start = time.process_time()
+    for _ in range(repeat):
+        response = client.get(path, headers=headers)
+        size = len(response.get_data())
+        if response.status_code != 200:
+            raise RuntimeError(f"{path} returned {response.status_code}")
+    return size, (time.process_time() - start) * 1000 / repeat
+
+
+def main():
+    args = parse_args()
+    database = os.path.join(tempfile.mkdtemp(prefix='petstore-bench-'), 'petstore.db')
+
+    import FakeAPI
+    FakeAPI.configure_app({'DATABASE': database})
+    FakeAPI.init_db()
+
+    seed(database, users=args.users, pets=args.pets, orders=args.orders, categories=50, tags=50)
+    client = FakeAPI.app.test_client()
+    levels = parse_levels(args.level)
+    results = []
+    for encoder_name, encoder in FakeAPI.JSON_ENCODERS.items():
+        # Looked up at call time by the row encoders and the JSON provider
+        FakeAPI.encode_json = encoder
+        for path in args.endpoint or ENDPOINTS:
+            identity_size, identity_ms = measure(client, path, {'Accept-Encoding': 'identity'}, args.repeat)
+            combinations = [('identity', None)] + [(encoding, level) for encoding in FakeAPI.COMPRESS_ENCODINGS
+                                                   for level in levels.get(encoding, ())]
+            for encoding, level in combinations:
+                if encoding == 'identity':
+                    size, cpu_ms = identity_size, identity_ms
+                else:
+                    FakeAPI.COMPRESS_LEVELS[encoding] = level
+                    size, cpu_ms = measure(client, path, {'Accept-Encoding': encoding}, args.repeat)
+                result = {
+                    'encoder': encoder_name, 'endpoint': path, 'encoding': encoding, 'level': level,
+                    'bytes': size, 'ratio': round(identity_size / size, 2) if size else None,
+                    'cpu_ms': round(cpu_ms, 3), 'extra_cpu_ms': round(cpu_ms - identity_ms, 3),
+                }
+                results.append(result)
+                label = encoding if level is None else f"{encoding}-{level}"
+                print(f"{encoder_name:<7} {path:<26} {label:<9} {size:>10} B  x{result['ratio']:<6} "
+                      f"{result['cpu_ms']:>9} ms cpu  ({result['extra_cpu_ms']:+} ms)", file=sys.stderr)
+    FakeAPI.encode_json = FakeAPI.JSON_ENCODERS[FakeAPI.JSON_ENCODER]
+
+    if args.output:
+        report = {
+            'revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': sys.version.split()[0],
+            'compress_min_size': FakeAPI.COMPRESS_MIN_SIZE,
+            'results': results,
+        }
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+        print(f"wrote {args.output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,373 @@
+# Load test for every endpoint in FakeAPI.py.
+# Seeds a scratch database with synthetic data, drives each route through the Flask
+# test client and/or a real local WSGI server, and writes p50/p95/p99 latency,
+# throughput and peak RSS per endpoint to a JSON file for comparing commits.
+#
+# Usage:
+#   python benchmarks/bench_endpoints.py --pets 100000 --orders 100000 --concurrency 16
+#   python benchmarks/bench_endpoints.py --mode server --scenario mixed --output results.json
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+STATUSES = ('available', 'pending', 'sold')
+ORDER_STATUSES = ('placed', 'approved', 'delivered')
+
+
+# Function to fill a fresh database with synthetic rows
+def seed(database, users, pets, orders, categories, tags):
+    import sqlite3
+    conn = sqlite3.connect(database)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = OFF")
+    with conn:
+        conn.executemany("INSERT INTO categories (id, name) VALUES (?, ?)",
+                         ((i, f"category-{i}") for i in range(1, categories + 1)))
+        conn.executemany("INSERT INTO tags (id, name) VALUES (?, ?)",
+                         ((i, f"tag-{i}") for i in range(1, tags + 1)))
+        conn.executemany(
+            "INSERT INTO users (id, username, email, phone, address, user_status) VALUES (?, ?, ?, ?, ?, ?)",
+            ((i, f"user{i}", f"user{i}@example.com", f"{i % 10 ** 10:010d}", f"{i} Main St", '1')
+             for i in range(1, users + 1)))
+        conn.executemany(
+            "INSERT INTO pets (id, name, category_id, photo_urls, tags, status) VALUES (?, ?, ?, ?, ?, ?)",
+            ((i, f"pet-{i}", i % categories + 1, f"https://example.com/{i}.jpg", f"tag-{i % tags + 1}",
+              STATUSES[i % len(STATUSES)]) for i in range(1, pets + 1)))
+        # The API keeps these link tables in step with pets.tags and pets.photo_urls
+        conn.executemany("INSERT INTO pet_tags (pet_id, tag_id, position) VALUES (?, ?, 0)",
+                         ((i, i % tags + 1) for i in range(1, pets + 1)))
+        conn.executemany("INSERT INTO pet_photos (pet_id, position, url) VALUES (?, 0, ?)",
+                         ((i, f"https://example.com/{i}.jpg") for i in range(1, pets + 1)))
+        conn.executemany(
+            "INSERT INTO orders (id, pet_id, quantity, ship_date, status, complete) VALUES (?, ?, ?, ?, ?, ?)",
+            ((i, i % pets + 1, i % 5 + 1, f"2024-01-{i % 28 + 1:02d}T08:00:00Z",
+              ORDER_STATUSES[i % len(ORDER_STATUSES)], i % 2 == 0) for i in range(1, orders + 1)))
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+# Function to read the ETags of the first `count` pets, for conditional GETs
+def pet_etags(database, count):
+    import sqlite3
+    import FakeAPI
+    conn = sqlite3.connect(database)
+    try:
+        return {pet_id: FakeAPI.entity_etag(version)
+                for pet_id, version in conn.execute("SELECT id, version FROM pets WHERE id <= ?", (count,))}
+    finally:
+        conn.close()
+
+
+# Request generators: each returns (method, path, json body or None), plus a dict of
+# request headers when it needs some.
+# Reads and updates use ids up to sizes[table]; DELETE walks down from the top of the
+# `reserve` extra rows seeded above that, so it never removes rows the reads expect.
+# `etags` maps pet ids to their ETags; PUT /pets/<id> changes some, which then answer 200.
+def endpoint_requests(sizes, reserve, etags):
+    delete_ids = {table: itertools.count(count + reserve, -1) for table, count in sizes.items()}
+
+    def read_id(table):
+        return random.randint(1, sizes[table])
+
+    def new_user():
+        n = random.randint(0, 10 ** 9)
+        return {'username': f"bench{n}", 'email': f"bench{n}@example.com", 'phone': '5550000000'}
+
+    def conditional_pet():
+        pet_id = random.choice(etag_ids)
+        return 'GET', f"/pets/{pet_id}", None, {'If-None-Match': f'"{etags[pet_id]}"'}
+
+    def new_pet():
+        return {'name': 'bench', 'category_id': random.randint(1, min(50, sizes['categories'])), 'status': 'available'}
+
+    def new_order():
+        return {'pet_id': read_id('pets'), 'quantity': 1, 'status': 'placed',
+                'shipDate': '2024-02-16T08:00:00Z', 'complete': False}
+
+    creators = {'users': new_user, 'pets': new_pet, 'orders': new_order,
+                'categories': lambda: {'name': 'bench'}, 'tags': lambda: {'name': 'bench'}}
+    updates = {'users': lambda: {'address': 'Bench Rd'}, 'pets': lambda: {'status': random.choice(STATUSES)},
+               'orders': lambda: {'status': 'approved', 'shipDate': '2024-02-17T08:00:00Z'},
+               'categories': lambda: {'name': 'renamed'}, 'tags': lambda: {'name': 'renamed'}}
+
+    etag_ids = list(etags)
+    endpoints = {}
+    for table in sizes:
+        endpoints[f"GET /{table}"] = lambda t=table: ('GET', f"/{t}?limit=100", None)
+        endpoints[f"GET /{table}?after_id"] = lambda t=table: ('GET', f"/{t}?limit=100&after_id={read_id(t)}", None)
+        endpoints[f"GET /{table}/<id>"] = lambda t=table: ('GET', f"/{t}/{read_id(t)}", None)
+        endpoints[f"POST /{table}"] = lambda t=table: ('POST', f"/{t}", creators[t]())
+        endpoints[f"POST /{table}/bulk"] = lambda t=table: ('POST', f"/{t}/bulk", [creators[t]() for _ in range(100)])
+        endpoints[f"PUT /{table}/<id>"] = lambda t=table: ('PUT', f"/{t}/{read_id(t)}", updates[t]())
+        endpoints[f"DELETE /{table}/<id>"] = lambda t=table: ('DELETE', f"/{t}/{next(delete_ids[t])}", None)
+    endpoints["GET /pets?status"] = lambda: ('GET', f"/pets?status={random.choice(STATUSES)}&limit=100", None)
+    endpoints["GET /orders?pet_id"] = lambda: ('GET', f"/orders?pet_id={read_id('pets')}", None)
+    endpoints["GET /pets?stream=1"] = lambda: ('GET', "/pets?stream=1&limit=10000", None)
+    endpoints["GET /pets/<id> If-None-Match"] = conditional_pet
+    endpoints["GET /pets/findByTags"] = lambda: ('GET', f"/pets/findByTags?tags=tag-{read_id('tags')}&limit=100", None)
+    endpoints["GET /tags/<id>/pets"] = lambda: ('GET', f"/tags/{read_id('tags')}/pets?limit=100", None)
+    endpoints["GET /search"] = lambda: ('GET', f"/search?q=pet-{read_id('pets')}&limit=20", None)
+    endpoints["GET /store/inventory"] = lambda: ('GET', "/store/inventory", None)
+    endpoints["GET /orders/stats"] = lambda: ('GET', "/orders/stats", None)
+    endpoints["GET /changes"] = lambda: ('GET', "/changes?limit=100", None)
+    endpoints["GET /complex-json-file"] = lambda: ('GET', "/complex-json-file", None)
+    endpoints["GET /db-pool"] = lambda: ('GET', "/db-pool", None)
+    endpoints["GET /entity-cache"] = lambda: ('GET', "/entity-cache", None)
+    return endpoints
+
+
+# Mixed scenario weights, mirroring production: mostly single-item reads
+MIXED_WEIGHTS = {
+    "GET /pets/<id>": 40,
+    "GET /categories/<id>": 15,
+    "GET /orders/<id>": 10,
+    "GET /users/<id>": 5,
+    "GET /pets?status": 10,
+    "GET /orders?pet_id": 5,
+    "GET /pets": 3,
+    "POST /orders": 5,
+    "PUT /pets/<id>": 4,
+    "PUT /orders/<id>": 2,
+    "POST /pets": 1,
+}
+
+
+# Function to build the mixed read/write request generator
+def mixed_requests(endpoints):
+    names = list(MIXED_WEIGHTS)
+    weights = [MIXED_WEIGHTS[name] for name in names]
+    return lambda: endpoints[random.choices(names, weights)[0]]()
+
+
+# Client that sends requests through the Flask test client
+class TestClientTransport:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def __call__(self, method, path, body, headers=None):
+        response = self.client.open(path, method=method, json=body, headers=headers)
+        response.get_data()
+        return response.status_code
+
+
+# Client that sends requests to a local WSGI server over keep-alive connections
+class HTTPTransport:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.local = threading.local()
+
+    def __call__(self, method, path, body, headers=None):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        payload = json.dumps(body) if body is not None else None
+        headers = dict(headers or {})
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+        try:
+            conn.request(method, path, body=payload, headers=headers)
+            response = conn.getresponse()
+            response.read()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            self.local.conn = None
+            raise
+        return response.status
+
+
+# Function to read the current resident set size in bytes
+def current_rss():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # ru_maxrss is in KiB on Linux and bytes on macOS
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+# Function to compute a percentile from sorted samples
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    index = min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))
+    return samples[index]
+
+
+# Function to fire `requests` requests from `concurrency` threads and collect statistics
+def run(transport, make_request, requests, concurrency):
+    latencies, statuses, errors = [], {}, 0
+    lock = threading.Lock()
+    remaining = itertools.count()
+    peak_rss = current_rss()
+    done = threading.Event()
+
+    def sample_rss():
+        nonlocal peak_rss
+        while not done.wait(0.05):
+            peak_rss = max(peak_rss, current_rss())
+
+    def worker():
+        nonlocal errors
+        local_latencies = []
+        while next(remaining) < requests:
+            request = make_request()
+            start = time.perf_counter()
+            try:
+                status = transport(*request)
+            except Exception:
+                with lock:
+                    errors += 1
+                continue
+            local_latencies.append(time.perf_counter() - start)
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+        with lock:
+            latencies.extend(local_latencies)
+
+    sampler = threading.Thread(target=sample_rss, daemon=True)
+    sampler.start()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    done.set()
+    sampler.join()
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'seconds': round(elapsed, 4),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        'peak_rss_mb': round(max(peak_rss, current_rss()) / 2 ** 20, 1),
+    }
+
+
+# Function to start a threaded WSGI server for the app on a free local port
+def start_server(app):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test every FakeAPI endpoint.")
+    parser.add_argument('--database', help="scratch database path (default: a temporary file)")
+    parser.add_argument('--no-seed', action='store_true', help="use --database as is")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--pets', type=int, default=1000)
+    parser.add_argument('--orders', type=int, default=1000)
+    parser.add_argument('--categories', type=int, default=50)
+    parser.add_argument('--tags', type=int, default=50)
+    parser.add_argument('--mode', choices=('client', 'server', 'both'), default='both')
+    parser.add_argument('--scenario', choices=('endpoints', 'mixed', 'all'), default='all')
+    parser.add_argument('--endpoint', action='append', help="only run these endpoints (repeatable)")
+    parser.add_argument('--requests', type=int, default=500, help="requests per endpoint")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=20, help="unmeasured requests per endpoint")
+    parser.add_argument('--seed', type=int, default=1234, help="random seed")
+    parser.add_argument('--output', default='bench_results.json')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    database = args.database or os.path.join(tempfile.mkdtemp(prefix='petstore-bench-'), 'petstore.db')
+
+    import FakeAPI
+    FakeAPI.configure_app({'DATABASE': database})
+    FakeAPI.init_db()
+
+    sizes = {'users': args.users, 'pets': args.pets, 'orders': args.orders,
+             'categories': args.categories, 'tags': args.tags}
+    transport_count = 2 if args.mode == 'both' else 1
+    reserve = (args.requests + args.warmup) * transport_count
+    if not args.no_seed:
+        started = time.perf_counter()
+        seed(database, **{table: count + reserve for table, count in sizes.items()})
+        print(f"seeded {database} in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    FakeAPI.entity_cache.clear()
+
+    endpoints = endpoint_requests(sizes, reserve, pet_etags(database, min(sizes['pets'], 1000)))
+    scenarios = {}
+    if args.scenario in ('endpoints', 'all'):
+        for name in args.endpoint or endpoints:
+            scenarios[name] = endpoints[name]
+    if args.scenario in ('mixed', 'all'):
+        scenarios['mixed'] = mixed_requests(endpoints)
+
+    transports = {}
+    server = None
+    if args.mode in ('client', 'both'):
+        transports['client'] = TestClientTransport(FakeAPI.app)
+    if args.mode in ('server', 'both'):
+        server = start_server(FakeAPI.app)
+        transports['server'] = HTTPTransport('127.0.0.1', server.server_port)
+
+    results = []
+    try:
+        for transport_name, transport in transports.items():
+            for name, make_request in scenarios.items():
+                run(transport, make_request, args.warmup, min(args.concurrency, max(args.warmup, 1)))
+                stats = run(transport, make_request, args.requests, args.concurrency)
+                stats.update(transport=transport_name, endpoint=name)
+                results.append(stats)
+                print(f"{transport_name:<7} {name:<28} {stats['throughput_rps']:>9} rps  "
+                      f"p50 {stats['p50_ms']} ms  p95 {stats['p95_ms']} ms  p99 {stats['p99_ms']} ms  "
+                      f"rss {stats['peak_rss_mb']} MB  errors {stats['errors']}", file=sys.stderr)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': sys.version.split()[0],
+        'sizes': sizes,
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'results': results,
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print(f"wrote {args.output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# Microbenchmark: validation cost per request.
+# Compares the hand-written if-chains the handlers used before with the compiled schemas.
+# Usage: python benchmarks/bench_validation.py [iterations]
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FakeAPI import validate_order, validate_pet, validate_user  # noqa: E402
+
+
+# The hand-written checks, as they were before the schemas (first error only)
+def handwritten_user(data):
+    for field in ('username', 'email', 'phone'):
+        if field not in data:
+            return f"Missing required field: {field}"
+    if '@' not in data['email']:
+        return "Invalid email format"
+    if len(data['phone']) != 10 or not data['phone'].isdigit():
+        return "Invalid phone number format. Phone number must be 10 digits."
+    if len(data['username']) < 3 or len(data['username']) > 50:
+        return "Username must be between 3 and 50 characters long."
+    if 'address' in data and len(data['address']) > 100:
+        return "Address must be less than 100 characters long."
+    if 'user_status' in data and data['user_status'] > 50:
+        return "User status must be less than 50"
+    return None
+
+
+def handwritten_pet(data):
+    if 'name' not in data or 'category_id' not in data or 'status' not in data:
+        return "Missing required fields: name, category, status"
+    if data['category_id'] > 50:
+        return "Category must be less than 50"
+    if len(data['status']) > 50:
+        return "Status must be less than 50 characters long"
+    return None
+
+
+def handwritten_order(data):
+    if 'pet_id' not in data or 'quantity' not in data or 'status' not in data or 'shipDate' not in data:
+        return "Missing required fields: pet_id, quantity, status, shipDate"
+    if not isinstance(data['pet_id'], int) or data['pet_id'] < 0:
+        return "Invalid pet_id format"
+    if not isinstance(data['quantity'], int) or data['quantity'] <= 0:
+        return "Invalid quantity format"
+    if len(data['status']) > 50:
+        return "Status must be less than 50 characters long"
+    return None
+
+
+CASES = {
+    'user': ({'username': 'alice', 'email': 'alice@example.com', 'phone': '5551234567',
+              'address': '1 Main St', 'user_status': 1}, handwritten_user, validate_user),
+    'pet': ({'name': 'Rex', 'category_id': 3, 'status': 'available', 'photo_urls': '', 'tags': 'Friendly'},
+            handwritten_pet, validate_pet),
+    'order': ({'pet_id': 7, 'quantity': 2, 'status': 'placed', 'shipDate': '2024-02-16T08:00:00Z',
+               'complete': False}, handwritten_order, validate_order),
+}
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    for name, (data, handwritten, compiled) in CASES.items():
+        assert handwritten(data) is None and compiled(data) == []
+        old = min(timeit.repeat(lambda: handwritten(data), number=number, repeat=5)) / number
+        new = min(timeit.repeat(lambda: compiled(data), number=number, repeat=5)) / number
+        print(f"{name:<6} hand-written {old * 1e6:6.2f} us   compiled schema {new * 1e6:6.2f} us")
+
+
+if __name__ == '__main__':
+    main()
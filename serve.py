@@ -0,0 +1,78 @@
+import argparse
+import multiprocessing
+import os
+import sys
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    sys.exit("The production server needs gunicorn: pip install gunicorn")
+
+
+# Production entry point: a gunicorn pre-fork master around FakeAPI.app, set up by configure_app().
+# The app is created once in the master, where the schema is set up and the static
+# JSON file is loaded, and only then are the workers forked. Send SIGHUP for a graceful
+# reload of the workers and SIGTERM for a graceful shutdown.
+#
+# A worker only invalidates the entity cache for its own writes, so with several
+# workers an entry lives for --entity-cache-ttl seconds at most, and the master does
+# not preload entities that every worker would then keep serving after another changed them.
+class PetStoreServer(BaseApplication):
+    def __init__(self, options, config=None):
+        self.options = options
+        self.config = config
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        import FakeAPI
+        config = dict(self.config or {}, HANDLER_THREADS=self.cfg.threads)
+        if self.cfg.workers == 1:
+            config.pop('ENTITY_CACHE_TTL', None)
+        app = FakeAPI.configure_app(config)
+        FakeAPI.warm_up(entities=self.cfg.workers == 1)
+        return app
+
+
+def parse_args():
+    env = os.environ.get
+    parser = argparse.ArgumentParser(description="Run the pet store API with pre-forked workers.")
+    parser.add_argument('--bind', default=env('PETSTORE_BIND', '127.0.0.1:8000'))
+    parser.add_argument('--database', help="SQLite database file (default: PETSTORE_DATABASE or petstore.db)")
+    parser.add_argument('--workers', type=int, default=int(env('PETSTORE_WORKERS', multiprocessing.cpu_count())),
+                        help="worker processes (default: CPU cores)")
+    parser.add_argument('--threads', type=int, default=int(env('PETSTORE_THREADS', 4)),
+                        help="threads per worker")
+    parser.add_argument('--max-requests', type=int, default=int(env('PETSTORE_MAX_REQUESTS', 10000)),
+                        help="recycle a worker after this many requests (0 disables)")
+    parser.add_argument('--max-requests-jitter', type=int, default=int(env('PETSTORE_MAX_REQUESTS_JITTER', 1000)))
+    parser.add_argument('--keepalive', type=int, default=int(env('PETSTORE_KEEPALIVE', 5)),
+                        help="seconds to keep idle connections open")
+    parser.add_argument('--entity-cache-ttl', type=float, default=float(env('PETSTORE_WORKER_CACHE_TTL', 1.0)),
+                        help="seconds an entity cache entry lives when there are several workers")
+    parser.add_argument('--timeout', type=int, default=int(env('PETSTORE_TIMEOUT', 30)))
+    parser.add_argument('--graceful-timeout', type=int, default=int(env('PETSTORE_GRACEFUL_TIMEOUT', 30)))
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    PetStoreServer({
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread',
+        'max_requests': args.max_requests,
+        'max_requests_jitter': args.max_requests_jitter,
+        'keepalive': args.keepalive,
+        'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+        'preload_app': True,
+    }, dict({'DATABASE': args.database} if args.database else {}, ENTITY_CACHE_TTL=args.entity_cache_ttl)).run()
+
+
+if __name__ == '__main__':
+    main()
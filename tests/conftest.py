@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import FakeAPI  # noqa: E402
+
+
+# Fixture opening a writable connection to a scratch database, set up for FakeAPI's
+# transaction helpers the way init_db() does
+@pytest.fixture
+def conn(tmp_path):
+    conn = FakeAPI.connect_db(str(tmp_path / 'petstore.db'))
+    try:
+        with FakeAPI.app.app_context(), FakeAPI.use_connection(conn):
+            yield conn
+    finally:
+        conn.close()
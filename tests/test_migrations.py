@@ -0,0 +1,98 @@
+import os
+import shutil
+
+import FakeAPI
+from conftest import ROOT
+
+# Tables as the first versions of init_db() created them: camelCase names for some
+# columns and NOT NULL on every one
+LEGACY_SCHEMA = '''
+    CREATE TABLE users (id INTEGER PRIMARY KEY, username TEXT NOT NULL, email TEXT NOT NULL,
+                        phone TEXT NOT NULL, userStatus INTEGER NOT NULL, address TEXT NOT NULL);
+    CREATE TABLE pets (id INTEGER PRIMARY KEY, name TEXT NOT NULL, category_id INTEGER NOT NULL,
+                       status TEXT NOT NULL, photoUrls TEXT NOT NULL, tags TEXT,
+                       FOREIGN KEY (category_id) REFERENCES categories (id));
+    CREATE TABLE orders (id INTEGER PRIMARY KEY, pet_id INTEGER NOT NULL, quantity INTEGER NOT NULL,
+                         shipDate TEXT NOT NULL, status TEXT NOT NULL, complete BOOLEAN NOT NULL,
+                         FOREIGN KEY (pet_id) REFERENCES pets (id));
+    CREATE TABLE categories (id INTEGER PRIMARY KEY, name TEXT NOT NULL);
+    CREATE TABLE tags (id INTEGER PRIMARY KEY, name TEXT NOT NULL);
+    INSERT INTO categories (id, name) VALUES (1, 'dogs');
+    INSERT INTO tags (id, name) VALUES (1, 'friendly');
+    INSERT INTO pets (id, name, category_id, status, photoUrls, tags)
+        VALUES (1, 'rex', 1, 'available', 'https://example.com/rex.jpg', 'friendly');
+    INSERT INTO orders (id, pet_id, quantity, shipDate, status, complete)
+        VALUES (1, 1, 2, '2024-01-01T08:00:00Z', 'placed', 0);
+'''
+
+
+def columns(conn, table):
+    # table_info rows: (cid, name, type, notnull, default, pk)
+    return {row[1]: bool(row[3]) for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def assert_latest_schema(conn):
+    latest = FakeAPI.MIGRATIONS[-1][0]
+    assert FakeAPI.get_schema_version(conn) == latest
+    for table, definition in FakeAPI.TABLE_DEFINITIONS.items():
+        declared = [item.split()[0] for item in definition if not item.startswith('FOREIGN KEY')]
+        found = columns(conn, table)
+        assert set(declared) <= set(found)
+        assert not any(found[column] for column in declared if column != 'id')
+
+
+def test_baseline_database_migrates_to_latest(conn, tmp_path):
+    # The database shipped with the original app, before schema versions existed
+    path = str(tmp_path / 'baseline.db')
+    shutil.copy(os.path.join(ROOT, 'petstore.db'), path)
+    baseline = FakeAPI.connect_db(path)
+    try:
+        counts = {table: baseline.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                  for table in FakeAPI.TABLE_DEFINITIONS}
+        with FakeAPI.use_connection(baseline):
+            assert FakeAPI.migrate(baseline) == [version for version, _, _ in FakeAPI.MIGRATIONS]
+            assert FakeAPI.migrate(baseline) == []
+        assert_latest_schema(baseline)
+        for table, count in counts.items():
+            migrated = baseline.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            # Migration 4 adds the tags pets name but the tags table lacks
+            assert migrated >= count if table == 'tags' else migrated == count
+        tagged = baseline.execute("SELECT COUNT(*) FROM pets WHERE tags IS NOT NULL AND tags != ''").fetchone()[0]
+        if tagged:
+            assert baseline.execute("SELECT COUNT(DISTINCT pet_id) FROM pet_tags").fetchone()[0] == tagged
+    finally:
+        baseline.close()
+
+
+def test_legacy_tables_are_rebuilt(conn):
+    conn.executescript(LEGACY_SCHEMA)
+    FakeAPI.migrate(conn)
+    assert_latest_schema(conn)
+    assert conn.execute("SELECT photo_urls, tags FROM pets WHERE id = 1").fetchone() == \
+        ('https://example.com/rex.jpg', 'friendly')
+    assert conn.execute("SELECT ship_date FROM orders WHERE id = 1").fetchone() == ('2024-01-01T08:00:00Z',)
+    # Optional fields can be left out now
+    conn.execute("INSERT INTO pets (name, status) VALUES ('tom', 'pending')")
+
+
+def test_migration_11_rebuilds_tables_renamed_in_place(conn, monkeypatch):
+    # Older versions of migration 2 only renamed the camelCase columns, which kept NOT
+    # NULL; start from such a database at schema version 10
+    conn.executescript(LEGACY_SCHEMA.replace('userStatus', 'user_status').replace('photoUrls', 'photo_urls')
+                       .replace('shipDate', 'ship_date'))
+    renamed_only = [(version, description, (lambda cursor: None) if version == 2 else migration)
+                    for version, description, migration in FakeAPI.MIGRATIONS if version <= 10]
+    monkeypatch.setattr(FakeAPI, 'MIGRATIONS', renamed_only)
+    FakeAPI.migrate(conn)
+    assert columns(conn, 'pets')['photo_urls']
+    monkeypatch.undo()
+
+    assert FakeAPI.migrate(conn) == [version for version, _, _ in FakeAPI.MIGRATIONS if version > 10]
+    assert_latest_schema(conn)
+    # The triggers added since migration 2 survive the rebuild
+    triggers = {name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+    assert {'pets_version_insert', 'pets_changes_insert', 'pets_fts_insert'} <= triggers
+    with FakeAPI.transaction():
+        conn.execute("INSERT INTO pets (name, status) VALUES ('tom', 'pending')")
+    assert conn.execute("SELECT COUNT(*) FROM changes WHERE table_name = 'pets'").fetchone()[0] == 1
+    assert conn.execute("SELECT rowid FROM pets_fts WHERE pets_fts MATCH 'tom'").fetchall() == [(2,)]
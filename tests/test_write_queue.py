@@ -0,0 +1,104 @@
+import sqlite3
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import pytest
+
+import FakeAPI
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'queue.db')
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("CREATE TABLE items (name TEXT)")
+    conn.close()
+    return path
+
+
+def names(database):
+    conn = sqlite3.connect(database)
+    try:
+        return sorted(name for name, in conn.execute("SELECT name FROM items"))
+    finally:
+        conn.close()
+
+
+# Function to build a job inserting `name` on the writer; fail=True raises after the insert
+def insert_job(name, fail=False):
+    def job():
+        FakeAPI.get_db().execute("INSERT INTO items (name) VALUES (?)", (name,))
+        if fail:
+            raise ValueError(name)
+        return name, []
+    return job
+
+
+def test_failing_job_does_not_undo_its_batch(database):
+    queue = FakeAPI.WriteQueue(database, batch_size=3, batch_latency=1.0)
+    futures = [queue.enqueue(insert_job('a')), queue.enqueue(insert_job('b', fail=True)),
+               queue.enqueue(insert_job('c'))]
+    assert futures[0].result(timeout=5) == 'a'
+    with pytest.raises(ValueError):
+        futures[1].result(timeout=5)
+    assert futures[2].result(timeout=5) == 'c'
+    assert names(database) == ['a', 'c']
+    metrics = queue.metrics()
+    assert metrics['batches'] == 1
+    assert metrics['max_batch_size'] == 3
+    assert metrics['failed_jobs'] == 1
+
+
+def test_after_commit_callbacks_run_only_for_committed_jobs(database):
+    queue = FakeAPI.WriteQueue(database, batch_size=2, batch_latency=1.0)
+    called = []
+
+    def job():
+        FakeAPI.get_db().execute("INSERT INTO items (name) VALUES ('a')")
+        return 'a', [lambda: called.append('a')]
+
+    def failing():
+        raise ValueError('b')
+
+    ok, failed = queue.enqueue(job), queue.enqueue(failing)
+    assert ok.result(timeout=5) == 'a'
+    with pytest.raises(ValueError):
+        failed.result(timeout=5)
+    assert called == ['a']
+
+
+def test_timed_out_job_is_cancelled_before_it_runs(database):
+    queue = FakeAPI.WriteQueue(database, batch_size=1, batch_latency=0, timeout=0.1)
+    started, release = threading.Event(), threading.Event()
+
+    def blocker():
+        started.set()
+        release.wait(5)
+        return insert_job('blocker')()
+
+    blocked = queue.enqueue(blocker)
+    assert started.wait(5)
+    try:
+        with pytest.raises(FutureTimeoutError):
+            queue.submit(insert_job('late'))
+    finally:
+        release.set()
+    assert blocked.result(timeout=5) == 'blocker'
+    # The writer skips the cancelled job and keeps going
+    assert queue.submit(insert_job('next')) == 'next'
+    assert names(database) == ['blocker', 'next']
+
+
+def test_running_job_is_waited_for_past_the_timeout(database):
+    queue = FakeAPI.WriteQueue(database, batch_size=1, batch_latency=0, timeout=0.1)
+    # Start the writer first, so the slow job is picked up at once
+    queue.submit(insert_job('first'))
+
+    def slow():
+        time.sleep(0.5)
+        return insert_job('slow')()
+
+    assert queue.submit(slow) == 'slow'
+    assert names(database) == ['first', 'slow']